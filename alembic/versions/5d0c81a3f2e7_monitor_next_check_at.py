@@ -0,0 +1,26 @@
+"""Monitor next check at
+
+Revision ID: 5d0c81a3f2e7
+Revises: 3e8ee2e89ded
+Create Date: 2026-10-18 10:12:31.284102
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d0c81a3f2e7'
+down_revision = '3e8ee2e89ded'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('monitor', sa.Column('next_check_at', sa.DateTime(), server_default=sa.func.now(), nullable=False))
+    op.create_index(op.f('ix_monitor_next_check_at'), 'monitor', ['next_check_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_monitor_next_check_at'), table_name='monitor')
+    op.drop_column('monitor', 'next_check_at')
@@ -0,0 +1,31 @@
+"""Monitor active
+
+Revision ID: 8a4f1d2c6b90
+Revises: 5d0c81a3f2e7
+Create Date: 2026-10-18 16:40:08.913377
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4f1d2c6b90'
+down_revision = '5d0c81a3f2e7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('monitor', sa.Column('active', sa.Boolean(), server_default='true', nullable=False))
+    op.drop_index('ix_monitor_next_check_at', table_name='monitor')
+    op.create_index(
+        'ix_monitor_active_next_check_at', 'monitor', ['next_check_at'], unique=False,
+        postgresql_where=sa.text('active'),
+    )
+
+
+def downgrade():
+    op.drop_index('ix_monitor_active_next_check_at', table_name='monitor')
+    op.create_index('ix_monitor_next_check_at', 'monitor', ['next_check_at'], unique=False)
+    op.drop_column('monitor', 'active')
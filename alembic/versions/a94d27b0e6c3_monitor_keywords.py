@@ -0,0 +1,28 @@
+"""Monitor keywords
+
+Revision ID: a94d27b0e6c3
+Revises: f3a6c8e1d205
+Create Date: 2026-10-18 23:02:48.915337
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a94d27b0e6c3'
+down_revision = 'f3a6c8e1d205'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('monitor', sa.Column('keywords', sa.JSON(), nullable=True))
+    op.add_column('monitor', sa.Column('keyword_regexes', sa.JSON(), nullable=True))
+    op.add_column('monitor', sa.Column('keyword_match', sa.String(), server_default='any', nullable=False))
+
+
+def downgrade():
+    op.drop_column('monitor', 'keyword_match')
+    op.drop_column('monitor', 'keyword_regexes')
+    op.drop_column('monitor', 'keywords')
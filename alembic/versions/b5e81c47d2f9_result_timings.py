@@ -0,0 +1,24 @@
+"""Result timings
+
+Revision ID: b5e81c47d2f9
+Revises: a94d27b0e6c3
+Create Date: 2026-10-19 00:14:06.327751
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5e81c47d2f9'
+down_revision = 'a94d27b0e6c3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('result', sa.Column('timings', sa.JSON(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('result', 'timings')
@@ -0,0 +1,24 @@
+"""Monitor critical
+
+Revision ID: c71e5a9d03b4
+Revises: 8a4f1d2c6b90
+Create Date: 2026-10-18 18:05:52.401726
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c71e5a9d03b4'
+down_revision = '8a4f1d2c6b90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('monitor', sa.Column('critical', sa.Boolean(), server_default='false', nullable=False))
+
+
+def downgrade():
+    op.drop_column('monitor', 'critical')
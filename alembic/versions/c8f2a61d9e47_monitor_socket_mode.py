@@ -0,0 +1,24 @@
+"""Monitor socket mode
+
+Revision ID: c8f2a61d9e47
+Revises: b5e81c47d2f9
+Create Date: 2026-10-19 09:41:52.118406
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c8f2a61d9e47'
+down_revision = 'b5e81c47d2f9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('monitor', sa.Column('socket_mode', sa.String(length=8), nullable=True))
+
+
+def downgrade():
+    op.drop_column('monitor', 'socket_mode')
@@ -0,0 +1,31 @@
+"""Ping response time in seconds
+
+Revision ID: d4e7a9b21c63
+Revises: c8f2a61d9e47
+Create Date: 2026-10-19 11:02:37.604219
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4e7a9b21c63'
+down_revision = 'c8f2a61d9e47'
+branch_labels = None
+depends_on = None
+
+
+# ping results stored in milliseconds, before the timings were recorded along with every result
+PING_RESULTS_IN_MILLISECONDS = """
+    timings IS NULL
+    AND response_time IS NOT NULL
+    AND monitor_id IN (SELECT id FROM monitor WHERE monitor_type = 'ping')
+"""
+
+
+def upgrade():
+    op.execute(f"UPDATE result SET response_time = response_time / 1000 WHERE {PING_RESULTS_IN_MILLISECONDS}")
+
+
+def downgrade():
+    op.execute(f"UPDATE result SET response_time = response_time * 1000 WHERE {PING_RESULTS_IN_MILLISECONDS}")
@@ -0,0 +1,30 @@
+"""Result check timeline
+
+Revision ID: e2b94f7a1c58
+Revises: c71e5a9d03b4
+Create Date: 2026-10-18 19:22:14.538610
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2b94f7a1c58'
+down_revision = 'c71e5a9d03b4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('result', sa.Column('due_at', sa.DateTime(), nullable=True))
+    op.add_column('result', sa.Column('enqueued_at', sa.DateTime(), nullable=True))
+    op.add_column('result', sa.Column('finished_at', sa.DateTime(), nullable=True))
+    op.create_index('ix_result_monitor_id_created_at', 'result', ['monitor_id', 'created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_result_monitor_id_created_at', table_name='result')
+    op.drop_column('result', 'finished_at')
+    op.drop_column('result', 'enqueued_at')
+    op.drop_column('result', 'due_at')
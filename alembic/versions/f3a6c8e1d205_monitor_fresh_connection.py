@@ -0,0 +1,24 @@
+"""Monitor fresh connection
+
+Revision ID: f3a6c8e1d205
+Revises: e2b94f7a1c58
+Create Date: 2026-10-18 21:10:37.162904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3a6c8e1d205'
+down_revision = 'e2b94f7a1c58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('monitor', sa.Column('fresh_connection', sa.Boolean(), server_default='false', nullable=False))
+
+
+def downgrade():
+    op.drop_column('monitor', 'fresh_connection')
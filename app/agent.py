@@ -0,0 +1,205 @@
+"""
+Standalone probe agent: scheduler and prober in a single asyncio process, for locations where running
+Redis, celery beat and the workers just to execute the checks is not worth it. It keeps the monitors
+of its shard in memory, probes them with the asyncio engine and writes the results and the incident
+transitions to the database in batches. Runs in place of celery beat and the probe workers.
+
+    python -m app.agent [shard] [num_shards]
+"""
+import asyncio
+import heapq
+import sys
+import time
+from collections import defaultdict
+from dataclasses import replace
+from datetime import datetime
+
+from app import crud
+from app.core import config
+from app.db.session import SessionLocal
+from app.services.async_monitoring import ProbeEngine, hold_probe_host
+from app.services.coalescing import get_request_fingerprint, group_by_request
+from app.services.incident import send_incident_alerts
+from app.services.outcome import MonitorOutcome, record_outcomes
+from app.services.scheduler import DueMonitor, get_next_check_at
+
+
+class Agent:
+    """
+    In memory scheduler: a heap of (next check timestamp, monitor id). Entries are never removed from the heap,
+    the ones not matching the current next check of their monitor (rescheduled or deleted) are skipped when popped.
+    """
+
+    def __init__(self, shard: int = 0, num_shards: int = 1):
+        self.shard = shard
+        self.num_shards = num_shards
+        self.monitors: dict[int, DueMonitor] = {}
+        self.next_checks: dict[int, float] = {}
+        self._heap: list[tuple[float, int]] = []
+        self._in_flight: set[int] = set()
+        self._outcomes: list[MonitorOutcome] = []
+        # request fingerprint of every monitor and monitor ids by fingerprint, see _pull_forward
+        self._fingerprints: dict[int, str] = {}
+        self._requests: dict[str, set[int]] = defaultdict(set)
+
+    def schedule(self, monitor_id: int, at: float):
+        self.next_checks[monitor_id] = at
+        heapq.heappush(self._heap, (at, monitor_id))
+
+    def load(self, now: datetime):
+        """ Sync the monitors with the monitor table, new ones get checked at their next phase slot """
+        monitors = {}
+        db = SessionLocal()
+        after_id = 0
+        while True:
+            page = crud.monitor.get_multi_by_shard(
+                db, shard=self.shard, num_shards=self.num_shards, after_id=after_id, limit=config.SCHEDULE_TASK_PAGE_SIZE
+            )
+            monitors.update({row.id: DueMonitor.from_row(row) for row in page})
+            if len(page) < config.SCHEDULE_TASK_PAGE_SIZE:
+                break
+            after_id = page[-1].id
+        db.close()
+
+        for monitor_id, due_monitor in monitors.items():
+            previous = self.monitors.get(monitor_id)
+            if previous is None or previous.periodicity != due_monitor.periodicity:
+                self.schedule(monitor_id, get_next_check_at(due_monitor, now).timestamp())
+        for monitor_id in self.monitors.keys() - monitors.keys():
+            del self.next_checks[monitor_id]
+        self.monitors = monitors
+
+        self._fingerprints = {
+            monitor_id: get_request_fingerprint(due_monitor.probe_spec) for monitor_id, due_monitor in monitors.items()
+        }
+        self._requests = defaultdict(set)
+        for monitor_id, fingerprint in self._fingerprints.items():
+            self._requests[fingerprint].add(monitor_id)
+        print(f"* Loaded {len(monitors)} monitors")
+
+    def pop_due(self, now: datetime) -> list[DueMonitor]:
+        """
+        Monitors due at `now`, rescheduled at their next phase slot. As in the other schedulers,
+        checks missed for more than SCHEDULER_MISSED_CHECK_GRACE_SECONDS are only rescheduled,
+        and so are the ones whose previous check is still running.
+        """
+        timestamp = now.timestamp()
+        missed_before = timestamp - config.SCHEDULER_MISSED_CHECK_GRACE_SECONDS
+        due_monitors = []
+        while self._heap and self._heap[0][0] <= timestamp:
+            at, monitor_id = heapq.heappop(self._heap)
+            if self.next_checks.get(monitor_id) != at:
+                continue
+
+            due_monitor = self.monitors[monitor_id]
+            self.schedule(monitor_id, get_next_check_at(due_monitor, now).timestamp())
+            if at >= missed_before and monitor_id not in self._in_flight:
+                due_monitors.append(replace(due_monitor, due_at=at))
+        return due_monitors + self._pull_forward(due_monitors, timestamp)
+
+    def _pull_forward(self, due_monitors: list[DueMonitor], timestamp: float) -> list[DueMonitor]:
+        """
+        Monitors making the same request as the due ones and due within PROBE_COALESCE_WINDOW_SECONDS,
+        checked now to share their probe, then rescheduled at their following phase slot
+        """
+        due_monitor_ids = {due_monitor.id for due_monitor in due_monitors}
+        pulled_monitors = []
+        for due_monitor in due_monitors:
+            for monitor_id in self._requests.get(self._fingerprints.get(due_monitor.id), ()):
+                at = self.next_checks.get(monitor_id)
+                if (
+                    monitor_id in due_monitor_ids
+                    or monitor_id in self._in_flight
+                    or at is None
+                    or at > timestamp + config.PROBE_COALESCE_WINDOW_SECONDS
+                ):
+                    continue
+
+                due_monitor_ids.add(monitor_id)
+                pulled_monitor = self.monitors[monitor_id]
+                self.schedule(monitor_id, get_next_check_at(pulled_monitor, datetime.fromtimestamp(at)).timestamp())
+                pulled_monitors.append(replace(pulled_monitor, due_at=at))
+        return pulled_monitors
+
+    def seconds_to_next_check(self, now: datetime) -> float:
+        if not self._heap:
+            return config.AGENT_FLUSH_SECONDS
+        return max(self._heap[0][0] - now.timestamp(), 0)
+
+    async def check(self, probe_engine: ProbeEngine, due_monitors: list[DueMonitor]):
+        """ Probe monitors making the same request (see app.services.coalescing) once """
+        monitor_ids = [due_monitor.id for due_monitor in due_monitors]
+        self._in_flight.update(monitor_ids)
+        probe_specs = [due_monitor.probe_spec for due_monitor in due_monitors]
+        try:
+            # timed once the host slot is held
+            async with hold_probe_host(probe_specs[0]):
+                monitored_at = datetime.now()
+                start = time.monotonic()
+                monit_responses = await probe_engine.probe_group(probe_specs)
+                probe_seconds = time.monotonic() - start
+        except Exception as exception:
+            print(f"* Error monitoring monitor_ids={monitor_ids}: {exception!r}")
+            return
+        finally:
+            self._in_flight.difference_update(monitor_ids)
+
+        for due_monitor, monit_response in zip(due_monitors, monit_responses):
+            self._outcomes.append(MonitorOutcome(
+                due_monitor.probe_spec,
+                monitored_at,
+                monit_response,
+                probe_seconds,
+                datetime.fromtimestamp(due_monitor.due_at),
+            ))
+
+    async def flush(self):
+        outcomes, self._outcomes = self._outcomes, []
+        if outcomes:
+            await asyncio.to_thread(_record, outcomes)
+
+    async def run(self):
+        async with ProbeEngine(concurrency=config.AGENT_CONCURRENCY) as probe_engine:
+            checks = set()
+            loaded_at = flushed_at = 0
+            try:
+                while True:
+                    if time.monotonic() - loaded_at >= config.SCHEDULER_RELOAD_SECONDS:
+                        await asyncio.to_thread(self.load, datetime.now())
+                        loaded_at = time.monotonic()
+
+                    due_monitors = {due_monitor.id: due_monitor for due_monitor in self.pop_due(datetime.now())}
+                    for group in group_by_request([due_monitor.probe_spec for due_monitor in due_monitors.values()]):
+                        check = asyncio.create_task(
+                            self.check(probe_engine, [due_monitors[probe_spec.id] for probe_spec in group])
+                        )
+                        checks.add(check)
+                        check.add_done_callback(checks.discard)
+
+                    if (
+                        time.monotonic() - flushed_at >= config.AGENT_FLUSH_SECONDS
+                        or len(self._outcomes) >= config.AGENT_FLUSH_SIZE
+                    ):
+                        await self.flush()
+                        flushed_at = time.monotonic()
+
+                    await asyncio.sleep(min(self.seconds_to_next_check(datetime.now()), config.AGENT_FLUSH_SECONDS))
+            finally:
+                # keep the results of the checks already done when stopped
+                await self.flush()
+
+
+def _record(outcomes: list[MonitorOutcome]):
+    db = SessionLocal()
+    for db_incident in record_outcomes(db, outcomes):
+        send_incident_alerts(db, db_incident)
+    db.close()
+    print(f"* Recorded {len(outcomes)} results")
+
+
+def main(shard: int = 0, num_shards: int = 1):
+    asyncio.run(Agent(shard, num_shards).run())
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -10,8 +10,86 @@ ALGORITHM = "HS256"
 
 # tasks
 USER_AGENT = os.environ.get('USER_AGENT', 'Monitstatus')
-CELERY_BROKER = 'redis://redis:6379/0'
-SCHEDULE_TASK_PERIODICITY_SECONDS = 1.0
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://redis:6379/0')
+CELERY_BROKER = REDIS_URL
+SCHEDULE_TASK_PERIODICITY_SECONDS = float(os.environ.get('SCHEDULE_TASK_PERIODICITY_SECONDS', 1.0))
+SCHEDULE_TASK_PAGE_SIZE = int(os.environ.get('SCHEDULE_TASK_PAGE_SIZE', 1000))
+# scheduler backend: 'database' (next_check_at column) or 'redis' (sharded sorted sets)
+SCHEDULER_BACKEND = os.environ.get('SCHEDULER_BACKEND', 'database')
+SCHEDULER_SHARDS = int(os.environ.get('SCHEDULER_SHARDS', 1))
+SCHEDULER_RELOAD_SECONDS = int(os.environ.get('SCHEDULER_RELOAD_SECONDS', 300))
+SCHEDULER_MISSED_CHECK_GRACE_SECONDS = int(os.environ.get('SCHEDULER_MISSED_CHECK_GRACE_SECONDS', 10))
+# probes sent in a single monitor_batch_task and how many of them run at once in the worker
+MONITOR_BATCH_SIZE = int(os.environ.get('MONITOR_BATCH_SIZE', 10))
+MONITOR_BATCH_CONCURRENCY = int(os.environ.get('MONITOR_BATCH_CONCURRENCY', 10))
+# 'threads' runs the blocking probes of a batch in a thread pool, MONITOR_BATCH_CONCURRENCY at once, 'asyncio' runs
+# them as coroutines of one engine per worker process, with PROBE_ENGINE_CONCURRENCY probes in flight across
+# all the batches of the process (run with a threads pool, e.g. `celery worker --pool threads`, to overlap batches)
+PROBE_ENGINE = os.environ.get('PROBE_ENGINE', 'threads')
+PROBE_ENGINE_CONCURRENCY = int(os.environ.get('PROBE_ENGINE_CONCURRENCY', 200))
+# how long past its request timeout a probe of the asyncio engine is cancelled
+PROBE_CANCEL_GRACE_SECONDS = int(os.environ.get('PROBE_CANCEL_GRACE_SECONDS', 5))
+# politeness limits of the probes to a same address across all the workers, 0 for unlimited: probes in flight
+# and probes started per second. Probes over the limits wait up to HOST_LIMIT_MAX_DELAY_SECONDS, then run anyway
+HOST_MAX_CONCURRENT_PROBES = int(os.environ.get('HOST_MAX_CONCURRENT_PROBES', 0))
+HOST_MAX_PROBES_PER_SECOND = float(os.environ.get('HOST_MAX_PROBES_PER_SECOND', 0))
+HOST_LIMIT_MAX_DELAY_SECONDS = float(os.environ.get('HOST_LIMIT_MAX_DELAY_SECONDS', 5))
+HOST_LIMIT_POLL_SECONDS = float(os.environ.get('HOST_LIMIT_POLL_SECONDS', 0.05))
+# checks of monitors making the same request share a single probe when dispatched together,
+# the agent also checks early the ones due within PROBE_COALESCE_WINDOW_SECONDS
+PROBE_COALESCE_WINDOW_SECONDS = float(os.environ.get('PROBE_COALESCE_WINDOW_SECONDS', 5))
+# keep-alive connections of the http probes, pooled per host in every worker
+HTTP_POOL_MAX_HOSTS = int(os.environ.get('HTTP_POOL_MAX_HOSTS', 500))
+HTTP_POOL_CONNECTIONS_PER_HOST = int(os.environ.get('HTTP_POOL_CONNECTIONS_PER_HOST', 4))
+HTTP_POOL_IDLE_SECONDS = int(os.environ.get('HTTP_POOL_IDLE_SECONDS', 60))
+# http response bodies are streamed in chunks of HTTP_CHUNK_BYTES, keyword checks read at most HTTP_MAX_BODY_BYTES
+# and stop as soon as the keyword is found. Availability checks only read bodies shorter than HTTP_DRAIN_MAX_BYTES,
+# to keep the connection alive, and close the connection of the longer ones right after the headers.
+HTTP_CHUNK_BYTES = int(os.environ.get('HTTP_CHUNK_BYTES', 16 * 1024))
+HTTP_MAX_BODY_BYTES = int(os.environ.get('HTTP_MAX_BODY_BYTES', 1024 * 1024))
+HTTP_DRAIN_MAX_BYTES = int(os.environ.get('HTTP_DRAIN_MAX_BYTES', 16 * 1024))
+# characters of a streamed body kept between chunks to find the keyword regex matches spanning two chunks
+KEYWORD_REGEX_WINDOW = int(os.environ.get('KEYWORD_REGEX_WINDOW', 1024))
+# keyword regexes run in the shared workers: longer ones, and the ones that can backtrack exponentially, are refused
+KEYWORD_REGEX_MAX_LENGTH = int(os.environ.get('KEYWORD_REGEX_MAX_LENGTH', 256))
+# dns resolutions cached in every worker: record TTLs are clamped between the min and max TTL,
+# failed lookups are cached for the negative TTL
+DNS_CACHE_MIN_TTL_SECONDS = int(os.environ.get('DNS_CACHE_MIN_TTL_SECONDS', 10))
+DNS_CACHE_MAX_TTL_SECONDS = int(os.environ.get('DNS_CACHE_MAX_TTL_SECONDS', 3600))
+DNS_CACHE_NEGATIVE_TTL_SECONDS = int(os.environ.get('DNS_CACHE_NEGATIVE_TTL_SECONDS', 30))
+DNS_CACHE_MAX_ENTRIES = int(os.environ.get('DNS_CACHE_MAX_ENTRIES', 10000))
+DNS_TIMEOUT_SECONDS = float(os.environ.get('DNS_TIMEOUT_SECONDS', 5))
+# expiry dates of the TLS certificates seen by the probes, cached in every worker
+CERTIFICATE_CACHE_SECONDS = int(os.environ.get('CERTIFICATE_CACHE_SECONDS', 6 * 3600))
+CERTIFICATE_CACHE_MAX_ENTRIES = int(os.environ.get('CERTIFICATE_CACHE_MAX_ENTRIES', 10000))
+# ping probes: echo requests of a ping are PING_INTERVAL_SECONDS apart, every one carrying PING_PAYLOAD_BYTES of data
+PING_INTERVAL_SECONDS = float(os.environ.get('PING_INTERVAL_SECONDS', 0.2))
+PING_PAYLOAD_BYTES = int(os.environ.get('PING_PAYLOAD_BYTES', 56))
+# tcp / udp probes read their responses in chunks of SOCKET_CHUNK_BYTES, up to SOCKET_MAX_RESPONSE_BYTES
+SOCKET_CHUNK_BYTES = int(os.environ.get('SOCKET_CHUNK_BYTES', 4096))
+SOCKET_MAX_RESPONSE_BYTES = int(os.environ.get('SOCKET_MAX_RESPONSE_BYTES', 64 * 1024))
+# standalone agent (python -m app.agent): probes running at once, and how often (or after how many results)
+# the results are written to the database
+AGENT_CONCURRENCY = int(os.environ.get('AGENT_CONCURRENCY', 200))
+AGENT_FLUSH_SECONDS = int(os.environ.get('AGENT_FLUSH_SECONDS', 5))
+AGENT_FLUSH_SIZE = int(os.environ.get('AGENT_FLUSH_SIZE', 500))
+# probe lanes, every one with its own queue and worker pool: critical monitors go to the priority lane,
+# the ones whose recent probes took more than SLOW_LANE_THRESHOLD_SECONDS to the slow one
+PROBE_QUEUES = {
+    'fast': 'probes_fast',
+    'slow': 'probes_slow',
+    'priority': 'probes_priority',
+}
+SLOW_LANE_THRESHOLD_SECONDS = float(os.environ.get('SLOW_LANE_THRESHOLD_SECONDS', 5))
+# backpressure: past any of these limits on the probe queues the scheduler is degraded
+SCHEDULER_MAX_QUEUE_DEPTH = int(os.environ.get('SCHEDULER_MAX_QUEUE_DEPTH', 10000))
+SCHEDULER_MAX_CONSUMER_LAG_SECONDS = int(os.environ.get('SCHEDULER_MAX_CONSUMER_LAG_SECONDS', 30))
+SCHEDULER_QUEUED_MARK_SECONDS = int(os.environ.get('SCHEDULER_QUEUED_MARK_SECONDS', 300))
+# fair share: checks per minute a team (or a user without team) can dispatch, 0 for unlimited
+TENANT_CHECKS_PER_MINUTE = int(os.environ.get('TENANT_CHECKS_PER_MINUTE', 0))
+# in-flight lease of a monitor: request timeout (or the default one) plus a grace period
+MONITOR_LEASE_DEFAULT_TIMEOUT_SECONDS = 30
+MONITOR_LEASE_GRACE_SECONDS = int(os.environ.get('MONITOR_LEASE_GRACE_SECONDS', 15))
 WORKER_ID = os.environ.get('WORKER_ID', 'Development - 127.0.0.1')
 
 # db
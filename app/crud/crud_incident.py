@@ -61,6 +61,17 @@ class CRUDIncident(CRUDBase[Incident, IncidentCreate, IncidentUpdate]):
             .first()
         )
 
+    def get_last_open_by_monitors(self, db: Session, *, monitor_ids: list[int]) -> dict[int, Incident]:
+        """ Last open incident of every given monitor having one, by monitor id """
+        open_incidents = (
+            db.query(self.model)
+            .filter(Incident.monitor_id.in_(monitor_ids))
+            .filter(Incident.ended_at == None)
+            .order_by(Incident.started_at)
+            .all()
+        )
+        return {incident.monitor_id: incident for incident in open_incidents}
+
     def get_multi_by_monitor_list_and_date(
         self, db: Session, *, monitor_ids: list[int], since: datetime,
     ) -> list[Incident]:
@@ -1,12 +1,73 @@
+import json
+from datetime import datetime
+from typing import Any, Dict
+
 from fastapi.encoders import jsonable_encoder
+from sqlalchemy import Row, func, select, update
 from sqlalchemy.orm import Session
 
 from app.crud.base import CRUDBase
 from app.models.monitor import Monitor
+from app.models.user import User
 from app.schemas.monitor import MonitorCreate, MonitorUpdate
 
 
+# columns needed by the scheduler to decide which monitors to dispatch and to build their probe spec.
+# Monitors with a non positive periodicity (created before it was validated) are never scheduled.
+SCHEDULING_COLUMNS = (
+    Monitor.id,
+    Monitor.periodicity,
+    Monitor.request_timeout,
+    Monitor.next_check_at,
+    Monitor.owner_id,
+    User.team_id,
+    Monitor.critical,
+    Monitor.monitor_type,
+    Monitor.endpoint,
+    Monitor.alert_type,
+    Monitor.keyword,
+    Monitor.keywords,
+    Monitor.keyword_regexes,
+    Monitor.keyword_match,
+    Monitor.http_method,
+    Monitor.request_body,
+    Monitor.request_headers,
+    Monitor.follow_redirects,
+    Monitor.keep_cookies_between_redirects,
+    Monitor.verify_ssl,
+    Monitor.fresh_connection,
+    Monitor.ssl_check_expiration,
+    Monitor.auth_user,
+    Monitor.auth_pass,
+    Monitor.num_pings,
+    Monitor.port,
+    Monitor.data,
+    Monitor.socket_mode,
+)
+
+# postgres channel notified on every monitor insert, update or delete (see app.monitor_listener)
+MONITOR_CHANGES_CHANNEL = 'monitor_changes'
+
+
 class CRUDMonitor(CRUDBase[Monitor, MonitorCreate, MonitorUpdate]):
+    def _notify_changes(self, db: Session, monitor_ids: list[int], action: str):
+        # LISTEN/NOTIFY only exists on postgres, other databases (tests) have nobody listening
+        if db.get_bind().dialect.name != 'postgresql':
+            return
+
+        # chunked to keep every payload under the 8000 bytes limit of NOTIFY
+        for i in range(0, len(monitor_ids), 500):
+            db.execute(select(func.pg_notify(
+                MONITOR_CHANGES_CHANNEL,
+                json.dumps({'ids': monitor_ids[i:i + 500], 'action': action}),
+            )))
+        db.commit()
+
+    def create(self, db: Session, *, obj_in: MonitorCreate) -> Monitor:
+        db_obj = super().create(db, obj_in=obj_in)
+        self._notify_changes(db, [db_obj.id], 'insert')
+        return db_obj
+
     def create_with_owner(
         self, db: Session, *, obj_in: MonitorCreate, owner_id: int
     ) -> Monitor:
@@ -15,6 +76,19 @@ class CRUDMonitor(CRUDBase[Monitor, MonitorCreate, MonitorUpdate]):
         db.add(db_obj)
         db.commit()
         db.refresh(db_obj)
+        self._notify_changes(db, [db_obj.id], 'insert')
+        return db_obj
+
+    def update(
+        self, db: Session, *, db_obj: Monitor, obj_in: MonitorUpdate | Dict[str, Any]
+    ) -> Monitor:
+        db_obj = super().update(db, db_obj=db_obj, obj_in=obj_in)
+        self._notify_changes(db, [db_obj.id], 'update')
+        return db_obj
+
+    def remove(self, db: Session, *, id: int) -> Monitor:
+        db_obj = super().remove(db, id=id)
+        self._notify_changes(db, [id], 'delete')
         return db_obj
 
     def get_multi_by_owner(
@@ -41,5 +115,109 @@ class CRUDMonitor(CRUDBase[Monitor, MonitorCreate, MonitorUpdate]):
                 .all()
         )
 
+    def set_active(
+        self,
+        db: Session,
+        *,
+        active: bool,
+        owner_id: int | None = None,
+        team_id: int | None = None,
+        monitor_ids: list[int] | None = None,
+    ) -> list[int]:
+        """
+        Pause or resume, in a single UPDATE, the monitors of a team (or of an owner without team),
+        optionally restricted to the given ids. Returns the ids of the updated monitors.
+        """
+        statement = update(Monitor).where(Monitor.active != active)
+        if team_id:
+            statement = statement.where(Monitor.owner_id.in_(select(User.id).where(User.team_id == team_id)))
+        else:
+            statement = statement.where(Monitor.owner_id == owner_id)
+        if monitor_ids is not None:
+            statement = statement.where(Monitor.id.in_(monitor_ids))
+
+        updated_ids = list(db.scalars(
+            statement.values(active=active).returning(Monitor.id).execution_options(synchronize_session=False)
+        ))
+        db.commit()
+        self._notify_changes(db, updated_ids, 'resume' if active else 'update')
+        return updated_ids
+
+    def get_ids_by_owner_or_team(
+        self, db: Session, *, owner_id: int, team_id: int | None = None
+    ) -> list[int]:
+        query = db.query(Monitor.id)
+        if team_id:
+            query = query.filter(Monitor.owner.has(team_id=team_id))
+        else:
+            query = query.filter(Monitor.owner_id == owner_id)
+        return [row.id for row in query]
+
+    def get_existing_ids(self, db: Session, *, monitor_ids: list[int]) -> set[int]:
+        return {row.id for row in db.query(Monitor.id).filter(Monitor.id.in_(monitor_ids))}
+
+    def get_auth_passes(self, db: Session, *, monitor_ids: list[int]) -> dict[int, str | None]:
+        rows = db.query(Monitor.id, Monitor.auth_pass).filter(Monitor.id.in_(monitor_ids))
+        return {row.id: row.auth_pass for row in rows}
+
+    def get_scheduling_data(self, db: Session, monitor_id: int) -> Row | None:
+        return (
+            db.query(*SCHEDULING_COLUMNS)
+                .outerjoin(User, Monitor.owner_id == User.id)
+                .filter(Monitor.id == monitor_id)
+                .filter(Monitor.active == True)
+                .filter(Monitor.periodicity > 0)
+                .first()
+        )
+
+    def get_multi_due(
+        self, db: Session, *, now: datetime, after_id: int = 0, limit: int = 1000
+    ) -> list[Row]:
+        """
+        Return the scheduling data (SCHEDULING_COLUMNS) of the monitors whose next check is due at `now`.
+        Paginated by keyset over the monitor id, so the caller can walk the whole table
+        passing the last id seen as `after_id`.
+        """
+        return (
+            db.query(*SCHEDULING_COLUMNS)
+                .outerjoin(User, Monitor.owner_id == User.id)
+                .filter(Monitor.active == True)
+                .filter(Monitor.periodicity > 0)
+                .filter(Monitor.next_check_at <= now)
+                .filter(Monitor.id > after_id)
+                .order_by(Monitor.id)
+                .limit(limit)
+                .all()
+        )
+
+    def get_multi_by_shard(
+        self, db: Session, *, shard: int, num_shards: int, after_id: int = 0, limit: int = 1000
+    ) -> list[Row]:
+        """ Return the scheduling data of the monitors of a scheduler shard """
+        return (
+            db.query(*SCHEDULING_COLUMNS)
+                .outerjoin(User, Monitor.owner_id == User.id)
+                .filter(Monitor.active == True)
+                .filter(Monitor.periodicity > 0)
+                .filter(Monitor.id % num_shards == shard)
+                .filter(Monitor.id > after_id)
+                .order_by(Monitor.id)
+                .limit(limit)
+                .all()
+        )
+
+    def update_next_checks(
+        self, db: Session, *, next_checks: dict[int, datetime]
+    ) -> None:
+        """ Bulk update of next_check_at given a monitor id -> next check mapping """
+        if not next_checks:
+            return
+
+        db.execute(
+            update(Monitor),
+            [{'id': monitor_id, 'next_check_at': next_check_at} for monitor_id, next_check_at in next_checks.items()],
+        )
+        db.commit()
+
 
 monitor = CRUDMonitor(Monitor)
@@ -1,9 +1,10 @@
 from datetime import datetime
 
+from sqlalchemy import Row, func, select
 from sqlalchemy.orm import Session
 
 from app.crud.base import CRUDBase
-from app.models.monitor import Result
+from app.models.monitor import Monitor, Result
 from app.schemas.result import ResultCreate, ResultUpdate
 
 
@@ -33,4 +34,22 @@ class CRUDResult(CRUDBase[Result, ResultCreate, ResultUpdate]):
     def get_last_by_monitor(self, db: Session, monitor_id: id) -> Result | None:
         return db.query(Result).filter(Result.monitor_id == monitor_id).order_by(Result.created_at.desc()).first()
 
+    def get_last_checks(self, db: Session, *, monitor_ids: list[int] | None = None) -> list[Row]:
+        """ (id, name, periodicity, last_checked_at) of every active monitor, or of the given ones """
+        # correlated per monitor, a single seek on ix_result_monitor_id_created_at for the monitors selected only
+        last_checked_at = (
+            select(func.max(Result.created_at))
+            .where(Result.monitor_id == Monitor.id)
+            .correlate(Monitor)
+            .scalar_subquery()
+            .label('last_checked_at')
+        )
+        query = (
+            db.query(Monitor.id, Monitor.name, Monitor.periodicity, Monitor.created_at, last_checked_at)
+            .filter(Monitor.active == True)
+        )
+        if monitor_ids is not None:
+            query = query.filter(Monitor.id.in_(monitor_ids))
+        return query.order_by(Monitor.id).all()
+
 result = CRUDResult(Result)
@@ -0,0 +1,35 @@
+"""
+Prints the monitors of the whole fleet whose checks silently stopped (unchecked for more than
+twice their periodicity) and the fleet-wide scheduling drift histogram of the last hours.
+
+    python -m app.freshness_report [hours]
+"""
+import sys
+from datetime import datetime, timedelta
+
+from app.db.session import SessionLocal
+from app.services.freshness import find_gaps, get_fleet_drift_histogram
+
+
+def main(hours: int = 1):
+    now = datetime.now()
+    db = SessionLocal()
+    gaps = find_gaps(db, now)
+    db.close()
+
+    print(f"* {len(gaps)} monitors with gaps")
+    for gap in gaps:
+        print(
+            f"  monitor_id={gap.monitor_id} name={gap.name!r} periodicity={gap.periodicity}s "
+            f"last_checked_at={gap.last_checked_at} unchecked for {gap.gap_seconds:.0f}s"
+        )
+
+    for hour in range(hours):
+        hour_start = now - timedelta(hours=hour)
+        print(f"* Scheduling drift {hour_start:%Y-%m-%d %H}h")
+        for bucket, count in get_fleet_drift_histogram(hour_start).items():
+            print(f"  {bucket:>8} {count}")
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
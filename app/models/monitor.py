@@ -1,4 +1,6 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, JSON
+from datetime import datetime
+
+from sqlalchemy import Boolean, Column, ForeignKey, Index, Integer, String, JSON, text
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from sqlalchemy.sql.sqltypes import DateTime, Float
@@ -8,6 +10,16 @@ from app.db.base_class import Base
 
 
 class Monitor(Base):
+    # the scheduler only looks for due monitors among the active ones
+    __table_args__ = (
+        Index(
+            'ix_monitor_active_next_check_at',
+            'next_check_at',
+            postgresql_where=text('active'),
+            sqlite_where=text('active'),
+        ),
+    )
+
     id = Column(Integer, primary_key=True, index=True)
     created_at = Column(DateTime, default=func.now())
     name = Column(String, nullable=False)
@@ -15,8 +27,17 @@ class Monitor(Base):
     endpoint = Column(String, nullable=False)
     alert_type = Column(String, nullable=False) # TODO maybe enum
     keyword = Column(String)
+    # more keywords and regular expressions, `keyword_match` tells whether any or all of them should match
+    keywords = Column(JSON, default=None)
+    keyword_regexes = Column(JSON, default=None)
+    keyword_match = Column(String, nullable=False, default='any', server_default='any')
     periodicity = Column(Integer, nullable=False, default=120)
     request_timeout = Column(Integer, nullable=False, default=30)
+    active = Column(Boolean, nullable=False, default=True, server_default='true')
+    # critical monitors are probed on their own priority lane
+    critical = Column(Boolean, nullable=False, default=False, server_default='false')
+    # set from python, the scheduler compares it against the clock of the workers
+    next_check_at = Column(DateTime, nullable=False, default=datetime.now)
 
     # http requests options
     http_method = Column(String(8), default='GET')
@@ -25,6 +46,9 @@ class Monitor(Base):
     follow_redirects = Column(Boolean, default=True)
     keep_cookies_between_redirects = Column(Boolean, default=True)
     verify_ssl = Column(Boolean, default=True)
+    # open a new connection on every check instead of reusing the pooled ones, so that the
+    # response time includes the TCP and TLS handshakes
+    fresh_connection = Column(Boolean, nullable=False, default=False, server_default='false')
     ssl_check_expiration = Column(Integer, default=0)
     auth_user = Column(String, default=None)
     auth_pass = Column(String, default=None)
@@ -35,6 +59,8 @@ class Monitor(Base):
     # tcp / udp options
     port = Column(Integer)
     data = Column(String)
+    # connect, expect or request (see SocketModeEnum), derived from the rest of the options when not set
+    socket_mode = Column(String(8), default=None)
 
     # alert config
     recovery_period = Column(Integer, default=0)
@@ -74,6 +100,10 @@ class Monitor(Base):
 
 
 class Result(Base):
+    __table_args__ = (
+        Index('ix_result_monitor_id_created_at', 'monitor_id', 'created_at'),
+    )
+
     id = Column(Integer, primary_key=True, index=True)
     created_at = Column(DateTime, nullable=False)
     monitored_at = Column(DateTime, nullable=True)
@@ -81,6 +111,13 @@ class Result(Base):
     status = Column(Boolean, nullable=True)
     monitor_id = Column(Integer, ForeignKey("monitor.id"))
 
+    # scheduling timeline of the check, monitored_at being the moment the probe started
+    due_at = Column(DateTime, nullable=True)
+    enqueued_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    # seconds spent on every phase of the probe, e.g. {"dns": 0.0012, "connect": 0.0153, "ttfb": 0.1021}
+    timings = Column(JSON, nullable=True)
+
     monitor = relationship("Monitor", back_populates="results")
 
 
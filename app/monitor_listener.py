@@ -0,0 +1,42 @@
+"""
+Listens to the monitor changes notified by the CRUD layer and applies them to the scheduler
+right away, so new and updated monitors get checked on the next scheduler tick.
+
+    python -m app.monitor_listener
+"""
+import json
+import select
+from datetime import datetime
+
+import psycopg2
+import psycopg2.extensions
+
+from app.core import config
+from app.crud.crud_monitor import MONITOR_CHANGES_CHANNEL
+from app.db.session import SessionLocal
+from app.services.scheduler import apply_monitor_change, get_scheduler
+
+
+def main():
+    connection = psycopg2.connect(config.SQLALCHEMY_DATABASE_URL)
+    connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    connection.cursor().execute(f"LISTEN {MONITOR_CHANGES_CHANNEL};")
+    print(f"* Listening to {MONITOR_CHANGES_CHANNEL}")
+
+    while True:
+        if select.select([connection], [], [], 5) == ([], [], []):
+            continue
+
+        connection.poll()
+        db = SessionLocal()
+        scheduler = get_scheduler(db)
+        while connection.notifies:
+            change = json.loads(connection.notifies.pop(0).payload)
+            print(f"* Monitor change {change}")
+            for monitor_id in change['ids']:
+                apply_monitor_change(db, scheduler, monitor_id, change['action'], datetime.now())
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,8 @@ from sqlalchemy.orm import Session
 from app import crud, models, schemas
 from app.api import deps
 import app.services.availability as availability_services
+import app.services.freshness as freshness_services
+from app.services.matching import get_regex_error
 
 
 router = APIRouter()
@@ -14,23 +16,63 @@ CurrentUser = Annotated[models.User, Depends(deps.get_current_user)]
 DBSession = Annotated[Session, Depends(deps.get_db)]
 
 
-@router.post("/monitors", response_model=schemas.Monitor, status_code=status.HTTP_201_CREATED)
-async def create_monitor(
-    monitor: schemas.MonitorCreate,
-    db: DBSession,
-    current_user: CurrentUser,
-):
-    # if the alert type is keyword, keyword should be specified
-    if monitor.alert_type != schemas.AlertTypeEnum.unavailable and monitor.keyword is None:
+def _validate_monitor(monitor: schemas.MonitorCreate | schemas.MonitorUpdate):
+    """ Checks across fields of a monitor being created, or of an updated monitor with its changes applied """
+    # if the alert type is keyword, keyword (or keywords, or regexes) should be specified
+    alert_type = schemas.AlertTypeEnum(monitor.alert_type or schemas.AlertTypeEnum.unavailable)
+    if (
+        alert_type != schemas.AlertTypeEnum.unavailable
+        and monitor.keyword is None and not monitor.keywords and not monitor.keyword_regexes
+    ):
         raise HTTPException(
             422,
             [{
                 'loc': ["body", 'keyword'],
-                'msg': f"should be defined on alert_type {monitor.alert_type.value}",
+                'msg': f"should be defined on alert_type {alert_type.value}",
                 'type': 'value_error.str.condition',
             }]
         )
 
+    for keyword_regex in monitor.keyword_regexes or []:
+        if error := get_regex_error(keyword_regex):
+            raise HTTPException(
+                422,
+                [{
+                    'loc': ["body", 'keyword_regexes'],
+                    'msg': f"invalid regular expression {keyword_regex!r}: {error}",
+                    'type': 'value_error.regex',
+                }]
+            )
+
+    monitor_type = schemas.MonitorTypeEnum(monitor.monitor_type or schemas.MonitorTypeEnum.http)
+    if monitor.socket_mode and (monitor.socket_mode == schemas.SocketModeEnum.request) != (
+        monitor_type == schemas.MonitorTypeEnum.udp
+    ):
+        raise HTTPException(
+            422,
+            [{
+                'loc': ["body", 'socket_mode'],
+                'msg': f"not available on monitor_type {monitor_type.value}",
+                'type': 'value_error.str.condition',
+            }]
+        )
+
+
+def _check_critical(current_user: models.User, critical: bool | None, current_critical: bool | None = False):
+    """ Only superusers move monitors in and out of the priority lane (see app.services.lanes) """
+    if bool(critical) != bool(current_critical) and not current_user.is_superuser:
+        raise HTTPException(status_code=403, detail="Only superusers can change critical")
+
+
+@router.post("/monitors", response_model=schemas.Monitor, status_code=status.HTTP_201_CREATED)
+async def create_monitor(
+    monitor: schemas.MonitorCreate,
+    db: DBSession,
+    current_user: CurrentUser,
+):
+    _validate_monitor(monitor)
+    _check_critical(current_user, monitor.critical)
+
     return crud.monitor.create_with_owner(db=db, obj_in=monitor, owner_id=current_user.id)
 
 
@@ -45,6 +87,58 @@ async def list_monitors(
     return crud.monitor.get_multi_by_owner(db, owner_id=current_user.id)
 
 
+@router.post("/monitors/pause", status_code=status.HTTP_200_OK)
+async def pause_monitors(
+    activation: schemas.MonitorBulkActivation,
+    db: DBSession,
+    current_user: CurrentUser,
+):
+    monitor_ids = crud.monitor.set_active(
+        db,
+        active=False,
+        owner_id=current_user.id,
+        team_id=current_user.team_id,
+        monitor_ids=activation.monitor_ids,
+    )
+    return {'monitor_ids': monitor_ids}
+
+
+@router.post("/monitors/resume", status_code=status.HTTP_200_OK)
+async def resume_monitors(
+    activation: schemas.MonitorBulkActivation,
+    db: DBSession,
+    current_user: CurrentUser,
+):
+    monitor_ids = crud.monitor.set_active(
+        db,
+        active=True,
+        owner_id=current_user.id,
+        team_id=current_user.team_id,
+        monitor_ids=activation.monitor_ids,
+    )
+    return {'monitor_ids': monitor_ids}
+
+
+@router.get("/monitors/gaps", response_model=list[schemas.MonitorGap], status_code=status.HTTP_200_OK)
+async def list_monitor_gaps(
+    db: DBSession,
+    current_user: CurrentUser,
+):
+    monitor_ids = crud.monitor.get_ids_by_owner_or_team(db, owner_id=current_user.id, team_id=current_user.team_id)
+    return freshness_services.find_gaps(db, datetime.now(), monitor_ids=monitor_ids)
+
+
+@router.get("/monitors/drift", status_code=status.HTTP_200_OK)
+async def get_fleet_drift(
+    current_user: CurrentUser,
+    hour: datetime | None = None,
+):
+    if not current_user.is_superuser:
+        raise HTTPException(status_code=403, detail="Unauthorized")
+
+    return freshness_services.get_fleet_drift_histogram(hour or datetime.now())
+
+
 @router.get("/monitors/{monitor_id}", response_model=schemas.Monitor, status_code=status.HTTP_200_OK)
 async def get_monitor(
     monitor_id: int,
@@ -75,6 +169,13 @@ async def update_monitor(
     if not current_user.has_access(db_monitor):
         raise HTTPException(status_code=403, detail="Unauthorized")
 
+    # partial update, the fields not sent keep their current value
+    _validate_monitor(schemas.MonitorUpdate.construct(**{
+        **{field: getattr(db_monitor, field) for field in schemas.MonitorUpdate.__fields__},
+        **monitor.dict(exclude_unset=True),
+    }))
+    if 'critical' in monitor.__fields_set__:
+        _check_critical(current_user, monitor.critical, db_monitor.critical)
     return crud.monitor.update(db, db_obj=db_monitor, obj_in=monitor)
 
 
@@ -133,3 +234,24 @@ async def get_monitor_status(
 
     results = crud.result.get_multi_by_monitor(db, monitor_id=monitor_id, since=start_date)
     return availability_services.calculate_status_intervals(results, start_date, timedelta(minutes=interval))
+
+
+@router.get("/monitors/{monitor_id}/drift", status_code=status.HTTP_200_OK)
+async def get_monitor_drift(
+    monitor_id: int,
+    db: DBSession,
+    current_user: CurrentUser,
+    since: datetime | None = None,
+):
+    if not since:
+        since = datetime.now() - timedelta(days=1)
+
+    db_monitor = crud.monitor.get(db, id=monitor_id)
+    if db_monitor is None:
+        raise HTTPException(status_code=404, detail="Monitor not found")
+
+    if not current_user.has_access(db_monitor):
+        raise HTTPException(status_code=403, detail="Unauthorized")
+
+    results = crud.result.get_multi_by_monitor(db, monitor_id=monitor_id, since=since)
+    return freshness_services.get_monitor_drift_histogram(results)
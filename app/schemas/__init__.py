@@ -1,7 +1,9 @@
 from .incident import IncidentCreate, IncidentUpdate, Incident
 from .incident_event import IncidentEventTypeEnum, IncidentEventCreate, IncidentEvent
 from .integration import IntegrationServicesEnum, IntegrationCreate, IntegrationUpdate, Integration, TelegramWebhook
-from .monitor import AlertTypeEnum, MonitorCreate, MonitorUpdate, Monitor
+from .monitor import (
+    AlertTypeEnum, MonitorTypeEnum, SocketModeEnum, MonitorBulkActivation, MonitorCreate, MonitorGap, MonitorUpdate, Monitor,
+)
 from .result import ResultCreate, ResultUpdate, Result
 from .schedule import ScheduleCreate, ScheduleUpdate, Schedule
 from .statuspage import StatusPageCreate, StatusPageUpdate, StatusPage
@@ -2,7 +2,7 @@ from datetime import datetime
 from enum import Enum
 from typing import Dict
 
-from pydantic import BaseModel
+from pydantic import BaseModel, conint
 
 
 class MonitorTypeEnum(str, Enum):
@@ -18,6 +18,20 @@ class AlertTypeEnum(str, Enum):
     does_not_contain_keyword = 'does_not_contain_keyword'
 
 
+class KeywordMatchEnum(str, Enum):
+    any = 'any'
+    all = 'all'
+
+
+class SocketModeEnum(str, Enum):
+    # tcp: succeeds on the handshake
+    connect = 'connect'
+    # tcp: sends the data, if any, and waits for a response
+    expect = 'expect'
+    # udp: sends the data and waits for a datagram
+    request = 'request'
+
+
 class HTTPMethodEnum(str, Enum):
     get = 'GET'
     post = 'POST'
@@ -30,8 +44,13 @@ class MonitorBase(BaseModel):
     endpoint: str | None
     alert_type: AlertTypeEnum | None = AlertTypeEnum.unavailable
     keyword: str | None = None
-    periodicity: int | None = 120
-    request_timeout: int | None = 30
+    keywords: list[str] | None = None
+    keyword_regexes: list[str] | None = None
+    keyword_match: KeywordMatchEnum | None = KeywordMatchEnum.any
+    periodicity: conint(gt=0) | None = 120
+    request_timeout: conint(gt=0) | None = 30
+    active: bool | None = True
+    critical: bool | None = False
 
     # http requests options
     http_method: HTTPMethodEnum | None = HTTPMethodEnum.get
@@ -40,6 +59,7 @@ class MonitorBase(BaseModel):
     follow_redirects: bool | None = True
     keep_cookies_between_redirects: bool | None = True
     verify_ssl: bool | None = True
+    fresh_connection: bool | None = False
     ssl_check_expiration: int | None = None
     auth_user: str | None = None
     auth_pass: str | None = None
@@ -50,6 +70,8 @@ class MonitorBase(BaseModel):
     # tcp / udp options
     port: int | None = None
     data: str | None = None
+    # derived from the monitor type, the data and the alert type when not set
+    socket_mode: SocketModeEnum | None = None
 
     # alert config
     recovery_period: int | None = 0
@@ -77,6 +99,22 @@ class MonitorUpdate(MonitorBase):
     pass
 
 
+class MonitorBulkActivation(BaseModel):
+    # all the monitors of the team (or of the user, without team) when not set
+    monitor_ids: list[int] | None = None
+
+
+class MonitorGap(BaseModel):
+    monitor_id: int
+    name: str
+    periodicity: int
+    last_checked_at: datetime | None
+    gap_seconds: float
+
+    class Config:
+        orm_mode = True
+
+
 class Monitor(MonitorBase):
     id: int
     up: bool | None = None
@@ -9,6 +9,7 @@ class ResultBase(BaseModel):
     response_time: float | None = None
     status: bool | None = False
     monitor_id: int
+    timings: dict[str, float] | None = None
 
 
 class ResultCreate(ResultBase):
@@ -0,0 +1,429 @@
+"""
+asyncio probe engine: the same checks as app.services.monitoring without blocking on network I/O,
+so a single worker process can have hundreds of probes in flight.
+"""
+import asyncio
+import os
+import threading
+import time
+import urllib.parse
+from contextlib import asynccontextmanager, contextmanager
+from typing import Awaitable, Callable
+
+import httpcore
+import httpx
+
+from app.core import config
+from app.models.monitor import Monitor
+from app.schemas.monitor import MonitorTypeEnum
+from app.services.cert_cache import certificate_cache
+from app.services.dns_cache import DNSResolutionError, dns_cache
+from app.services.host_limit import host_limiter
+from app.services.icmp import icmp_pinger
+from app.services.monitoring import (
+    GroupBodyScanner, MonitResponse, get_http_status, get_ping_response, get_probe_hostname, get_socket_responses,
+    get_ssl_checked_response, must_drain, submit_socket_probe,
+)
+
+
+async def resolve(hostname: str) -> tuple[list[str], float]:
+    """ Addresses of `hostname` from the DNS cache of the worker and the seconds spent resolving it """
+    start = time.monotonic()
+    addresses = await dns_cache.resolve_async(hostname)
+    return addresses, time.monotonic() - start
+
+
+async def get_probe_host(monitor: Monitor) -> str | None:
+    """ Address the monitor probes connect to, None when it cannot be resolved (the probe reports it) """
+    hostname = get_probe_hostname(monitor)
+    try:
+        return (await dns_cache.resolve_async(hostname))[0] if hostname else None
+    except DNSResolutionError:
+        return None
+
+
+@asynccontextmanager
+async def hold_probe_host(monitor: Monitor):
+    """ Hold a probe slot of the host the monitor connects to, waiting for the host limits (see app.services.host_limit) """
+    host = await get_probe_host(monitor) if host_limiter.enabled else None
+    async with host_limiter.hold_async(host, monitor.request_timeout):
+        yield
+
+
+class _CachedDNSNetworkBackend(httpcore.AsyncNetworkBackend):
+    """ httpcore network backend resolving the host names through the DNS cache of the worker """
+
+    def __init__(self, backend: httpcore.AsyncNetworkBackend):
+        self._backend = backend
+
+    async def connect_tcp(self, host, port, **kwargs):
+        try:
+            addresses = await dns_cache.resolve_async(host)
+        except DNSResolutionError as exception:
+            raise httpcore.ConnectError(str(exception))
+        return await self._backend.connect_tcp(addresses[0], port, **kwargs)
+
+    async def connect_unix_socket(self, path, **kwargs):
+        return await self._backend.connect_unix_socket(path, **kwargs)
+
+    async def sleep(self, seconds):
+        await self._backend.sleep(seconds)
+
+
+@contextmanager
+def _map_httpcore_exceptions():
+    try:
+        yield
+    except (
+        httpcore.TimeoutException, httpcore.NetworkError, httpcore.ProtocolError, httpcore.ProxyError,
+        httpcore.UnsupportedProtocol,
+    ) as exception:
+        # httpx names its exceptions after the httpcore ones
+        raise getattr(httpx, type(exception).__name__)(str(exception)) from exception
+
+
+class _ResponseStream(httpx.AsyncByteStream):
+    def __init__(self, httpcore_stream):
+        self._httpcore_stream = httpcore_stream
+
+    async def __aiter__(self):
+        with _map_httpcore_exceptions():
+            async for part in self._httpcore_stream:
+                yield part
+
+    async def aclose(self):
+        if hasattr(self._httpcore_stream, 'aclose'):
+            await self._httpcore_stream.aclose()
+
+
+class CachedDNSTransport(httpx.AsyncBaseTransport):
+    """
+    httpx transport over an httpcore connection pool resolving the host names through the DNS cache of the worker.
+    Connections are still pooled by host name, so TLS (SNI, certificate checks) is unaffected.
+    """
+
+    def __init__(self, verify: bool, limits: httpx.Limits = httpx.Limits()):
+        self._pool = httpcore.AsyncConnectionPool(
+            ssl_context=httpx.create_ssl_context(verify=verify),
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+            network_backend=_CachedDNSNetworkBackend(httpcore.AnyIOBackend()),
+        )
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        httpcore_request = httpcore.Request(
+            method=request.method,
+            url=httpcore.URL(
+                scheme=request.url.raw_scheme,
+                host=request.url.raw_host,
+                port=request.url.port,
+                target=request.url.raw_path,
+            ),
+            headers=request.headers.raw,
+            content=request.stream,
+            extensions=request.extensions,
+        )
+        with _map_httpcore_exceptions():
+            httpcore_response = await self._pool.handle_async_request(httpcore_request)
+
+        return httpx.Response(
+            status_code=httpcore_response.status,
+            headers=httpcore_response.headers,
+            stream=_ResponseStream(httpcore_response.stream),
+            extensions=httpcore_response.extensions,
+        )
+
+    async def aclose(self):
+        await self._pool.aclose()
+
+
+class _PhaseTrace:
+    """ httpcore trace callback measuring the connect, TLS and time to first byte phases of a request """
+
+    def __init__(self):
+        self.started: dict[str, float] = {}
+        self.completed: dict[str, float] = {}
+
+    async def __call__(self, event_name: str, info: dict):
+        name, _, stage = event_name.rpartition('.')
+        if stage == 'started':
+            self.started[name] = time.monotonic()
+        elif stage == 'complete':
+            self.completed[name] = time.monotonic()
+
+    def _duration(self, started: str, completed: str) -> float | None:
+        if started in self.started and completed in self.completed:
+            return self.completed[completed] - self.started[started]
+        return None
+
+    @property
+    def timings(self) -> dict[str, float]:
+        timings = {
+            'connect': self._duration('connection.connect_tcp', 'connection.connect_tcp'),
+            'tls': self._duration('connection.start_tls', 'connection.start_tls'),
+            'ttfb': (
+                self._duration('http11.send_request_headers', 'http11.receive_response_headers')
+                or self._duration('http2.send_request_headers', 'http2.receive_response_headers')
+            ),
+        }
+        return {phase: seconds for phase, seconds in timings.items() if seconds is not None}
+
+
+def _store_certificate(response: httpx.Response):
+    """ Cache the certificate expiry of the https endpoint from the connection the probe used """
+    if response.url.scheme != 'https' or 'network_stream' not in response.extensions:
+        return
+
+    ssl_object = response.extensions['network_stream'].get_extra_info('ssl_object')
+    if ssl_object is not None:
+        certificate_cache.store(response.url.host, response.url.port or 443, ssl_object.getpeercert(binary_form=True))
+
+
+def show_response_detail(response: httpx.Response) -> str:
+    detail_lines = [f"{response.status_code} {response.reason_phrase}", ""]
+    for header, value in response.headers.items():
+        detail_lines.append(f"{header}: {value}")
+    return '\n'.join(detail_lines)
+
+
+class ProbeEngine:
+    """
+    Runs probes concurrently on the running event loop, at most `concurrency` at a time.
+    HTTP probes (but the `fresh_connection` ones) share one connection pool per `verify_ssl` setting,
+    every probe still gets its own client so cookies are never shared between monitors. Every probe
+    is cancelled if it has not finished `PROBE_CANCEL_GRACE_SECONDS` after its request timeout.
+
+        async with ProbeEngine(concurrency=200) as probe_engine:
+            monit_response = await probe_engine.check(monitor)
+    """
+
+    def __init__(self, concurrency: int):
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._limits = httpx.Limits(
+            max_connections=concurrency,
+            max_keepalive_connections=concurrency,
+            keepalive_expiry=config.HTTP_POOL_IDLE_SECONDS,
+        )
+        self._transports: dict[bool, CachedDNSTransport] = {}
+
+    async def __aenter__(self) -> 'ProbeEngine':
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        for transport in self._transports.values():
+            await transport.aclose()
+        self._transports.clear()
+
+    async def check(self, monitor: Monitor) -> MonitResponse:
+        return (await self.check_group([monitor]))[0]
+
+    async def check_group(self, monitors: list[Monitor]) -> list[MonitResponse]:
+        """ Probe monitors making the same request (see app.services.coalescing) once, with a response for every one """
+        async with hold_probe_host(monitors[0]):
+            return await self.probe_group(monitors)
+
+    async def probe_group(self, monitors: list[Monitor]) -> list[MonitResponse]:
+        """
+        check_group without the host limits, for callers holding the host slot themselves.
+        The slot is waited for before taking a concurrency slot, so delayed probes do not hold one.
+        """
+        monitor = monitors[0]
+        async with self._semaphore:
+            try:
+                return await asyncio.wait_for(
+                    self._check_group(monitors), monitor.request_timeout + config.PROBE_CANCEL_GRACE_SECONDS
+                )
+            except asyncio.TimeoutError:
+                return [MonitResponse('', 'Timeout', 0, False) for _ in monitors]
+
+    async def _check_group(self, monitors: list[Monitor]) -> list[MonitResponse]:
+        monitor = monitors[0]
+        if monitor.monitor_type == MonitorTypeEnum.http:
+            return await self.http_monitoring_group(monitors)
+
+        elif monitor.monitor_type == MonitorTypeEnum.ping:
+            # ping responses do not depend on the alert config
+            return [await ping_monitoring(monitor)] * len(monitors)
+
+        elif monitor.monitor_type in (MonitorTypeEnum.tcp, MonitorTypeEnum.udp):
+            return await _socket_monitoring(monitors)
+
+        raise NotImplementedError
+
+    def _get_transport(self, verify_ssl: bool) -> CachedDNSTransport:
+        if verify_ssl not in self._transports:
+            self._transports[verify_ssl] = CachedDNSTransport(verify=verify_ssl, limits=self._limits)
+        return self._transports[verify_ssl]
+
+    async def http_monitoring(self, monitor: Monitor) -> MonitResponse:
+        return (await self.http_monitoring_group([monitor]))[0]
+
+    async def http_monitoring_group(self, monitors: list[Monitor]) -> list[MonitResponse]:
+        monitor = monitors[0]
+        incident_cause = ''
+        response_representation = ''
+        timings = {}
+        # resolved upfront to report DNS failures and timing apart, the connections then hit the cache
+        hostname = urllib.parse.urlsplit(monitor.endpoint).hostname
+        if hostname:
+            try:
+                _, timings['dns'] = await resolve(hostname)
+            except DNSResolutionError as exception:
+                return [MonitResponse('', exception.incident_cause, 0, False) for _ in monitors]
+
+        headers = {'User-Agent': config.USER_AGENT}
+        if monitor.request_headers:
+            headers = {**headers, **monitor.request_headers}
+
+        authentication = None
+        if monitor.auth_user and monitor.auth_pass:
+            authentication = httpx.BasicAuth(monitor.auth_user, monitor.auth_pass)
+
+        if monitor.fresh_connection:
+            transport = CachedDNSTransport(verify=bool(monitor.verify_ssl))
+        else:
+            transport = self._get_transport(bool(monitor.verify_ssl))
+        # not closed on purpose, closing the client would close the shared transport
+        client = httpx.AsyncClient(
+            transport=transport,
+            timeout=monitor.request_timeout,
+            follow_redirects=bool(monitor.follow_redirects),
+        )
+        if not monitor.keep_cookies_between_redirects:
+            async def drop_cookies(response: httpx.Response):
+                # runs before the redirect request is built, so the cookies a response sets are not sent to its location
+                client.cookies.clear()
+
+            client.event_hooks = {'response': [drop_cookies]}
+        phase_trace = _PhaseTrace()
+        try:
+            start = time.monotonic()
+            # closing the response releases the connection to the pool when the body was read, closes it otherwise
+            async with client.stream(
+                method=monitor.http_method,
+                url=monitor.endpoint,
+                headers=headers,
+                content=monitor.request_body,
+                auth=authentication,
+                extensions={'trace': phase_trace},
+            ) as response:
+                headers_at = time.monotonic()
+                # up to the headers, connecting included
+                response_time = headers_at - start
+                timings.update(phase_trace.timings)
+                response_representation = show_response_detail(response)
+                _store_certificate(response.history[0] if response.history else response)
+
+                body_scanner = GroupBodyScanner(monitors, response.encoding, config.HTTP_MAX_BODY_BYTES)
+                if body_scanner.reads_body:
+                    async for chunk in response.aiter_bytes(config.HTTP_CHUNK_BYTES):
+                        if body_scanner.feed(chunk):
+                            break
+                elif must_drain(response.headers.get('Content-Length')):
+                    await response.aread()
+                timings['transfer'] = time.monotonic() - headers_at
+
+                statuses = [
+                    get_http_status(
+                        member,
+                        not response.is_error,
+                        response.status_code,
+                        response.reason_phrase,
+                        body_scanner.keyword_found(index),
+                    )
+                    for index, member in enumerate(monitors)
+                ]
+        except httpx.TimeoutException:
+            incident_cause = 'Timeout'
+        except httpx.TooManyRedirects:
+            incident_cause = 'Too Many Redirects'
+        except httpx.TransportError:
+            incident_cause = 'Connection Error'
+        finally:
+            if monitor.fresh_connection:
+                await transport.aclose()
+        if incident_cause:
+            return [MonitResponse(response_representation, incident_cause, 0, False, dict(timings)) for _ in monitors]
+
+        monit_responses = []
+        for member, (status, member_incident_cause) in zip(monitors, statuses):
+            monit_response = MonitResponse(
+                response_representation,
+                member_incident_cause,
+                response_time,
+                status,
+                dict(timings),
+            )
+            if status and member.ssl_check_expiration:
+                monit_response = await asyncio.to_thread(get_ssl_checked_response, member, monit_response)
+            monit_responses.append(monit_response)
+        return monit_responses
+
+
+class ProbeEngineThread:
+    """
+    One ProbeEngine per worker process, on an event loop running in a daemon thread, so that its connection pools
+    and its concurrency limit are shared by all the batches of the process (several at once with a threads pool).
+    Started on the first call of the process, so every forked worker gets its own.
+
+        monit_responses = probe_engine_thread.run(lambda probe_engine: probe_engine.check_group(monitors), timeout=60)
+    """
+
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _start(self):
+        if self._pid == os.getpid():
+            return
+
+        self._loop = asyncio.new_event_loop()
+        self._probe_engine = ProbeEngine(self.concurrency)
+        threading.Thread(target=self._loop.run_forever, name='probe-engine', daemon=True).start()
+        self._pid = os.getpid()
+
+    def run(self, probe: Callable[[ProbeEngine], Awaitable], timeout: float):
+        """ Run the coroutine `probe(probe_engine)` on the loop of the process, cancelled after `timeout` seconds """
+        with self._lock:
+            self._start()
+        future = asyncio.run_coroutine_threadsafe(probe(self._probe_engine), self._loop)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            future.cancel()
+            raise
+
+
+async def ping_monitoring(monitor: Monitor) -> MonitResponse:
+    try:
+        addresses, dns_time = await resolve(monitor.endpoint)
+    except DNSResolutionError as exception:
+        return MonitResponse('', exception.incident_cause, 0, False)
+
+    ping_result = await asyncio.wrap_future(
+        icmp_pinger.submit(addresses[0], count=monitor.num_pings, timeout=monitor.request_timeout / monitor.num_pings)
+    )
+    return get_ping_response(ping_result, dns_time)
+
+
+async def _socket_monitoring(monitors: list[Monitor]) -> list[MonitResponse]:
+    try:
+        addresses, dns_time = await resolve(monitors[0].endpoint)
+    except DNSResolutionError as exception:
+        return [MonitResponse('', exception.incident_cause, 0, False) for _ in monitors]
+
+    future, body_scanner = submit_socket_probe(monitors, addresses[0])
+    return get_socket_responses(monitors, await asyncio.wrap_future(future), body_scanner, dns_time)
+
+
+async def tcp_monitoring(monitor: Monitor) -> MonitResponse:
+    return (await _socket_monitoring([monitor]))[0]
+
+
+async def udp_monitoring(monitor: Monitor) -> MonitResponse:
+    return (await _socket_monitoring([monitor]))[0]
@@ -36,6 +36,8 @@ def calculate_status_intervals(
 
     up_by_intervals = {}
     results_by_intervals = {}
+    # seconds of every probe phase in every interval
+    timings_by_intervals = {}
     num_results_ok = 0
 
     for r in results:
@@ -51,6 +53,11 @@ def calculate_status_intervals(
         else:
             results_by_intervals[bucket] = 1
 
+        if r.timings:
+            interval_timings = timings_by_intervals.setdefault(bucket, {})
+            for phase, seconds in r.timings.items():
+                interval_timings.setdefault(phase, []).append(seconds)
+
         if r.status is True:
             num_results_ok = num_results_ok + 1
             if bucket in up_by_intervals:
@@ -60,16 +67,22 @@ def calculate_status_intervals(
 
     starting_intervals = []
     status_by_intervals = []
+    average_timings = []
     for n in range(num_intervals):
         starting_intervals.append(start_date + interval*n)
         if n in results_by_intervals:
             status_by_intervals.append(up_by_intervals.get(n, 0.0) / results_by_intervals[n])
         else:
             status_by_intervals.append(-1)
+        average_timings.append({
+            phase: sum(seconds) / len(seconds) for phase, seconds in timings_by_intervals.get(n, {}).items()
+        })
 
     # TODO availability assumes the interval do not changes
     return {
         'availability': num_results_ok / len(results) if results else 0.0,
         'uptimes': status_by_intervals,
         'starting_intervals': starting_intervals,
+        # average seconds of every probe phase, by interval
+        'timings': average_timings,
     }
\ No newline at end of file
@@ -0,0 +1,82 @@
+from dataclasses import dataclass
+
+from app.core import config
+from app.db.redis import redis_client
+
+
+CONSUMER_LAG_KEY = 'scheduler:consumer_lag'
+PUBLISH_SECONDS_KEY = 'scheduler:publish_seconds'
+
+
+@dataclass
+class QueueStatus:
+    depth: int
+    consumer_lag: float
+    # time the last tick took to publish its probes
+    publish_seconds: float = 0
+
+    @property
+    def degraded(self) -> bool:
+        return (
+            self.depth > config.SCHEDULER_MAX_QUEUE_DEPTH or
+            self.consumer_lag > config.SCHEDULER_MAX_CONSUMER_LAG_SECONDS
+        )
+
+    @property
+    def capacity(self) -> int | None:
+        """ Number of probes that can still be enqueued in this tick, None when unbounded """
+        if not self.degraded:
+            return None
+
+        return max(0, config.SCHEDULER_MAX_QUEUE_DEPTH - self.depth)
+
+
+def _queued_key(monitor_id: int) -> str:
+    return f"queued:monitor:{monitor_id}"
+
+
+def get_queue_status() -> QueueStatus:
+    """ Depth of the probe queues on the broker and the last lag between enqueue and start reported by the workers """
+    pipeline = redis_client.pipeline()
+    for queue in config.PROBE_QUEUES.values():
+        pipeline.llen(queue)
+    pipeline.get(CONSUMER_LAG_KEY)
+    pipeline.get(PUBLISH_SECONDS_KEY)
+    *depths, consumer_lag, publish_seconds = pipeline.execute()
+    return QueueStatus(
+        depth=sum(depths), consumer_lag=float(consumer_lag or 0), publish_seconds=float(publish_seconds or 0)
+    )
+
+
+def record_consumer_lag(lag_seconds: float):
+    # expires so a stale value does not keep the scheduler degraded once the queue is drained
+    redis_client.set(CONSUMER_LAG_KEY, lag_seconds, ex=config.SCHEDULER_MAX_CONSUMER_LAG_SECONDS)
+
+
+def record_publish_seconds(publish_seconds: float):
+    redis_client.set(PUBLISH_SECONDS_KEY, publish_seconds, ex=config.SCHEDULER_MAX_CONSUMER_LAG_SECONDS)
+
+
+def mark_queued(monitor_ids: list[int], ttl_seconds: int):
+    if not monitor_ids:
+        return
+
+    pipeline = redis_client.pipeline()
+    for monitor_id in monitor_ids:
+        pipeline.set(_queued_key(monitor_id), 1, ex=ttl_seconds)
+    pipeline.execute()
+
+
+def unmark_queued(monitor_ids: list[int]):
+    if not monitor_ids:
+        return
+
+    redis_client.delete(*[_queued_key(monitor_id) for monitor_id in monitor_ids])
+
+
+def get_queued_monitor_ids(monitor_ids: list[int]) -> set[int]:
+    if not monitor_ids:
+        return set()
+
+    queued = redis_client.mget([_queued_key(monitor_id) for monitor_id in monitor_ids])
+    return {monitor_id for monitor_id, is_queued in zip(monitor_ids, queued) if is_queued is not None}
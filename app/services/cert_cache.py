@@ -0,0 +1,49 @@
+import threading
+import time
+from datetime import datetime
+
+from cryptography import x509
+
+from app.core import config
+
+
+class CertificateCache:
+    """
+    Expiry date of the TLS certificates seen by the probes of the worker, per (host, port), filled in by the
+    probe connections themselves. Certificates rarely change, so every monitor pointing to the same host
+    reads the expiry from here for `ttl_seconds` instead of opening a connection just to look at the certificate.
+    """
+
+    def __init__(self, ttl_seconds: int, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        # (host, port) -> (not after, expires at)
+        self._entries: dict[tuple[str, int], tuple[datetime, float]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, host: str, port: int) -> datetime | None:
+        entry = self._entries.get((host, port))
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        return entry[0]
+
+    def store(self, host: str, port: int, certificate: bytes | None):
+        """ Store the expiry of a DER encoded certificate """
+        if not certificate:
+            return
+
+        not_after = x509.load_der_x509_certificate(certificate).not_valid_after_utc.replace(tzinfo=None)
+        with self._lock:
+            self._entries.pop((host, port), None)
+            self._entries[(host, port)] = (not_after, time.monotonic() + self.ttl_seconds)
+            while len(self._entries) > self.max_entries:
+                del self._entries[next(iter(self._entries))]
+
+
+certificate_cache = CertificateCache(
+    ttl_seconds=config.CERTIFICATE_CACHE_SECONDS,
+    max_entries=config.CERTIFICATE_CACHE_MAX_ENTRIES,
+)
@@ -0,0 +1,73 @@
+"""
+Probe coalescing: monitors making the same request (often the same public endpoint watched by several teams)
+share a single network probe, whose response is then evaluated for every one of them with its own alert config.
+"""
+import hashlib
+import json
+import urllib.parse
+from collections import defaultdict
+from typing import Any, Callable
+
+from app.schemas.monitor import MonitorTypeEnum
+from app.services.monitoring import ProbeSpec, get_socket_mode
+
+
+def get_canonical_endpoint(probe_spec: ProbeSpec) -> str:
+    """ Endpoint with the case insensitive parts lowercased and the default port left out """
+    if probe_spec.monitor_type != MonitorTypeEnum.http:
+        return probe_spec.endpoint.strip().lower()
+
+    parsed_url = urllib.parse.urlsplit(probe_spec.endpoint.strip())
+    scheme = parsed_url.scheme.lower()
+    netloc = parsed_url.hostname or ''
+    if parsed_url.port and parsed_url.port != {'http': 80, 'https': 443}.get(scheme):
+        netloc = f"{netloc}:{parsed_url.port}"
+    if parsed_url.username or parsed_url.password:
+        netloc = f"{parsed_url.username or ''}:{parsed_url.password or ''}@{netloc}"
+    return urllib.parse.urlunsplit((scheme, netloc, parsed_url.path or '/', parsed_url.query, ''))
+
+
+def get_request_fingerprint(probe_spec: ProbeSpec) -> str:
+    """
+    Digest of everything that goes on the wire, or changes how the probe is made, for a monitor.
+    The alert config (alert type, keywords, certificate expiry) is left out, it is evaluated per monitor.
+    """
+    request = {
+        'monitor_type': probe_spec.monitor_type,
+        'endpoint': get_canonical_endpoint(probe_spec),
+        'request_timeout': probe_spec.request_timeout,
+    }
+    if probe_spec.monitor_type == MonitorTypeEnum.http:
+        request.update({
+            'http_method': (probe_spec.http_method or '').upper(),
+            'request_body': probe_spec.request_body,
+            'request_headers': sorted(
+                (header.lower(), value) for header, value in (probe_spec.request_headers or {}).items()
+            ),
+            'follow_redirects': bool(probe_spec.follow_redirects),
+            'keep_cookies_between_redirects': bool(probe_spec.keep_cookies_between_redirects),
+            'verify_ssl': bool(probe_spec.verify_ssl),
+            'fresh_connection': bool(probe_spec.fresh_connection),
+            # the password is left out of the serialized specs, read back by the worker
+            'auth': [probe_spec.auth_user, probe_spec.auth_pass] if probe_spec.auth_user else None,
+        })
+    elif probe_spec.monitor_type == MonitorTypeEnum.ping:
+        request['num_pings'] = probe_spec.num_pings
+    else:
+        request.update({
+            'port': probe_spec.port,
+            'data': probe_spec.data or '',
+            'socket_mode': get_socket_mode(probe_spec),
+        })
+    return hashlib.sha1(json.dumps(request, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def group_by_request(items: list, probe_spec_of: Callable[[Any], ProbeSpec] = lambda item: item) -> list[list]:
+    """
+    Probe specs (or the items `probe_spec_of` gets them from) grouped by request fingerprint, every group
+    to be probed once. Groups come in the order of their first item, items in the order they come.
+    """
+    groups = defaultdict(list)
+    for item in items:
+        groups[get_request_fingerprint(probe_spec_of(item))].append(item)
+    return list(groups.values())
@@ -0,0 +1,178 @@
+import asyncio
+import ipaddress
+import socket
+import threading
+import time
+from dataclasses import dataclass
+
+import dns.asyncresolver
+import dns.exception
+import dns.resolver
+
+from app.core import config
+
+
+class DNSResolutionError(Exception):
+    def __init__(self, hostname: str, incident_cause: str):
+        super().__init__(f"{incident_cause}: {hostname}")
+        self.hostname = hostname
+        self.incident_cause = incident_cause
+
+
+@dataclass
+class _Entry:
+    addresses: list[str]
+    # incident cause of a failed lookup, cached for a short while too
+    error: str | None
+    expires_at: float
+
+
+class DNSCache:
+    """
+    Resolutions shared by all the probes of the worker. Answers are kept for their record TTL
+    (clamped between `min_ttl` and `max_ttl`), failures (NXDOMAIN, SERVFAIL, timeouts) for `negative_ttl`.
+    When the resolver fails (not when the name does not exist) the last known addresses are served,
+    so that a resolver hiccup does not open incidents on every monitor.
+    Names without A records are resolved from their AAAA records (IPv6 only hosts), names without either
+    fall back to the system resolver (/etc/hosts, search domains), which lists the IPv4 addresses first.
+    """
+
+    def __init__(self, min_ttl: int, max_ttl: int, negative_ttl: int, max_entries: int, timeout: float):
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._entries: dict[str, _Entry] = {}
+        self._lock = threading.Lock()
+        self._resolver = None
+        self._async_resolver = None
+        # lookups in flight, so concurrent probes to the same host share the query
+        self._lookups: dict[str, asyncio.Task] = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _get_resolver(self) -> dns.resolver.Resolver:
+        if self._resolver is None:
+            self._resolver = dns.resolver.Resolver()
+            self._resolver.lifetime = self.timeout
+        return self._resolver
+
+    def _get_async_resolver(self) -> dns.asyncresolver.Resolver:
+        if self._async_resolver is None:
+            self._async_resolver = dns.asyncresolver.Resolver()
+            self._async_resolver.lifetime = self.timeout
+        return self._async_resolver
+
+    def _get(self, hostname: str) -> list[str] | None:
+        """ Cached addresses of `hostname`, None when not cached. Raises the cached failures """
+        try:
+            ipaddress.ip_address(hostname)
+            return [hostname]
+        except ValueError:
+            pass
+
+        entry = self._entries.get(hostname)
+        if entry is None or entry.expires_at <= time.monotonic():
+            return None
+        if entry.error:
+            raise DNSResolutionError(hostname, entry.error)
+        return entry.addresses
+
+    def _store(self, hostname: str, addresses: list[str], error: str | None, ttl: float) -> list[str]:
+        with self._lock:
+            previous = self._entries.pop(hostname, None)
+            if error == 'DNS server failure' and previous is not None and previous.addresses:
+                addresses, error = previous.addresses, None
+
+            self._entries[hostname] = _Entry(addresses, error, time.monotonic() + ttl)
+            while len(self._entries) > self.max_entries:
+                del self._entries[next(iter(self._entries))]
+
+        if error:
+            raise DNSResolutionError(hostname, error)
+        return addresses
+
+    def _store_answer(self, hostname: str, answer: dns.resolver.Answer) -> list[str]:
+        ttl = min(max(answer.rrset.ttl, self.min_ttl), self.max_ttl)
+        return self._store(hostname, [record.address for record in answer], None, ttl)
+
+    def _store_system(self, hostname: str) -> list[str]:
+        try:
+            addresses = list(dict.fromkeys(
+                address[4][0] for address in sorted(
+                    socket.getaddrinfo(hostname, None, socket.AF_UNSPEC, socket.SOCK_STREAM),
+                    key=lambda address: address[0] != socket.AF_INET,
+                )
+            ))
+        except socket.gaierror:
+            return self._store(hostname, [], 'DNS lookup failure', self.negative_ttl)
+        return self._store(hostname, addresses, None, self.min_ttl)
+
+    def resolve(self, hostname: str) -> list[str]:
+        """ Addresses of `hostname`, raises DNSResolutionError with the incident cause when it cannot be resolved """
+        addresses = self._get(hostname)
+        if addresses is not None:
+            return addresses
+
+        # IPv6 only hosts have AAAA records only
+        for record_type in ('A', 'AAAA'):
+            try:
+                answer = self._get_resolver().resolve(hostname, record_type, search=True)
+            except dns.resolver.NoAnswer:
+                continue
+            except dns.resolver.NXDOMAIN:
+                break
+            except (dns.resolver.NoNameservers, dns.exception.Timeout):
+                return self._store(hostname, [], 'DNS server failure', self.negative_ttl)
+            except dns.exception.DNSException:
+                # not a valid hostname
+                return self._store(hostname, [], 'DNS lookup failure', self.negative_ttl)
+            return self._store_answer(hostname, answer)
+        return self._store_system(hostname)
+
+    async def resolve_async(self, hostname: str) -> list[str]:
+        addresses = self._get(hostname)
+        if addresses is not None:
+            return addresses
+
+        lookup = self._lookups.get(hostname)
+        if lookup is None or lookup.get_loop() is not asyncio.get_running_loop():
+            lookup = asyncio.ensure_future(self._resolve_async(hostname))
+            self._lookups[hostname] = lookup
+            lookup.add_done_callback(lambda done: self._forget_lookup(hostname, done))
+        return await asyncio.shield(lookup)
+
+    def _forget_lookup(self, hostname: str, lookup: asyncio.Task):
+        if self._lookups.get(hostname) is lookup:
+            del self._lookups[hostname]
+
+    async def _resolve_async(self, hostname: str) -> list[str]:
+        for record_type in ('A', 'AAAA'):
+            try:
+                answer = await self._get_async_resolver().resolve(hostname, record_type, search=True)
+            except dns.resolver.NoAnswer:
+                continue
+            except dns.resolver.NXDOMAIN:
+                break
+            except (dns.resolver.NoNameservers, dns.exception.Timeout):
+                return self._store(hostname, [], 'DNS server failure', self.negative_ttl)
+            except dns.exception.DNSException:
+                # not a valid hostname
+                return self._store(hostname, [], 'DNS lookup failure', self.negative_ttl)
+            return self._store_answer(hostname, answer)
+        return await asyncio.to_thread(self._store_system, hostname)
+
+
+dns_cache = DNSCache(
+    min_ttl=config.DNS_CACHE_MIN_TTL_SECONDS,
+    max_ttl=config.DNS_CACHE_MAX_TTL_SECONDS,
+    negative_ttl=config.DNS_CACHE_NEGATIVE_TTL_SECONDS,
+    max_entries=config.DNS_CACHE_MAX_ENTRIES,
+    timeout=config.DNS_TIMEOUT_SECONDS,
+)
@@ -0,0 +1,82 @@
+from collections import Counter, defaultdict, deque
+from datetime import datetime
+from typing import Iterator
+
+from app.db.redis import redis_client
+from app.services.scheduler import DueMonitor
+
+
+class FairShareQueue:
+    """
+    Due monitors grouped by tenant, drained in round robin so under contention every tenant
+    gets the same share of the dispatch capacity whatever its number of monitors.
+    Tenants with fewer checks in the current minute are served first in every round,
+    and a tenant is no longer served once its checks-per-minute budget is spent.
+
+    With a `max_per_tenant` (the dispatch capacity, no tenant can get more) the queue is bounded
+    and the monitors pushed over it are dropped.
+    """
+    def __init__(self, max_per_tenant: int | None = None):
+        self.queues: dict[str, deque[DueMonitor]] = defaultdict(deque)
+        self.max_per_tenant = max_per_tenant
+
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def push(self, due_monitor: DueMonitor) -> bool:
+        """ Queue a due monitor, False when dropped """
+        if self.max_per_tenant is not None and len(self.queues.get(due_monitor.tenant, ())) >= self.max_per_tenant:
+            return False
+
+        self.queues[due_monitor.tenant].append(due_monitor)
+        return True
+
+    def drain(
+        self, capacity: int | None, usage: dict[str, int], budget: int | None = None
+    ) -> Iterator[DueMonitor]:
+        remaining = {
+            tenant: budget - usage.get(tenant, 0) if budget else None
+            for tenant in self.queues
+        }
+        tenants = sorted(self.queues, key=lambda tenant: usage.get(tenant, 0))
+        served = 0
+        while tenants:
+            next_round = []
+            for tenant in tenants:
+                if capacity is not None and served >= capacity:
+                    return
+                if remaining[tenant] is not None and remaining[tenant] <= 0:
+                    continue
+
+                yield self.queues[tenant].popleft()
+                served += 1
+                if remaining[tenant] is not None:
+                    remaining[tenant] -= 1
+
+                if self.queues[tenant]:
+                    next_round.append(tenant)
+            tenants = next_round
+
+
+def _usage_key(tenant: str, now: datetime) -> str:
+    return f"fairshare:{tenant}:{now:%Y%m%d%H%M}"
+
+
+def get_tenant_usage(tenants: list[str], now: datetime) -> dict[str, int]:
+    """ Number of checks dispatched in the current minute by tenant """
+    if not tenants:
+        return {}
+
+    usage = redis_client.mget([_usage_key(tenant, now) for tenant in tenants])
+    return {tenant: int(checks or 0) for tenant, checks in zip(tenants, usage)}
+
+
+def add_tenant_usage(dispatched: Counter, now: datetime):
+    if not dispatched:
+        return
+
+    pipeline = redis_client.pipeline()
+    for tenant, checks in dispatched.items():
+        pipeline.incrby(_usage_key(tenant, now), checks)
+        pipeline.expire(_usage_key(tenant, now), 120)
+    pipeline.execute()
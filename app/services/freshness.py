@@ -0,0 +1,83 @@
+import bisect
+from dataclasses import dataclass
+from datetime import datetime
+
+from sqlalchemy.orm import Session
+
+from app import crud
+from app.db.redis import redis_client
+from app.models.monitor import Result
+
+
+# upper bounds, in seconds, of the scheduling drift histogram buckets
+DRIFT_BUCKETS = [0.1, 0.5, 1, 2, 5, 10, 30, 60, 300]
+DRIFT_BUCKET_NAMES = [f"<={bucket}s" for bucket in DRIFT_BUCKETS] + [f">{DRIFT_BUCKETS[-1]}s"]
+FLEET_DRIFT_KEY = 'freshness:drift:{hour}'
+
+# a monitor is considered to have a gap when it went unchecked for this many periods
+GAP_PERIODS = 2
+
+
+@dataclass
+class MonitorGap:
+    monitor_id: int
+    name: str
+    periodicity: int
+    last_checked_at: datetime | None
+    gap_seconds: float
+
+
+def get_drift_bucket(drift_seconds: float) -> str:
+    return DRIFT_BUCKET_NAMES[bisect.bisect_left(DRIFT_BUCKETS, drift_seconds)]
+
+
+def get_drift_histogram(drifts: list[float]) -> dict[str, int]:
+    histogram = dict.fromkeys(DRIFT_BUCKET_NAMES, 0)
+    for drift_seconds in drifts:
+        histogram[get_drift_bucket(drift_seconds)] += 1
+    return histogram
+
+
+def get_monitor_drift_histogram(results: list[Result]) -> dict[str, int]:
+    """ Histogram of the delay between the moment the checks were due and the moment they started """
+    return get_drift_histogram([
+        (result.monitored_at - result.due_at).total_seconds()
+        for result in results if result.due_at and result.monitored_at
+    ])
+
+
+def record_fleet_drifts(drifts: list[float], now: datetime):
+    """ Add the drifts of a batch of checks to the fleet-wide histogram of the current hour """
+    if not drifts:
+        return
+
+    key = FLEET_DRIFT_KEY.format(hour=f"{now:%Y%m%d%H}")
+    pipeline = redis_client.pipeline()
+    for drift_seconds in drifts:
+        pipeline.hincrby(key, get_drift_bucket(drift_seconds), 1)
+    pipeline.expire(key, 7 * 24 * 3600)
+    pipeline.execute()
+
+
+def get_fleet_drift_histogram(hour: datetime) -> dict[str, int]:
+    counts = redis_client.hgetall(FLEET_DRIFT_KEY.format(hour=f"{hour:%Y%m%d%H}"))
+    return {bucket: int(counts.get(bucket, 0)) for bucket in DRIFT_BUCKET_NAMES}
+
+
+def find_gaps(db: Session, now: datetime, monitor_ids: list[int] | None = None) -> list[MonitorGap]:
+    """
+    Active monitors that went unchecked for more than GAP_PERIODS times their periodicity,
+    i.e. whose checks silently stopped
+    """
+    gaps = []
+    for last_check in crud.result.get_last_checks(db, monitor_ids=monitor_ids):
+        gap_seconds = (now - (last_check.last_checked_at or last_check.created_at)).total_seconds()
+        if gap_seconds > GAP_PERIODS * last_check.periodicity:
+            gaps.append(MonitorGap(
+                monitor_id=last_check.id,
+                name=last_check.name,
+                periodicity=last_check.periodicity,
+                last_checked_at=last_check.last_checked_at,
+                gap_seconds=gap_seconds,
+            ))
+    return gaps
@@ -0,0 +1,150 @@
+import asyncio
+import math
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+
+import redis
+
+from app.core import config
+from app.db.redis import redis_client
+
+
+# takes a probe slot of a host, returns 0 when taken, otherwise the milliseconds to wait before trying again.
+# KEYS[1]: sorted set of the probes in flight (token -> expiry), KEYS[2]: time the next probe can start at.
+# ARGV: token, max concurrent probes, milliseconds between probes, milliseconds a slot is held at most, poll interval
+ACQUIRE_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local max_concurrent = tonumber(ARGV[2])
+local interval = tonumber(ARGV[3])
+local ttl = tonumber(ARGV[4])
+
+if max_concurrent > 0 then
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+    if redis.call('ZCARD', KEYS[1]) >= max_concurrent then
+        return tonumber(ARGV[5])
+    end
+end
+if interval > 0 then
+    local next_at = tonumber(redis.call('GET', KEYS[2]) or now)
+    if next_at > now then
+        return math.ceil(next_at - now)
+    end
+    redis.call('SET', KEYS[2], now + interval, 'PX', math.ceil(interval) + 1)
+end
+if max_concurrent > 0 then
+    redis.call('ZADD', KEYS[1], now + ttl, ARGV[1])
+    redis.call('PEXPIRE', KEYS[1], ttl)
+end
+return 0
+"""
+_acquire = redis_client.register_script(ACQUIRE_SCRIPT)
+
+
+def _in_flight_key(host: str) -> str:
+    return f"hostlimit:{{{host}}}:in_flight"
+
+
+def _next_at_key(host: str) -> str:
+    return f"hostlimit:{{{host}}}:next_at"
+
+
+class HostLimiter:
+    """
+    Politeness limits of the probes to a same host (the address they connect to), shared by all the workers
+    through Redis: at most `max_concurrent` probes in flight, started at most `per_second` per second and
+    evenly spaced. A probe over the limits is delayed up to `max_delay_seconds`, then runs anyway so that
+    a busy host never misses its checks. The limits are not enforced (the probes are not delayed) when Redis fails.
+
+        with host_limiter.hold(address, monitor.request_timeout):
+            ...
+    """
+
+    def __init__(self, max_concurrent: int, per_second: float, max_delay_seconds: float, poll_seconds: float):
+        self.max_concurrent = max_concurrent
+        self.per_second = per_second
+        self.max_delay_seconds = max_delay_seconds
+        self.poll_seconds = poll_seconds
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.max_concurrent or self.per_second)
+
+    def _try_acquire(self, host: str, token: str, hold_seconds: float) -> float:
+        """ Seconds to wait before trying again, 0 when the slot was taken (or Redis failed) """
+        try:
+            wait_ms = _acquire(
+                keys=[_in_flight_key(host), _next_at_key(host)],
+                args=[
+                    token,
+                    self.max_concurrent,
+                    1000 / self.per_second if self.per_second else 0,
+                    math.ceil(hold_seconds * 1000),
+                    math.ceil(self.poll_seconds * 1000),
+                ],
+            )
+        except redis.RedisError as exception:
+            print(f"* Host limit of {host} not enforced: {exception!r}")
+            return 0
+        return wait_ms / 1000
+
+    def _release(self, host: str, token: str):
+        if not self.max_concurrent:
+            return
+        try:
+            redis_client.zrem(_in_flight_key(host), token)
+        except redis.RedisError:
+            # the slot expires by itself
+            pass
+
+    def _give_up(self, host: str, delayed: float, wait: float) -> bool:
+        if delayed + wait <= self.max_delay_seconds:
+            return False
+        print(f"* Host limit of {host} not acquired after {delayed:.1f}s, probing anyway")
+        return True
+
+    @contextmanager
+    def hold(self, host: str | None, timeout: float):
+        """ Hold a probe slot of `host` (no limits when None) for a probe of `timeout` seconds at most """
+        if host is None or not self.enabled:
+            yield
+            return
+
+        token = uuid.uuid4().hex
+        start = time.monotonic()
+        while wait := self._try_acquire(host, token, timeout + config.PROBE_CANCEL_GRACE_SECONDS):
+            if self._give_up(host, time.monotonic() - start, wait):
+                break
+            time.sleep(wait)
+        try:
+            yield
+        finally:
+            self._release(host, token)
+
+    @asynccontextmanager
+    async def hold_async(self, host: str | None, timeout: float):
+        if host is None or not self.enabled:
+            yield
+            return
+
+        token = uuid.uuid4().hex
+        start = time.monotonic()
+        while wait := await asyncio.to_thread(
+            self._try_acquire, host, token, timeout + config.PROBE_CANCEL_GRACE_SECONDS
+        ):
+            if self._give_up(host, time.monotonic() - start, wait):
+                break
+            await asyncio.sleep(wait)
+        try:
+            yield
+        finally:
+            await asyncio.to_thread(self._release, host, token)
+
+
+host_limiter = HostLimiter(
+    max_concurrent=config.HOST_MAX_CONCURRENT_PROBES,
+    per_second=config.HOST_MAX_PROBES_PER_SECOND,
+    max_delay_seconds=config.HOST_LIMIT_MAX_DELAY_SECONDS,
+    poll_seconds=config.HOST_LIMIT_POLL_SECONDS,
+)
@@ -0,0 +1,180 @@
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NewConnectionError
+
+from app.core import config
+from app.services.cert_cache import certificate_cache
+from app.services.dns_cache import DNSResolutionError, dns_cache
+
+
+class _CachedDNSConnectionMixin:
+    # seconds spent establishing the connection, taken by the first probe using it (see pop_connection_timings)
+    timings = None
+
+    def _new_conn(self):
+        try:
+            address = dns_cache.resolve(self._dns_host)[0]
+        except DNSResolutionError as exception:
+            raise NewConnectionError(self, str(exception))
+
+        # connect to the address only, the host name is still used for SNI and the certificate verification
+        dns_host, self._dns_host = self._dns_host, address
+        start = time.monotonic()
+        try:
+            return super()._new_conn()
+        finally:
+            self._dns_host = dns_host
+            self.timings = {'connect': time.monotonic() - start}
+
+
+class CachedDNSHTTPConnection(_CachedDNSConnectionMixin, HTTPConnection):
+    pass
+
+
+class CachedDNSHTTPSConnection(_CachedDNSConnectionMixin, HTTPSConnection):
+    def connect(self):
+        start = time.monotonic()
+        super().connect()
+        self.timings['tls'] = time.monotonic() - start - self.timings['connect']
+        # the certificate expiry comes for free with every new connection
+        certificate_cache.store(self.host, self.port, self.sock.getpeercert(binary_form=True))
+
+
+class CachedDNSHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CachedDNSHTTPConnection
+
+
+class CachedDNSHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CachedDNSHTTPSConnection
+
+
+class CachedDNSAdapter(HTTPAdapter):
+    """ Adapter resolving the host names through the DNS cache of the worker """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CachedDNSHTTPConnectionPool,
+            'https': CachedDNSHTTPSConnectionPool,
+        }
+
+
+def pop_connection_timings(response: requests.Response) -> dict[str, float]:
+    """ Connect and TLS timings of the connection of a streamed response, empty when the connection was reused """
+    connection = getattr(response.raw, 'connection', None)
+    timings = getattr(connection, 'timings', None) or {}
+    if connection is not None:
+        connection.timings = None
+    return timings
+
+
+def new_session() -> requests.Session:
+    """ Session with new connections, resolving the host names through the DNS cache """
+    session = requests.Session()
+    session.mount('http://', CachedDNSAdapter())
+    session.mount('https://', CachedDNSAdapter())
+    return session
+
+
+class PooledAdapter(CachedDNSAdapter):
+    """
+    Adapter of a HostConnectionPool host, shared by the sessions of the checks to that host.
+    Closing a session releases the adapter, its connections are closed only once it was evicted
+    from the pool and every session holding it was closed.
+    """
+
+    def __init__(self, lock: threading.Lock, **kwargs):
+        super().__init__(**kwargs)
+        # the lock of the pool, which takes the adapter for the sessions and evicts it
+        self._lock = lock
+        self._holders = 0
+        self._evicted = False
+
+    def close(self):
+        with self._lock:
+            self._holders -= 1
+            must_close = self._evicted and not self._holders
+        if must_close:
+            self.close_connections()
+
+    def close_connections(self):
+        super().close()
+
+
+class HostConnectionPool:
+    """
+    Keep-alive connections of the worker, shared by all the checks it runs: one requests adapter
+    (an urllib3 connection pool) per scheme, host, port and TLS verification setting.
+
+    Holds at most `max_hosts` hosts, dropping the least recently used one past that, and closes
+    the connections of the hosts not used for `idle_seconds`, once the checks using them are done.
+    """
+
+    def __init__(self, max_hosts: int, idle_seconds: float, connections_per_host: int):
+        self.max_hosts = max_hosts
+        self.idle_seconds = idle_seconds
+        self.connections_per_host = connections_per_host
+        # key -> (adapter, last used at), least recently used first
+        self._adapters: OrderedDict[tuple, tuple[PooledAdapter, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._adapters)
+
+    def get_adapter(self, key: tuple) -> PooledAdapter:
+        """ The adapter of the host, held until closed (see PooledAdapter) """
+        now = time.monotonic()
+        evicted = []
+        with self._lock:
+            if key in self._adapters:
+                adapter, _ = self._adapters.pop(key)
+            else:
+                adapter = PooledAdapter(self._lock, pool_connections=1, pool_maxsize=self.connections_per_host)
+            adapter._holders += 1
+            self._adapters[key] = (adapter, now)
+
+            while len(self._adapters) > self.max_hosts:
+                evicted.append(self._adapters.popitem(last=False)[1][0])
+            while self._adapters:
+                oldest_key, (oldest_adapter, last_used_at) = next(iter(self._adapters.items()))
+                if now - last_used_at < self.idle_seconds:
+                    break
+                del self._adapters[oldest_key]
+                evicted.append(oldest_adapter)
+
+            for evicted_adapter in evicted:
+                evicted_adapter._evicted = True
+            # the ones still held are closed by their last session
+            evicted = [evicted_adapter for evicted_adapter in evicted if not evicted_adapter._holders]
+
+        for evicted_adapter in evicted:
+            evicted_adapter.close_connections()
+        return adapter
+
+    def session(self, url: str, verify_ssl: bool) -> requests.Session:
+        """
+        New session, with its own cookie jar, whose requests to the host of `url` reuse the pooled connections.
+        Redirects to other hosts get new connections. Must be closed once done: that closes the connections
+        of the redirects and releases the pooled ones.
+        """
+        parsed_url = urllib.parse.urlsplit(url)
+        port = parsed_url.port or (443 if parsed_url.scheme == 'https' else 80)
+        adapter = self.get_adapter((parsed_url.scheme, parsed_url.hostname, port, bool(verify_ssl)))
+
+        session = new_session()
+        session.mount(f"{parsed_url.scheme}://{parsed_url.netloc}/", adapter)
+        return session
+
+
+connection_pool = HostConnectionPool(
+    max_hosts=config.HTTP_POOL_MAX_HOSTS,
+    idle_seconds=config.HTTP_POOL_IDLE_SECONDS,
+    connections_per_host=config.HTTP_POOL_CONNECTIONS_PER_HOST,
+)
@@ -0,0 +1,333 @@
+"""
+ICMP echo engine: a single socket and a single thread per worker process multiplexing the echo requests
+of all the ping probes, however many are in flight, instead of one socket and one blocked thread per probe.
+"""
+import os
+import selectors
+import socket
+import struct
+import time
+from concurrent.futures import Future
+
+from app.core import config
+from app.services.selector_loop import SelectorLoop
+
+ECHO_REPLY = 0
+DESTINATION_UNREACHABLE = 3
+ECHO_REQUEST = 8
+TIME_EXCEEDED = 11
+
+ECHO_REQUEST_V6 = 128
+ECHO_REPLY_V6 = 129
+DESTINATION_UNREACHABLE_V6 = 1
+TIME_EXCEEDED_V6 = 3
+
+# incident causes of the ICMP errors answering an echo request, by address family and ICMP type
+ERROR_CAUSES = {
+    socket.AF_INET: {DESTINATION_UNREACHABLE: 'Destination unreachable', TIME_EXCEEDED: 'TTL expired in transit'},
+    socket.AF_INET6: {DESTINATION_UNREACHABLE_V6: 'Destination unreachable', TIME_EXCEEDED_V6: 'TTL expired in transit'},
+}
+
+# linux/in.h and linux/in6.h, not exposed by the socket module
+IP_RECVERR = getattr(socket, 'IP_RECVERR', 11)
+IPV6_RECVERR = getattr(socket, 'IPV6_RECVERR', 25)
+SO_EE_ORIGIN_ICMP = 2
+SO_EE_ORIGIN_ICMP6 = 3
+
+_HEADER = struct.Struct('!BBHHH')
+# struct sock_extended_err of linux/errqueue.h: errno, origin, type, code, pad, info, data
+_EXTENDED_ERROR = struct.Struct('=IBBBBII')
+
+
+def checksum(data: bytes) -> int:
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+def echo_request(identifier: int, sequence: int, payload: bytes, family: int = socket.AF_INET) -> bytes:
+    if family == socket.AF_INET6:
+        # the kernel computes ICMPv6 checksums, they cover a pseudo header with the source address
+        return _HEADER.pack(ECHO_REQUEST_V6, 0, 0, identifier, sequence) + payload
+    header = _HEADER.pack(ECHO_REQUEST, 0, 0, identifier, sequence)
+    return _HEADER.pack(ECHO_REQUEST, 0, checksum(header + payload), identifier, sequence) + payload
+
+
+def get_family(address: str) -> int:
+    return socket.AF_INET6 if ':' in address else socket.AF_INET
+
+
+class PingResult:
+    """ Outcome of every echo request sent to an address: the round trip seconds, or the error message """
+
+    def __init__(self, address: str, count: int):
+        self.address = address
+        self.replies: list[float | str | None] = [None] * count
+        self.num_pending = count
+
+    @property
+    def rtts(self) -> list[float]:
+        return [reply for reply in self.replies if isinstance(reply, float)]
+
+    @property
+    def errors(self) -> list[str]:
+        return [reply for reply in self.replies if isinstance(reply, str)]
+
+    @property
+    def loss(self) -> float:
+        return 1 - len(self.rtts) / len(self.replies)
+
+    @property
+    def rtt_avg(self) -> float:
+        rtts = self.rtts
+        return sum(rtts) / len(rtts) if rtts else 0
+
+    @property
+    def success(self) -> bool:
+        """ Successful when any echo request got a reply, like pythonping """
+        return bool(self.rtts)
+
+    def __repr__(self):
+        lines = [
+            f'Reply from {self.address} in {reply * 1000:.2f}ms' if isinstance(reply, float) else reply
+            for reply in self.replies
+        ]
+        lines.append('')
+        lines.append(
+            f'{len(self.replies)} packets transmitted, {len(self.rtts)} received, {self.loss:.0%} packet loss'
+        )
+        if self.rtts:
+            lines.append(
+                f'Round Trip Times min/avg/max is '
+                f'{min(self.rtts) * 1000:.2f}/{self.rtt_avg * 1000:.2f}/{max(self.rtts) * 1000:.2f} ms'
+            )
+        return '\n'.join(lines)
+
+
+class _Ping:
+    def __init__(self, address: str, count: int, timeout: float, interval: float):
+        self.result = PingResult(address, count)
+        self.future: Future[PingResult] = Future()
+        self.timeout = timeout
+        self.interval = interval
+
+    def record(self, index: int, reply: float | str):
+        self.result.replies[index] = reply
+        self.result.num_pending -= 1
+        if not self.result.num_pending:
+            self.future.set_result(self.result)
+
+
+class ICMPPinger(SelectorLoop):
+    """
+    Sends the echo requests of all the pings submitted, from any thread or event loop, through one ICMP socket
+    per address family and matches the replies to them by sequence number (and identifier on raw sockets).
+    The echo requests of a ping are `interval` seconds apart, every one waiting `timeout` seconds for its reply.
+
+    Uses unprivileged ICMP datagram sockets when the kernel allows it (net.ipv4.ping_group_range),
+    raw sockets otherwise, which require root or CAP_NET_RAW. Raw sockets receive the destination unreachable
+    and time exceeded errors like any ICMP packet, datagram sockets get them on their error queue (IP_RECVERR).
+    IPv6 addresses are pinged with ICMPv6 when the host supports it.
+
+        ping_result = icmp_pinger.ping('192.0.2.1', count=4, timeout=1)
+    """
+
+    name = 'icmp-pinger'
+
+    # extra seconds `ping` waits for the result, beyond the timeouts of its echo requests
+    result_grace_seconds = 5
+
+    def __init__(self, interval: float, payload_size: int):
+        super().__init__()
+        self.interval = interval
+        self.payload = bytes(i & 0xFF for i in range(payload_size))
+
+    def _setup(self):
+        # IPv4 is required, IPv6 pings fail with a clear cause on hosts without it
+        self._sockets = {socket.AF_INET: self._open_socket(socket.AF_INET, socket.IPPROTO_ICMP)}
+        try:
+            self._sockets[socket.AF_INET6] = self._open_socket(socket.AF_INET6, socket.IPPROTO_ICMPV6)
+        except OSError:
+            pass
+        # only checked on raw sockets, datagram sockets get their identifier set by the kernel
+        # and do not receive the replies to other sockets
+        self._identifier = os.getpid() & 0xFFFF
+        # sequence number -> (ping, index of the echo request, sent at)
+        self._in_flight: dict[int, tuple[_Ping, int, float]] = {}
+        self._next_sequence = 0
+
+    def _open_socket(self, family: int, protocol: int) -> socket.socket:
+        try:
+            icmp_socket = socket.socket(family, socket.SOCK_DGRAM, protocol)
+            if family == socket.AF_INET:
+                icmp_socket.setsockopt(socket.IPPROTO_IP, IP_RECVERR, 1)
+            else:
+                icmp_socket.setsockopt(socket.IPPROTO_IPV6, IPV6_RECVERR, 1)
+        except PermissionError:
+            icmp_socket = socket.socket(family, socket.SOCK_RAW, protocol)
+        # replies of thousands of targets can arrive at once
+        icmp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+        self.register(icmp_socket, selectors.EVENT_READ, self._receive)
+        return icmp_socket
+
+    def submit(self, address: str, count: int, timeout: float) -> Future:
+        """ Ping an IP address, the future gets the PingResult once every echo request is answered or timed out """
+        ping = _Ping(address, count, timeout, min(self.interval, timeout))
+        self.call_soon_threadsafe(self._schedule_ping, ping)
+        return ping.future
+
+    def ping(self, address: str, count: int, timeout: float) -> PingResult:
+        try:
+            return self.submit(address, count, timeout).result(count * timeout + self.result_grace_seconds)
+        except TimeoutError:
+            # the loop thread is stalled, the probe must not wait for it
+            ping_result = PingResult(address, count)
+            ping_result.replies = ['Request timed out'] * count
+            return ping_result
+
+    def _schedule_ping(self, ping: _Ping):
+        now = time.monotonic()
+        for index in range(len(ping.result.replies)):
+            self.call_at(now + index * ping.interval, self._send, ping, index)
+
+    def _allocate_sequence(self) -> int | None:
+        if len(self._in_flight) >= 0x10000:
+            return None
+        while self._next_sequence in self._in_flight:
+            self._next_sequence = (self._next_sequence + 1) & 0xFFFF
+        sequence = self._next_sequence
+        self._next_sequence = (self._next_sequence + 1) & 0xFFFF
+        return sequence
+
+    def _send(self, ping: _Ping, index: int):
+        family = get_family(ping.result.address)
+        icmp_socket = self._sockets.get(family)
+        if icmp_socket is None:
+            ping.record(index, 'IPv6 is not available on the monitoring worker')
+            return
+
+        sequence = self._allocate_sequence()
+        if sequence is None:
+            ping.record(index, 'Too many echo requests in flight')
+            return
+
+        try:
+            icmp_socket.sendto(echo_request(self._identifier, sequence, self.payload, family), (ping.result.address, 0))
+        except OSError as exception:
+            ping.record(index, exception.strerror or str(exception))
+            return
+
+        sent_at = time.monotonic()
+        self._in_flight[sequence] = (ping, index, sent_at)
+        self.call_at(sent_at + ping.timeout, self._expire, sequence, ping)
+
+    def _expire(self, sequence: int, ping: _Ping):
+        in_flight = self._in_flight.get(sequence)
+        if in_flight is not None and in_flight[0] is ping:
+            del self._in_flight[sequence]
+            ping.record(in_flight[1], 'Request timed out')
+
+    def _receive(self, icmp_socket: socket.socket, mask: int):
+        family = icmp_socket.family
+        raw = icmp_socket.type == socket.SOCK_RAW
+        while True:
+            try:
+                packet, address_info = icmp_socket.recvfrom(65535, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+            except OSError:
+                # pending error of a datagram socket, its details are on the error queue
+                continue
+            received_at = time.monotonic()
+
+            if raw and family == socket.AF_INET:
+                # IPv4 raw sockets receive the IP header, IPv6 ones do not
+                packet = packet[(packet[0] & 0x0F) * 4:]
+            if len(packet) < _HEADER.size:
+                continue
+            icmp_type, _, _, identifier, sequence = _HEADER.unpack_from(packet)
+
+            if icmp_type in (ECHO_REPLY, ECHO_REPLY_V6):
+                self._answer(raw, identifier, sequence, address_info[0], received_at)
+            elif raw and icmp_type in ERROR_CAUSES[family]:
+                self._answer_raw_error(family, ERROR_CAUSES[family][icmp_type], packet[_HEADER.size:])
+
+        if not raw:
+            self._receive_errors(icmp_socket)
+
+    def _answer(self, raw: bool, identifier: int, sequence: int, address: str, received_at: float):
+        in_flight = self._in_flight.get(sequence)
+        if in_flight is None or in_flight[0].result.address != address:
+            return
+        if raw and identifier != self._identifier:
+            # raw sockets receive the replies to every process of the host
+            return
+
+        ping, index, sent_at = self._in_flight.pop(sequence)
+        ping.record(index, received_at - sent_at)
+
+    def _answer_raw_error(self, family: int, incident_cause: str, original_packet: bytes):
+        """ Errors quote the IP header and the first 8 bytes of the echo request that caused them """
+        if family == socket.AF_INET:
+            if len(original_packet) < 20:
+                return
+            header_length = (original_packet[0] & 0x0F) * 4
+            address = socket.inet_ntop(family, original_packet[16:20])
+        else:
+            # the IPv6 header is fixed size, extension headers are not expected on echo requests
+            if len(original_packet) < 40:
+                return
+            header_length = 40
+            address = socket.inet_ntop(family, original_packet[24:40])
+        original_echo = original_packet[header_length:header_length + _HEADER.size]
+        if len(original_echo) < _HEADER.size:
+            return
+        original_type, _, _, identifier, sequence = _HEADER.unpack(original_echo)
+        if identifier == self._identifier:
+            self._answer_error(original_type, sequence, address, incident_cause)
+
+    def _receive_errors(self, icmp_socket: socket.socket):
+        """
+        Datagram sockets queue the errors answering their echo requests, with the echo request
+        as sent (its identifier rewritten by the kernel) and its destination
+        """
+        while True:
+            try:
+                original_echo, ancillary_data, _, address_info = icmp_socket.recvmsg(
+                    65535, 1024, socket.MSG_ERRQUEUE | socket.MSG_DONTWAIT
+                )
+            except (BlockingIOError, InterruptedError):
+                return
+            if len(original_echo) < _HEADER.size:
+                continue
+            original_type, _, _, _, sequence = _HEADER.unpack_from(original_echo)
+            for level, cmsg_type, cmsg_data in ancillary_data:
+                if (level, cmsg_type) in ((socket.IPPROTO_IP, IP_RECVERR), (socket.IPPROTO_IPV6, IPV6_RECVERR)):
+                    incident_cause = get_error_cause(icmp_socket.family, cmsg_data)
+                    self._answer_error(original_type, sequence, address_info[0], incident_cause)
+
+    def _answer_error(self, original_type: int, sequence: int, address: str, incident_cause: str):
+        in_flight = self._in_flight.get(sequence)
+        if (
+            original_type not in (ECHO_REQUEST, ECHO_REQUEST_V6)
+            or in_flight is None
+            or in_flight[0].result.address != address
+        ):
+            return
+
+        ping, index, _ = self._in_flight.pop(sequence)
+        ping.record(index, incident_cause)
+
+
+def get_error_cause(family: int, extended_error: bytes) -> str:
+    """ Incident cause of a struct sock_extended_err read from the error queue of a datagram socket """
+    error_number, origin, icmp_type, _, _, _, _ = _EXTENDED_ERROR.unpack_from(extended_error)
+    if origin in (SO_EE_ORIGIN_ICMP, SO_EE_ORIGIN_ICMP6) and icmp_type in ERROR_CAUSES[family]:
+        return ERROR_CAUSES[family][icmp_type]
+    return os.strerror(error_number)
+
+
+icmp_pinger = ICMPPinger(interval=config.PING_INTERVAL_SECONDS, payload_size=config.PING_PAYLOAD_BYTES)
@@ -0,0 +1,81 @@
+from collections import defaultdict
+from enum import Enum
+
+from sqlalchemy.orm import Session
+
+from app import crud
+from app.core import config
+from app.db.redis import redis_client
+from app.services.scheduler import DueMonitor
+
+
+# exponentially weighted moving average of the probe duration of every monitor
+PROBE_SECONDS_KEY = 'lanes:probe_seconds'
+PROBE_SECONDS_WEIGHT = 0.3
+PROBE_SECONDS_PRUNED_KEY = 'lanes:probe_seconds:pruned'
+
+# folds the probe seconds ARGV[2..] of the monitors ARGV[1..] (alternating) into their averages, with weight ARGV[1],
+# in one step so concurrent workers recording the same monitor do not overwrite each other
+RECORD_SCRIPT = """
+local weight = tonumber(ARGV[1])
+for i = 2, #ARGV, 2 do
+    local seconds = tonumber(ARGV[i + 1])
+    local previous = redis.call('HGET', KEYS[1], ARGV[i])
+    if previous then
+        seconds = weight * seconds + (1 - weight) * tonumber(previous)
+    end
+    -- lua numbers would be truncated to integers
+    redis.call('HSET', KEYS[1], ARGV[i], tostring(seconds))
+end
+"""
+_record = redis_client.register_script(RECORD_SCRIPT)
+
+
+class Lane(str, Enum):
+    fast = 'fast'
+    slow = 'slow'
+    priority = 'priority'
+
+
+def get_lane(due_monitor: DueMonitor, probe_seconds: float | None) -> Lane:
+    if due_monitor.critical:
+        return Lane.priority
+    if probe_seconds is not None and probe_seconds > config.SLOW_LANE_THRESHOLD_SECONDS:
+        return Lane.slow
+    return Lane.fast
+
+
+def split_by_lane(due_monitors: list[DueMonitor]) -> dict[Lane, list[DueMonitor]]:
+    """ Group the due monitors by the lane (queue and worker pool) they should be probed on """
+    if not due_monitors:
+        return {}
+
+    probe_seconds = redis_client.hmget(PROBE_SECONDS_KEY, [due_monitor.id for due_monitor in due_monitors])
+    lanes = defaultdict(list)
+    for due_monitor, seconds in zip(due_monitors, probe_seconds):
+        lanes[get_lane(due_monitor, float(seconds) if seconds is not None else None)].append(due_monitor)
+    return lanes
+
+
+def record_probe_seconds(probe_seconds: dict[int, float]):
+    if not probe_seconds:
+        return
+
+    _record(
+        keys=[PROBE_SECONDS_KEY],
+        args=[PROBE_SECONDS_WEIGHT, *(value for item in probe_seconds.items() for value in item)],
+        client=redis_client,
+    )
+
+
+def prune_probe_seconds(db: Session):
+    """ Forget the averages of the monitors no longer in the monitor table, at most every SCHEDULER_RELOAD_SECONDS """
+    if not redis_client.set(PROBE_SECONDS_PRUNED_KEY, 1, nx=True, ex=config.SCHEDULER_RELOAD_SECONDS):
+        return
+
+    recorded_ids = [int(monitor_id) for monitor_id in redis_client.hkeys(PROBE_SECONDS_KEY)]
+    for i in range(0, len(recorded_ids), config.SCHEDULE_TASK_PAGE_SIZE):
+        page_ids = recorded_ids[i:i + config.SCHEDULE_TASK_PAGE_SIZE]
+        stale_ids = set(page_ids) - crud.monitor.get_existing_ids(db, monitor_ids=page_ids)
+        if stale_ids:
+            redis_client.hdel(PROBE_SECONDS_KEY, *stale_ids)
@@ -0,0 +1,56 @@
+import uuid
+
+from app.core import config
+from app.db.redis import redis_client
+
+
+# deletes the lease only if it is still owned by the given token
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+_release = redis_client.register_script(RELEASE_SCRIPT)
+
+
+def _lease_key(monitor_id: int) -> str:
+    return f"lease:monitor:{monitor_id}"
+
+
+def acquire_monitor_leases(monitor_ids: list[int], ttl_seconds: int) -> dict[int, str]:
+    """
+    Take the in-flight lease of the given monitors, returning the token of every lease taken.
+    Monitors whose lease is held by another probe are left out. The leases expire by themselves
+    after `ttl_seconds` in case the worker dies.
+    """
+    tokens = {monitor_id: uuid.uuid4().hex for monitor_id in monitor_ids}
+    pipeline = redis_client.pipeline()
+    for monitor_id, token in tokens.items():
+        pipeline.set(_lease_key(monitor_id), token, nx=True, px=ttl_seconds * 1000)
+    acquired = pipeline.execute()
+    return {monitor_id: token for (monitor_id, token), is_acquired in zip(tokens.items(), acquired) if is_acquired}
+
+
+def release_monitor_leases(tokens: dict[int, str]):
+    pipeline = redis_client.pipeline()
+    for monitor_id, token in tokens.items():
+        _release(keys=[_lease_key(monitor_id)], args=[token], client=pipeline)
+    pipeline.execute()
+
+
+def get_lease_ttl_seconds(request_timeouts: list[int | None], concurrency: int) -> int:
+    """ Time to probe monitors with the given timeouts `concurrency` at a time, plus a grace period """
+    waves = -(-len(request_timeouts) // concurrency)
+    max_request_timeout = max(
+        request_timeout or config.MONITOR_LEASE_DEFAULT_TIMEOUT_SECONDS for request_timeout in request_timeouts
+    )
+    return waves * max_request_timeout + config.MONITOR_LEASE_GRACE_SECONDS
+
+
+def get_leased_monitor_ids(monitor_ids: list[int]) -> set[int]:
+    if not monitor_ids:
+        return set()
+
+    leases = redis_client.mget([_lease_key(monitor_id) for monitor_id in monitor_ids])
+    return {monitor_id for monitor_id, lease in zip(monitor_ids, leases) if lease is not None}
@@ -0,0 +1,127 @@
+import functools
+import re
+# the parser of the re module, to look at the structure of the tenants' regexes
+from re import _parser as sre_parse
+
+import ahocorasick
+
+from app.core import config
+from app.models.monitor import Monitor
+
+
+class KeywordMatcher:
+    """
+    The keywords (literals, found all at once by an Aho-Corasick automaton) and regular expressions of a monitor.
+    Matches when any of them is found, or when all of them are with `match_all`.
+    """
+
+    def __init__(self, keywords: tuple[str, ...], regexes: tuple[str, ...], match_all: bool):
+        self.keywords = keywords
+        self.regexes = [re.compile(regex) for regex in regexes]
+        self.match_all = match_all
+        self.num_patterns = len(keywords) + len(regexes)
+        # characters carried over between chunks, so that matches spanning two chunks are found
+        self.carry_over = max(
+            [len(keyword) - 1 for keyword in keywords] + [config.KEYWORD_REGEX_WINDOW if regexes else 0]
+        )
+
+        self._automaton = None
+        if keywords:
+            self._automaton = ahocorasick.Automaton()
+            for index, keyword in enumerate(keywords):
+                self._automaton.add_word(keyword, index)
+            self._automaton.make_automaton()
+
+    def find(self, text: str, skip: set[int] = frozenset()) -> set[int]:
+        """ Index of the patterns found in `text`, keywords first, then regexes """
+        found = set()
+        if self._automaton is not None:
+            found.update(index for _, index in self._automaton.iter(text))
+        for index, regex in enumerate(self.regexes, start=len(self.keywords)):
+            if index not in skip and regex.search(text):
+                found.add(index)
+        return found
+
+    def matches(self, text: str) -> bool:
+        return self.is_match(self.find(text))
+
+    def is_match(self, found: set[int]) -> bool:
+        return len(found) == self.num_patterns if self.match_all else bool(found)
+
+    def scan(self) -> 'KeywordScan':
+        return KeywordScan(self)
+
+
+class KeywordScan:
+    """
+    Matching of a text received in chunks. A regex match spanning two chunks is only found
+    when it fits in the KEYWORD_REGEX_WINDOW characters carried over.
+    """
+
+    def __init__(self, matcher: KeywordMatcher):
+        self.matcher = matcher
+        self.found: set[int] = set()
+        self._carry_over = ''
+
+    @property
+    def matched(self) -> bool:
+        return self.matcher.is_match(self.found)
+
+    @property
+    def decided(self) -> bool:
+        """ Whether reading more text cannot change the outcome """
+        return len(self.found) == self.matcher.num_patterns if self.matcher.match_all else self.matched
+
+    def feed(self, text: str) -> bool:
+        window = self._carry_over + text
+        self.found |= self.matcher.find(window, skip=self.found)
+        carry_over = self.matcher.carry_over
+        self._carry_over = window[len(window) - carry_over:] if carry_over else ''
+        return self.decided
+
+
+_REPEATS = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, sre_parse.POSSESSIVE_REPEAT)
+
+
+def _check_structure(parsed: sre_parse.SubPattern, in_repeat: bool = False):
+    for op, argument in parsed:
+        if op in (sre_parse.GROUPREF, sre_parse.GROUPREF_EXISTS):
+            raise ValueError('backreferences are not supported')
+
+        repeats = op in _REPEATS and argument[1] > 1
+        if repeats and in_repeat:
+            raise ValueError('nested repetitions are not supported')
+
+        for item in argument if isinstance(argument, (tuple, list)) else [argument]:
+            for subpattern in item if isinstance(item, list) else [item]:
+                if isinstance(subpattern, sre_parse.SubPattern):
+                    _check_structure(subpattern, in_repeat or repeats)
+
+
+def get_regex_error(regex: str) -> str | None:
+    """
+    Why a tenant regex is refused, None when accepted. Regexes run against up to HTTP_MAX_BODY_BYTES
+    in the shared workers, so besides being valid they must be short and backtrack at most polynomially:
+    no repetition of a repetition (like `(a+)+`) and no backreferences.
+    """
+    if len(regex) > config.KEYWORD_REGEX_MAX_LENGTH:
+        return f"longer than {config.KEYWORD_REGEX_MAX_LENGTH} characters"
+    try:
+        _check_structure(sre_parse.parse(regex))
+    except (re.error, ValueError) as exception:
+        return str(exception)
+    return None
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_matcher(keywords: tuple[str, ...], regexes: tuple[str, ...], match_all: bool) -> KeywordMatcher:
+    return KeywordMatcher(keywords, regexes, match_all)
+
+
+def get_matcher(monitor: Monitor) -> KeywordMatcher:
+    """
+    Compiled matcher of the monitor keyword config, cached in the worker. The cache is keyed by the config itself,
+    so it changes with every new version of the monitor and is shared by the monitors having the same keywords.
+    """
+    keywords = [keyword for keyword in [monitor.keyword, *(monitor.keywords or [])] if keyword]
+    return _get_matcher(tuple(keywords), tuple(monitor.keyword_regexes or []), monitor.keyword_match == 'all')
@@ -1,20 +1,72 @@
+import codecs
 import socket
 import ssl
 import time
 import urllib.parse
-from dataclasses import dataclass
+from concurrent.futures import Future
+from contextlib import contextmanager
+from dataclasses import dataclass, field, fields, replace
 from datetime import datetime
 
 import requests
-from pythonping import ping
 from requests.auth import HTTPBasicAuth
 
 from app import schemas
 from app.core import config
 from app.models.monitor import Monitor
-from app.schemas.monitor import MonitorTypeEnum
+from app.services.cert_cache import certificate_cache
+from app.services.dns_cache import DNSResolutionError, dns_cache
+from app.services.host_limit import host_limiter
+from app.services.http_pool import connection_pool, new_session, pop_connection_timings
+from app.services.icmp import PingResult, icmp_pinger
+from app.services.matching import KeywordScan, get_matcher
+from app.services.socket_probe import SocketResult, socket_prober
+from app.schemas.monitor import MonitorTypeEnum, SocketModeEnum
 
 
+@dataclass
+class ProbeSpec:
+    """
+    Everything needed to probe a monitor, sent by the scheduler in the task payload so the worker
+    does not need to read the monitor from the database (but the credentials of the monitors having some).
+    The probe functions take either a ProbeSpec or a Monitor, both having the same attributes.
+    """
+    id: int
+    monitor_type: str
+    endpoint: str
+    alert_type: str
+    keyword: str | None
+    keywords: list[str] | None
+    keyword_regexes: list[str] | None
+    keyword_match: str | None
+    request_timeout: int
+    http_method: str | None
+    request_body: str | None
+    request_headers: dict[str, str] | None
+    follow_redirects: bool | None
+    keep_cookies_between_redirects: bool | None
+    verify_ssl: bool | None
+    fresh_connection: bool | None
+    ssl_check_expiration: int | None
+    auth_user: str | None
+    auth_pass: str | None
+    num_pings: int | None
+    port: int | None
+    data: str | None
+    socket_mode: str | None
+
+    @classmethod
+    def from_monitor(cls, monitor) -> 'ProbeSpec':
+        """ Build the spec from a Monitor or from a row having the same columns """
+        return cls(**{field.name: getattr(monitor, field.name) for field in fields(cls)})
+
+    def without_credentials(self) -> 'ProbeSpec':
+        """
+        The spec to serialize (task payloads, Redis scheduler): credentials never leave the database,
+        the worker reads them back by monitor id (see app.tasks)
+        """
+        return replace(self, auth_pass=None)
+
 
 @dataclass
 class MonitResponse:
@@ -22,6 +74,8 @@ class MonitResponse:
     incident_cause: str
     response_time: float
     status: bool
+    # seconds spent on every phase of the probe: dns, connect, tls, ttfb (up to the first response byte) and transfer
+    timings: dict[str, float] = field(default_factory=dict)
 
 
 def show_response_detail(response: requests.Response) -> str:
@@ -31,22 +85,170 @@ def show_response_detail(response: requests.Response) -> str:
     return '\n'.join(detail_lines)
 
 
-def get_num_days_before_expired(hostname: str, port: str = '443') -> int:
+def get_num_days_before_expired(hostname: str, port: int = 443, timeout: float | None = None) -> int:
+    """
+    Get number of days before a TLS/SSL of a domain expires. Read from the certificates cache,
+    filled in by the probe connections, only connecting to the host when the expiry is not cached.
+    """
+    expiry_date = certificate_cache.get(hostname, port)
+    if expiry_date is None:
+        # only the expiry date is needed, the certificate is verified by the probe itself
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        with socket.create_connection((dns_cache.resolve(hostname)[0], port), timeout=timeout) as sock:
+            with context.wrap_socket(sock, server_hostname=hostname) as ssock:
+                certificate_cache.store(hostname, port, ssock.getpeercert(binary_form=True))
+        expiry_date = certificate_cache.get(hostname, port)
+
+    delta = expiry_date - datetime.utcnow()
+    return delta.days
+
+
+class BodyScanner:
     """
-    Get number of days before a TLS/SSL of a domain expires
+    Matches the keywords of a monitor against a response body fed in chunks as they are received,
+    so that bodies never have to be held in memory. `feed` returns True once there is no need
+    to read more: the match outcome is known or `max_bytes` were read.
     """
-    context = ssl.create_default_context()
-    with socket.create_connection((hostname, port)) as sock:
-        with context.wrap_socket(sock, server_hostname=hostname) as ssock:
-            ssl_info = ssock.getpeercert()
-            expiry_date = datetime.strptime(ssl_info['notAfter'], '%b %d %H:%M:%S %Y %Z')
-            delta = expiry_date - datetime.utcnow()
-            return delta.days
+
+    def __init__(self, keyword_scan: KeywordScan, encoding: str | None, max_bytes: int):
+        self.keyword_scan = keyword_scan
+        self.max_bytes = max_bytes
+        self.read_bytes = 0
+        try:
+            self._decoder = codecs.getincrementaldecoder(encoding or 'utf-8')(errors='replace')
+        except LookupError:
+            self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    def feed(self, chunk: bytes) -> bool:
+        chunk = chunk[:self.max_bytes - self.read_bytes]
+        self.read_bytes += len(chunk)
+        return self.keyword_scan.feed(self._decoder.decode(chunk)) or self.read_bytes >= self.max_bytes
+
+    def finish(self) -> bool:
+        """ Whether the keywords matched, once the whole body (or `max_bytes` of it) has been fed """
+        if not self.keyword_scan.decided:
+            self.keyword_scan.feed(self._decoder.decode(b'', final=True))
+        return self.keyword_scan.matched
+
+
+class GroupBodyScanner:
+    """
+    Body scanners of the monitors sharing a probe (see app.services.coalescing), fed the same chunks.
+    `feed` returns True once none of them needs to read more. Monitors not looking for keywords have no scanner.
+    """
+
+    def __init__(self, monitors: list[Monitor], encoding: str | None, max_bytes: int):
+        self.body_scanners = [
+            BodyScanner(get_matcher(monitor).scan(), encoding, max_bytes)
+            if monitor.alert_type != schemas.AlertTypeEnum.unavailable else None
+            for monitor in monitors
+        ]
+        self._pending = [body_scanner for body_scanner in self.body_scanners if body_scanner is not None]
+
+    @property
+    def reads_body(self) -> bool:
+        return any(self.body_scanners)
+
+    def feed(self, chunk: bytes) -> bool:
+        self._pending = [body_scanner for body_scanner in self._pending if not body_scanner.feed(chunk)]
+        return not self._pending
+
+    def keyword_found(self, index: int) -> bool | None:
+        """ Whether the keywords of the monitor at `index` matched, None when it does not look for keywords """
+        body_scanner = self.body_scanners[index]
+        return body_scanner.finish() if body_scanner is not None else None
+
+
+def must_drain(content_length: str | None) -> bool:
+    """ Whether to read the body of an availability check so that its connection can be reused """
+    return content_length is not None and content_length.isdigit() and int(content_length) <= config.HTTP_DRAIN_MAX_BYTES
+
+
+def get_http_status(
+    monitor: Monitor, ok: bool, status_code: int, reason: str, keyword_found: bool | None
+) -> tuple[bool, str]:
+    """
+    Status and incident cause of an HTTP response, shared by the blocking and the asyncio probes.
+    `keyword_found` (whether the keywords matched) is None for availability checks, which do not read the body.
+    """
+    incident_cause = ''
+    if monitor.alert_type == schemas.AlertTypeEnum.unavailable:
+        status = ok
+        if not status:
+            incident_cause = f"HTTP {status_code} - {reason}"
+    elif monitor.alert_type == schemas.AlertTypeEnum.does_not_contain_keyword:
+        status = keyword_found
+        if not status:
+            incident_cause = "Keyword not found"
+    elif monitor.alert_type == schemas.AlertTypeEnum.contains_keyword:
+        status = not keyword_found
+        if not status:
+            incident_cause = "Keyword found"
+    else:
+        raise Exception(f"Unknown alert type for monitor.id={monitor.id}")
+    return status, incident_cause
+
+
+def get_socket_status(monitor: Monitor, keyword_found: bool | None) -> tuple[bool, str]:
+    status = True
+    incident_cause = ''
+    if monitor.alert_type == schemas.AlertTypeEnum.does_not_contain_keyword:
+        status = bool(keyword_found)
+        if not status:
+            incident_cause = "Keyword not found"
+    return status, incident_cause
+
+
+def get_ssl_expiration_incident_cause(monitor: Monitor) -> str:
+    """ Empty unless the certificate of an https endpoint expires within `ssl_check_expiration` days """
+    parsed_url = urllib.parse.urlsplit(monitor.endpoint)
+    if parsed_url.scheme == 'https':
+        days_to_expiration = get_num_days_before_expired(
+            parsed_url.hostname, parsed_url.port or 443, monitor.request_timeout
+        )
+        if days_to_expiration <= monitor.ssl_check_expiration:
+            return f'SSL certificate expires in {days_to_expiration} days'
+    return ''
+
+
+def resolve(hostname: str) -> tuple[list[str], float]:
+    """ Addresses of `hostname` from the DNS cache of the worker and the seconds spent resolving it """
+    start = time.monotonic()
+    addresses = dns_cache.resolve(hostname)
+    return addresses, time.monotonic() - start
 
 
 def http_monitoring(monitor: Monitor) -> MonitResponse:
+    return http_monitoring_group([monitor])[0]
+
+
+def get_ssl_checked_response(monitor: Monitor, monit_response: MonitResponse) -> MonitResponse:
+    """ Fail a successful response when the certificate of the monitor endpoint expires soon """
+    if monit_response.status and monitor.ssl_check_expiration:
+        ssl_incident_cause = get_ssl_expiration_incident_cause(monitor)
+        if ssl_incident_cause:
+            return replace(monit_response, incident_cause=ssl_incident_cause, status=False)
+    return monit_response
+
+
+def http_monitoring_group(monitors: list[Monitor]) -> list[MonitResponse]:
+    """
+    Probe monitors making the same request (see app.services.coalescing) with a single request,
+    the response being evaluated for every one of them
+    """
+    monitor = monitors[0]
     incident_cause = ''
     response_representation = ''
+    timings = {}
+    # resolved upfront to report DNS failures and timing apart, the connections then hit the cache
+    hostname = urllib.parse.urlsplit(monitor.endpoint).hostname
+    if hostname:
+        try:
+            _, timings['dns'] = resolve(hostname)
+        except DNSResolutionError as exception:
+            return [MonitResponse('', exception.incident_cause, 0, False) for _ in monitors]
     try:
         headers = {'User-Agent': config.USER_AGENT}
         if monitor.request_headers:
@@ -56,143 +258,219 @@ def http_monitoring(monitor: Monitor) -> MonitResponse:
         if monitor.auth_user and monitor.auth_pass:
             authentication = HTTPBasicAuth(monitor.auth_user, monitor.auth_pass)
 
-        requester = requests.request
-        if monitor.keep_cookies_between_redirects:
-            requester = requests.Session().request
-
-        response = requester(
-            method=monitor.http_method,
-            url=monitor.endpoint,
-            timeout=monitor.request_timeout,
-            verify=monitor.verify_ssl,
-            allow_redirects=monitor.follow_redirects,
-            headers=headers,
-            data=monitor.request_body,
-            auth=authentication,
-        )
-        response_time = response.elapsed.total_seconds()
-        response_representation = show_response_detail(response)
-
-        if monitor.alert_type == schemas.AlertTypeEnum.unavailable:
-            status = response.ok
-            if not status:
-                incident_cause = f"HTTP {response.status_code} - {response.reason}"
-        elif monitor.alert_type == schemas.AlertTypeEnum.does_not_contain_keyword:
-            status = response.text.find(monitor.keyword) != -1
-            if not status:
-                incident_cause = "Keyword not found"
-        elif monitor.alert_type == schemas.AlertTypeEnum.contains_keyword:
-            status = response.text.find(monitor.keyword) == -1
-            if not status:
-                incident_cause = "Keyword found"
+        # every check gets its own session (and cookie jar), sharing the keep-alive connections of the worker
+        if monitor.fresh_connection:
+            session = new_session()
         else:
-            raise Exception(f"Unknown alert type for monitor.id={monitor.id}")
+            session = connection_pool.session(monitor.endpoint, monitor.verify_ssl)
+
+        try:
+            start = time.monotonic()
+            response = session.request(
+                method=monitor.http_method,
+                url=monitor.endpoint,
+                timeout=monitor.request_timeout,
+                verify=monitor.verify_ssl,
+                allow_redirects=monitor.follow_redirects,
+                headers=headers,
+                data=monitor.request_body,
+                auth=authentication,
+                stream=True,
+            )
+            headers_at = time.monotonic()
+            try:
+                # up to the headers, connecting included
+                response_time = headers_at - start
+                timings.update(pop_connection_timings(response))
+                timings['ttfb'] = response_time - timings.get('connect', 0) - timings.get('tls', 0)
+                response_representation = show_response_detail(response)
+
+                body_scanner = GroupBodyScanner(monitors, response.encoding, config.HTTP_MAX_BODY_BYTES)
+                if body_scanner.reads_body:
+                    for chunk in response.iter_content(config.HTTP_CHUNK_BYTES):
+                        if body_scanner.feed(chunk):
+                            break
+                elif must_drain(response.headers.get('Content-Length')):
+                    response.content  # read, so the connection goes back to the pool
+
+                timings['transfer'] = time.monotonic() - headers_at
+
+                statuses = [
+                    get_http_status(
+                        member, response.ok, response.status_code, response.reason, body_scanner.keyword_found(index)
+                    )
+                    for index, member in enumerate(monitors)
+                ]
+            finally:
+                # releases the connection to the pool when the body was read, closes it otherwise
+                response.close()
+        finally:
+            # closed on failures too, the session would otherwise leak its sockets (the pooled ones are only released)
+            session.close()
     except requests.exceptions.Timeout:
         incident_cause = 'Timeout'
-        response_time = 0
-        status = False
-    except requests.exceptions.ConnectionError as exception:
+    except requests.exceptions.ConnectionError:
         incident_cause = 'Connection Error'
-        if "[Errno -2] Name or service not known" in str(exception):
-            incident_cause = 'DNS lookup failure'
-        response_time = 0
-        status = False
     except requests.exceptions.TooManyRedirects:
         incident_cause = 'Too Many Redirects'
-        response_time = 0
-        status = False
-
-    if status and monitor.ssl_check_expiration:
-        parsed_url = urllib.parse.urlparse(monitor.endpoint)
-        if parsed_url.scheme == 'https':
-            days_to_expiration = get_num_days_before_expired(parsed_url.netloc)
-            if days_to_expiration <= monitor.ssl_check_expiration:
-                return MonitResponse(
-                    response_representation,
-                    f'SSL certificate expires in {days_to_expiration} days',
-                    response_time,
-                    False
-                )
+    if incident_cause:
+        return [MonitResponse(response_representation, incident_cause, 0, False, dict(timings)) for _ in monitors]
+
+    return [
+        get_ssl_checked_response(member, MonitResponse(
+            response_representation,
+            member_incident_cause,
+            response_time,
+            status,
+            dict(timings),
+        ))
+        for member, (status, member_incident_cause) in zip(monitors, statuses)
+    ]
+
+
+def get_ping_response(ping_result: PingResult, dns_time: float) -> MonitResponse:
+    incident_cause = ''
+    if not ping_result.success:
+        incident_cause = ping_result.errors[0]
 
     return MonitResponse(
-        response_representation,
+        repr(ping_result),
         incident_cause,
-        response_time,
-        status
+        ping_result.rtt_avg,
+        ping_result.success,
+        {'dns': dns_time},
     )
 
 
 def ping_monitoring(monitor: Monitor) -> MonitResponse:
-    r = ping(
-        monitor.endpoint,
-        timeout=monitor.request_timeout / monitor.num_pings,
-        count=monitor.num_pings,
+    try:
+        addresses, dns_time = resolve(monitor.endpoint)
+    except DNSResolutionError as exception:
+        return MonitResponse('', exception.incident_cause, 0, False)
+
+    # waits for the replies only, the echo requests of all the ping probes of the worker share one socket
+    ping_result = icmp_pinger.ping(
+        addresses[0], count=monitor.num_pings, timeout=monitor.request_timeout / monitor.num_pings
     )
+    return get_ping_response(ping_result, dns_time)
 
-    incident_cause = ''
-    if not r.success():
-        incident_cause = [r for r in r._responses if not r.success][0].legacy_repr()
 
-    return MonitResponse(
-        repr(r),
-        incident_cause,
-        r.rtt_avg_ms,
-        r.success(),
+def get_socket_mode(monitor: Monitor) -> str:
+    """
+    Mode of the socket probe: the one set on the monitor, otherwise TCP monitors only wait for
+    a response when they send data or look for keywords
+    """
+    if monitor.socket_mode:
+        return monitor.socket_mode
+    if monitor.monitor_type == MonitorTypeEnum.udp:
+        return SocketModeEnum.request
+    if monitor.data or monitor.alert_type != schemas.AlertTypeEnum.unavailable:
+        return SocketModeEnum.expect
+    return SocketModeEnum.connect
+
+
+def submit_socket_probe(monitors: list[Monitor], address: str) -> tuple[Future, GroupBodyScanner]:
+    """ Probe the port of monitors making the same request on `address` with the socket prober of the worker """
+    monitor = monitors[0]
+    body_scanner = GroupBodyScanner(monitors, 'utf-8', config.SOCKET_MAX_RESPONSE_BYTES)
+    future = socket_prober.submit(
+        address,
+        monitor.port,
+        socket.SOCK_DGRAM if monitor.monitor_type == MonitorTypeEnum.udp else socket.SOCK_STREAM,
+        get_socket_mode(monitor),
+        bytes(monitor.data or '', 'utf-8'),
+        monitor.request_timeout,
+        config.SOCKET_MAX_RESPONSE_BYTES,
+        body_scanner.feed if body_scanner.reads_body else None,
     )
+    return future, body_scanner
 
 
-def _socket_monitoring(monitor: Monitor, socket_kind: socket.SocketKind) -> MonitResponse:
-    try:
-        with socket.socket(socket.AF_INET, socket_kind) as s:
-            s.settimeout(monitor.request_timeout)
-            start = time.time()
-            s.connect((monitor.endpoint, monitor.port))
-            if monitor.data:
-                s.sendall(bytes(monitor.data, 'utf-8'))
-            response = s.recv(1024)
-            end = time.time()
-            elapsed_time = end - start
-    except ConnectionRefusedError:
-        return MonitResponse('', 'Connection refused', 0, False)
-    except TimeoutError:
-        return MonitResponse('', 'Timeout', 0, False)
-
-    str_response = response.decode()
+def get_socket_responses(
+    monitors: list[Monitor], socket_result: SocketResult, body_scanner: GroupBodyScanner, dns_time: float
+) -> list[MonitResponse]:
+    if socket_result.error:
+        return [MonitResponse('', socket_result.error, 0, False) for _ in monitors]
 
-    status = True
-    incident_cause = ''
-    if monitor.alert_type == schemas.AlertTypeEnum.does_not_contain_keyword:
-        status = str_response.find(monitor.keyword) != -1
-        if not status:
-            incident_cause = "Keyword not found"
+    timings = {'dns': dns_time, 'connect': socket_result.connect_time}
+    if socket_result.ttfb is not None:
+        timings['ttfb'] = socket_result.ttfb
 
-    return MonitResponse(
-        str_response,
-        incident_cause,
-        elapsed_time,
-        status,
-    )
+    monit_responses = []
+    for index, monitor in enumerate(monitors):
+        status, incident_cause = get_socket_status(monitor, body_scanner.keyword_found(index))
+        monit_responses.append(MonitResponse(
+            socket_result.response.decode(errors='replace'),
+            incident_cause,
+            socket_result.elapsed,
+            status,
+            dict(timings),
+        ))
+    return monit_responses
+
+
+def _socket_monitoring(monitors: list[Monitor]) -> list[MonitResponse]:
+    try:
+        addresses, dns_time = resolve(monitors[0].endpoint)
+    except DNSResolutionError as exception:
+        return [MonitResponse('', exception.incident_cause, 0, False) for _ in monitors]
+
+    future, body_scanner = submit_socket_probe(monitors, addresses[0])
+    return get_socket_responses(monitors, future.result(), body_scanner, dns_time)
 
 
 def tcp_monitoring(monitor: Monitor) -> MonitResponse:
-    return _socket_monitoring(monitor, socket.SOCK_STREAM)
+    return _socket_monitoring([monitor])[0]
 
 
 def udp_monitoring(monitor: Monitor) -> MonitResponse:
-    return _socket_monitoring(monitor, socket.SOCK_DGRAM)
+    return _socket_monitoring([monitor])[0]
+
+
+def get_probe_hostname(monitor: Monitor) -> str | None:
+    if monitor.monitor_type == MonitorTypeEnum.http:
+        return urllib.parse.urlsplit(monitor.endpoint).hostname
+    return monitor.endpoint
+
+
+def get_probe_host(monitor: Monitor) -> str | None:
+    """ Address the monitor probes connect to, None when it cannot be resolved (the probe reports it) """
+    hostname = get_probe_hostname(monitor)
+    try:
+        return dns_cache.resolve(hostname)[0] if hostname else None
+    except DNSResolutionError:
+        return None
 
 
 def check_monitor(monitor):
+    return check_monitor_group([monitor])[0]
+
+
+def check_monitor_group(monitors: list) -> list[MonitResponse]:
+    """ Probe monitors making the same request (see app.services.coalescing) once, with a response for every one """
+    with hold_probe_host(monitors[0]):
+        return probe_monitor_group(monitors)
+
+
+@contextmanager
+def hold_probe_host(monitor):
+    """ Hold a probe slot of the host the monitor connects to, waiting for the host limits (see app.services.host_limit) """
+    host = get_probe_host(monitor) if host_limiter.enabled else None
+    with host_limiter.hold(host, monitor.request_timeout):
+        yield
+
+
+def probe_monitor_group(monitors: list) -> list[MonitResponse]:
+    """ check_monitor_group without the host limits, for callers holding the host slot themselves """
+    monitor = monitors[0]
     if monitor.monitor_type == MonitorTypeEnum.http:
-        return http_monitoring(monitor)
+        return http_monitoring_group(monitors)
 
     elif monitor.monitor_type == MonitorTypeEnum.ping:
-        return ping_monitoring(monitor)
-
-    elif monitor.monitor_type == MonitorTypeEnum.tcp:
-        return tcp_monitoring(monitor)
+        # ping responses do not depend on the alert config
+        return [ping_monitoring(monitor)] * len(monitors)
 
-    elif monitor.monitor_type == MonitorTypeEnum.udp:
-        return udp_monitoring(monitor)
+    elif monitor.monitor_type in (MonitorTypeEnum.tcp, MonitorTypeEnum.udp):
+        return _socket_monitoring(monitors)
 
     raise NotImplementedError
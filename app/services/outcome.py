@@ -0,0 +1,92 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from sqlalchemy.orm import Session
+
+from app import crud
+from app.core import config
+from app.models.monitor import Incident, IncidentEvent, Result
+from app.schemas.incident_event import IncidentEventTypeEnum
+from app.services.monitoring import MonitResponse, ProbeSpec
+
+
+@dataclass
+class MonitorOutcome:
+    probe_spec: ProbeSpec
+    monitored_at: datetime
+    response: MonitResponse
+    # wall time spent probing, used to pick the probe lane of the monitor
+    probe_seconds: float = 0
+    due_at: datetime | None = None
+    enqueued_at: datetime | None = None
+
+    @property
+    def finished_at(self) -> datetime:
+        return self.monitored_at + timedelta(seconds=self.probe_seconds)
+
+
+def get_request_representation(probe_spec: ProbeSpec) -> str:
+    request_repr = f"{probe_spec.http_method if probe_spec.monitor_type == 'http' else probe_spec.monitor_type} {probe_spec.endpoint}"
+    if probe_spec.monitor_type in ('tcp', 'udp'):
+        request_repr += f":{probe_spec.port}"
+    return request_repr
+
+
+def record_outcomes(db: Session, outcomes: list[MonitorOutcome]) -> list[Incident]:
+    """
+    Store the results of a batch of probes, opening and closing their incidents, in a single transaction.
+    Returns the incidents that started or ended, whose alerts should be sent.
+    """
+    monitor_ids = [outcome.probe_spec.id for outcome in outcomes]
+    # monitors deleted while being probed
+    existing_monitor_ids = crud.monitor.get_existing_ids(db, monitor_ids=monitor_ids)
+    outcomes = [outcome for outcome in outcomes if outcome.probe_spec.id in existing_monitor_ids]
+    last_open_incidents = crud.incident.get_last_open_by_monitors(db, monitor_ids=monitor_ids)
+
+    changed_incidents = []
+    for outcome in outcomes:
+        db.add(Result(
+            created_at=outcome.monitored_at,
+            monitored_at=outcome.monitored_at,
+            response_time=outcome.response.response_time,
+            status=outcome.response.status,
+            monitor_id=outcome.probe_spec.id,
+            due_at=outcome.due_at,
+            enqueued_at=outcome.enqueued_at,
+            finished_at=outcome.finished_at,
+            timings={
+                phase: round(seconds, 4) for phase, seconds in outcome.response.timings.items()
+            } or None,
+        ))
+
+        last_open_incident = last_open_incidents.get(outcome.probe_spec.id)
+        if outcome.response.status and last_open_incident:
+            last_open_incident.ended_at = outcome.monitored_at
+            db.add(IncidentEvent(
+                incident=last_open_incident,
+                type=IncidentEventTypeEnum.monitoring_success,
+                field=str(outcome.response.status),
+                extra_field=config.WORKER_ID,
+            ))
+            changed_incidents.append(last_open_incident)
+
+        elif not outcome.response.status and not last_open_incident:
+            new_incident = Incident(
+                started_at=outcome.monitored_at,
+                ended_at=None,
+                monitor_id=outcome.probe_spec.id,
+                cause=outcome.response.incident_cause,
+                request=get_request_representation(outcome.probe_spec),
+                response=outcome.response.response_representation,
+            )
+            db.add(new_incident)
+            db.add(IncidentEvent(
+                incident=new_incident,
+                type=IncidentEventTypeEnum.monitoring_failure,
+                field=outcome.response.incident_cause,
+                extra_field=config.WORKER_ID,
+            ))
+            changed_incidents.append(new_incident)
+
+    db.commit()
+    return changed_incidents
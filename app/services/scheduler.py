@@ -0,0 +1,278 @@
+import json
+import math
+from dataclasses import asdict, dataclass, replace
+from datetime import datetime, timedelta
+from typing import Iterator
+
+import redis
+from sqlalchemy import Row
+from sqlalchemy.orm import Session
+
+from app import crud
+from app.core import config
+from app.db.redis import redis_client
+from app.services.monitoring import ProbeSpec
+
+
+@dataclass
+class DueMonitor:
+    id: int
+    periodicity: int
+    request_timeout: int
+    # scheduling fair share key: the team of the owner, or the owner when it has no team
+    tenant: str
+    critical: bool = False
+    probe_spec: ProbeSpec | None = None
+    # timestamp the check was due at, to measure the scheduling drift
+    due_at: float | None = None
+
+    @property
+    def phase(self) -> float:
+        return get_phase_offset(self.id, self.periodicity)
+
+    @classmethod
+    def from_row(cls, row: Row) -> 'DueMonitor':
+        return cls(
+            id=row.id,
+            periodicity=row.periodicity,
+            request_timeout=row.request_timeout,
+            tenant=f"team:{row.team_id}" if row.team_id else f"user:{row.owner_id}",
+            critical=row.critical,
+            probe_spec=ProbeSpec.from_monitor(row),
+            due_at=row.next_check_at.timestamp(),
+        )
+
+    def dumps(self) -> str:
+        probe_spec = self.probe_spec and self.probe_spec.without_credentials()
+        return json.dumps({**asdict(replace(self, probe_spec=probe_spec)), 'phase': self.phase})
+
+    @classmethod
+    def loads(cls, dumped: str) -> 'DueMonitor':
+        fields = json.loads(dumped)
+        del fields['phase']
+        if fields['probe_spec'] is not None:
+            fields['probe_spec'] = ProbeSpec(**fields['probe_spec'])
+        return cls(**fields)
+
+
+def get_phase_offset(monitor_id: int, periodicity: int) -> float:
+    """
+    Stable offset of a monitor inside its period. Multiplying by the golden ratio spreads
+    consecutive ids (monitors created together) evenly over the period.
+    """
+    return math.modf(monitor_id * 0.6180339887498949)[0] * periodicity
+
+
+def get_next_check_at(due_monitor: DueMonitor, now: datetime) -> datetime:
+    """ First instant after `now` matching the phase of the monitor """
+    timestamp = now.timestamp()
+    next_slot = math.floor((timestamp - due_monitor.phase) / due_monitor.periodicity) + 1
+    return datetime.fromtimestamp(next_slot * due_monitor.periodicity + due_monitor.phase)
+
+
+def iter_due_monitors(db: Session, now: datetime) -> Iterator[list[Row]]:
+    """
+    Yield pages of monitors due at `now`, walking the whole monitor table by id
+    so that no monitor is left behind regardless of the fleet size.
+    """
+    after_id = 0
+    while True:
+        page = crud.monitor.get_multi_due(
+            db, now=now, after_id=after_id, limit=config.SCHEDULE_TASK_PAGE_SIZE
+        )
+        if not page:
+            return
+
+        yield page
+
+        if len(page) < config.SCHEDULE_TASK_PAGE_SIZE:
+            return
+        after_id = page[-1].id
+
+
+class DatabaseScheduler:
+    """
+    Scheduler backed by the monitor.next_check_at column.
+
+    Due monitors are dispatched and rescheduled at their next phase slot. Checks missed for more than
+    SCHEDULER_MISSED_CHECK_GRACE_SECONDS (beat or workers down) are not fired at once but only
+    rescheduled, so after an outage the monitors ramp back up spread over their period.
+    """
+    def __init__(self, db: Session):
+        self.db = db
+
+    def schedule(self, due_monitor: DueMonitor, at: datetime):
+        crud.monitor.update_next_checks(self.db, next_checks={due_monitor.id: at})
+
+    def unschedule(self, monitor_id: int):
+        # nothing to do, the monitor row is already gone
+        pass
+
+    def iter_due(self, now: datetime) -> Iterator[list[DueMonitor]]:
+        missed_before = now - timedelta(seconds=config.SCHEDULER_MISSED_CHECK_GRACE_SECONDS)
+        for page in iter_due_monitors(self.db, now):
+            due_monitors = [DueMonitor.from_row(row) for row in page]
+            crud.monitor.update_next_checks(self.db, next_checks={
+                due_monitor.id: get_next_check_at(due_monitor, now) for due_monitor in due_monitors
+            })
+            yield [
+                due_monitor for due_monitor, row in zip(due_monitors, page)
+                if row.next_check_at >= missed_before
+            ]
+
+
+# Pops up to ARGV[2] members due at ARGV[1] and re-inserts them at their next phase slot.
+# Returns the number of members processed and the scheduling data and due time of the ones to dispatch,
+# leaving out the ones missed for more than ARGV[3] seconds (see DatabaseScheduler).
+# Members without scheduling data are stale (the monitor was deleted) and get dropped,
+# as well as the ones with a non positive periodicity, that have no next slot.
+POP_DUE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local missed_before = now - tonumber(ARGV[3])
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now, 'WITHSCORES', 'LIMIT', 0, tonumber(ARGV[2]))
+local popped = {}
+for i = 1, #due, 2 do
+    local member = due[i]
+    local due_monitor = redis.call('HGET', KEYS[2], member)
+    local decoded = due_monitor and cjson.decode(due_monitor)
+    if decoded and tonumber(decoded['periodicity']) > 0 then
+        local next_slot = math.floor((now - decoded['phase']) / decoded['periodicity']) + 1
+        redis.call('ZADD', KEYS[1], next_slot * decoded['periodicity'] + decoded['phase'], member)
+        if tonumber(due[i + 1]) >= missed_before then
+            table.insert(popped, due_monitor)
+            table.insert(popped, due[i + 1])
+        end
+    else
+        redis.call('ZREM', KEYS[1], member)
+        redis.call('HDEL', KEYS[2], member)
+    end
+end
+return {#due / 2, popped}
+"""
+
+
+class RedisScheduler:
+    """
+    Scheduler keeping the next check timestamp of every monitor in Redis sorted sets.
+
+    Monitors are split in shards by id, every shard being popped atomically by a lua script,
+    so several scheduler processes can work on the same shards (or on different ones) at once.
+    The shard is loaded from the database when missing and reloaded every
+    SCHEDULER_RELOAD_SECONDS to pick up the changes on the monitor table.
+    """
+    def __init__(self, db: Session, client: redis.Redis, shard: int = 0, num_shards: int = 1):
+        self.db = db
+        self.client = client
+        self.shard = shard
+        self.num_shards = num_shards
+        self._pop_due = client.register_script(POP_DUE_SCRIPT)
+
+    # the shard number is used as hash tag, so all the keys of a shard live in the same cluster slot
+    def _due_key(self, shard: int) -> str:
+        return f"scheduler:{{{shard}}}:due"
+
+    def _monitors_key(self, shard: int) -> str:
+        return f"scheduler:{{{shard}}}:monitors"
+
+    def _loaded_key(self, shard: int) -> str:
+        return f"scheduler:{{{shard}}}:loaded"
+
+    def shard_of(self, monitor_id: int) -> int:
+        return monitor_id % self.num_shards
+
+    def schedule(self, due_monitor: DueMonitor, at: datetime):
+        shard = self.shard_of(due_monitor.id)
+        pipeline = self.client.pipeline()
+        pipeline.hset(self._monitors_key(shard), due_monitor.id, due_monitor.dumps())
+        pipeline.zadd(self._due_key(shard), {due_monitor.id: at.timestamp()})
+        pipeline.execute()
+
+    def unschedule(self, monitor_id: int):
+        shard = self.shard_of(monitor_id)
+        pipeline = self.client.pipeline()
+        pipeline.hdel(self._monitors_key(shard), monitor_id)
+        pipeline.zrem(self._due_key(shard), monitor_id)
+        pipeline.execute()
+
+    def load(self):
+        """
+        Load the shard from the monitor table, keeping the due times already scheduled,
+        and prune the monitors deleted without their change being applied
+        """
+        if not self.client.set(self._loaded_key(self.shard), 1, nx=True, ex=config.SCHEDULER_RELOAD_SECONDS):
+            return
+
+        after_id = 0
+        while True:
+            page = crud.monitor.get_multi_by_shard(
+                self.db,
+                shard=self.shard,
+                num_shards=self.num_shards,
+                after_id=after_id,
+                limit=config.SCHEDULE_TASK_PAGE_SIZE,
+            )
+            if not page:
+                break
+
+            pipeline = self.client.pipeline()
+            pipeline.hset(self._monitors_key(self.shard), mapping={
+                row.id: DueMonitor.from_row(row).dumps() for row in page
+            })
+            pipeline.zadd(self._due_key(self.shard), {row.id: row.next_check_at.timestamp() for row in page}, nx=True)
+            pipeline.execute()
+
+            if len(page) < config.SCHEDULE_TASK_PAGE_SIZE:
+                break
+            after_id = page[-1].id
+
+        self.prune()
+
+    def prune(self):
+        """ Remove the monitors of the shard that are no longer in the monitor table """
+        scheduled_ids = [int(monitor_id) for monitor_id in self.client.hkeys(self._monitors_key(self.shard))]
+        for i in range(0, len(scheduled_ids), config.SCHEDULE_TASK_PAGE_SIZE):
+            page_ids = scheduled_ids[i:i + config.SCHEDULE_TASK_PAGE_SIZE]
+            stale_ids = set(page_ids) - crud.monitor.get_existing_ids(self.db, monitor_ids=page_ids)
+            if stale_ids:
+                pipeline = self.client.pipeline()
+                pipeline.hdel(self._monitors_key(self.shard), *stale_ids)
+                pipeline.zrem(self._due_key(self.shard), *stale_ids)
+                pipeline.execute()
+
+    def iter_due(self, now: datetime) -> Iterator[list[DueMonitor]]:
+        self.load()
+        while True:
+            processed, popped = self._pop_due(
+                keys=[self._due_key(self.shard), self._monitors_key(self.shard)],
+                args=[now.timestamp(), config.SCHEDULE_TASK_PAGE_SIZE, config.SCHEDULER_MISSED_CHECK_GRACE_SECONDS],
+            )
+            yield [
+                replace(DueMonitor.loads(due_monitor), due_at=float(due_at))
+                for due_monitor, due_at in zip(popped[::2], popped[1::2])
+            ]
+
+            if processed < config.SCHEDULE_TASK_PAGE_SIZE:
+                return
+
+
+def apply_monitor_change(
+    db: Session, scheduler: DatabaseScheduler | RedisScheduler, monitor_id: int, action: str, now: datetime
+):
+    """
+    Update the scheduler after a monitor insert, update, resume or delete. New and updated monitors are checked
+    right away, resumed ones (possibly thousands at once) at their next phase slot. Paused monitors are unscheduled.
+    """
+    scheduling_data = crud.monitor.get_scheduling_data(db, monitor_id) if action != 'delete' else None
+    if scheduling_data is None:
+        scheduler.unschedule(monitor_id)
+        return
+
+    due_monitor = DueMonitor.from_row(scheduling_data)
+    scheduler.schedule(due_monitor, get_next_check_at(due_monitor, now) if action == 'resume' else now)
+
+
+def get_scheduler(db: Session, shard: int = 0) -> DatabaseScheduler | RedisScheduler:
+    if config.SCHEDULER_BACKEND == 'redis':
+        return RedisScheduler(db, redis_client, shard=shard, num_shards=config.SCHEDULER_SHARDS)
+
+    return DatabaseScheduler(db)
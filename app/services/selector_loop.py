@@ -0,0 +1,103 @@
+import heapq
+import itertools
+import os
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+from typing import Callable
+
+
+class SelectorLoop:
+    """
+    Base of the probe engines multiplexing many sockets in one thread: a selectors (epoll) loop with timers,
+    started on the first call of the process, so every forked worker gets its own.
+    Other threads hand work over to the loop with `call_soon_threadsafe`, everything else runs in the loop thread.
+    """
+
+    name = 'selector-loop'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _setup(self):
+        """ Open and register the sockets the loop always listens to, runs in the calling thread """
+
+    def _start(self):
+        if self._pid == os.getpid():
+            return
+
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_receiver, self._wakeup_sender = socket.socketpair()
+        self._wakeup_receiver.setblocking(False)
+        self._wakeup_sender.setblocking(False)
+        self._selector.register(self._wakeup_receiver, selectors.EVENT_READ, self._take_submitted)
+        self._submitted: deque[tuple[Callable, tuple]] = deque()
+        # (at, tie breaker, callback, args)
+        self._timers: list[tuple[float, int, Callable, tuple]] = []
+        self._counter = itertools.count()
+        try:
+            self._setup()
+        except OSError:
+            self._selector.close()
+            self._wakeup_receiver.close()
+            self._wakeup_sender.close()
+            raise
+
+        threading.Thread(target=self._run, name=self.name, daemon=True).start()
+        self._pid = os.getpid()
+
+    def call_soon_threadsafe(self, callback: Callable, *args):
+        with self._lock:
+            self._start()
+            self._submitted.append((callback, args))
+        try:
+            self._wakeup_sender.send(b'\0')
+        except BlockingIOError:
+            # already woken up
+            pass
+
+    def call_at(self, at: float, callback: Callable, *args):
+        heapq.heappush(self._timers, (at, next(self._counter), callback, args))
+
+    def register(self, fileobj, events: int, callback: Callable):
+        """ Call `callback(fileobj, mask)` whenever `fileobj` is ready, until unregistered """
+        self._selector.register(fileobj, events, callback)
+
+    def modify(self, fileobj, events: int, callback: Callable):
+        self._selector.modify(fileobj, events, callback)
+
+    def unregister(self, fileobj):
+        self._selector.unregister(fileobj)
+
+    def _run(self):
+        while True:
+            now = time.monotonic()
+            while self._timers and self._timers[0][0] <= now:
+                _, _, callback, args = heapq.heappop(self._timers)
+                self._call(callback, *args)
+
+            timeout = max(self._timers[0][0] - time.monotonic(), 0) if self._timers else None
+            for key, mask in self._selector.select(timeout):
+                self._call(key.data, key.fileobj, mask)
+
+    def _call(self, callback: Callable, *args):
+        try:
+            callback(*args)
+        except Exception as exception:
+            # the loop serves every probe of the process, it must keep running
+            print(f"* Error in {self.name}: {exception!r}")
+
+    def _take_submitted(self, wakeup_receiver: socket.socket, mask: int):
+        try:
+            while wakeup_receiver.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        with self._lock:
+            submitted, self._submitted = self._submitted, deque()
+        for callback, args in submitted:
+            self._call(callback, *args)
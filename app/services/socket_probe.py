@@ -0,0 +1,186 @@
+"""
+TCP and UDP probe engine: the sockets of all the tcp and udp probes of a worker process multiplexed
+in one selectors (epoll) thread, whether they are run by the probe threads or by the asyncio engine.
+"""
+import errno
+import functools
+import os
+import selectors
+import socket
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Callable
+
+from app.core import config
+from app.services.selector_loop import SelectorLoop
+
+
+@dataclass
+class SocketResult:
+    # received bytes, at most `max_bytes` of them
+    response: bytes = b''
+    # incident cause when the probe failed
+    error: str | None = None
+    connect_time: float | None = None
+    # from connected (and the data sent) to the first byte received
+    ttfb: float | None = None
+    elapsed: float = 0
+
+
+class _SocketProbe:
+    def __init__(
+        self, address: str, port: int, kind: socket.SocketKind, mode: str, data: bytes, timeout: float,
+        max_bytes: int, feed: Callable[[bytes], bool] | None,
+    ):
+        self.address = address
+        self.port = port
+        self.kind = kind
+        self.mode = mode
+        self.to_send = data
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.feed = feed
+        self.result = SocketResult()
+        self.future: Future[SocketResult] = Future()
+        self.socket = None
+        self.watched = False
+        self.started_at = 0.0
+        self.connected_at = 0.0
+
+
+def _error_cause(error: int) -> str:
+    if error == errno.ECONNREFUSED:
+        return 'Connection refused'
+    return os.strerror(error)
+
+
+class SocketProber(SelectorLoop):
+    """
+    Runs the socket probes submitted from any thread or event loop in one selectors loop. A probe either:
+
+    - `connect`s: succeeds once the TCP handshake is done, for services never sending anything first
+    - `expect`s: sends the data, if any, then reads until `feed` returns True (after the first chunk without it),
+      the peer closes the connection or `max_bytes` were received. On timeout, what was received so far is kept
+    - `request`s: sends one UDP datagram and waits for the first datagram answered
+
+    Connects over IPv6 to IPv6 addresses.
+
+        socket_result = socket_prober.submit('192.0.2.1', 22, socket.SOCK_STREAM, 'expect', b'', 5, 1024).result()
+    """
+
+    name = 'socket-prober'
+
+    def submit(
+        self, address: str, port: int, kind: socket.SocketKind, mode: str, data: bytes, timeout: float,
+        max_bytes: int, feed: Callable[[bytes], bool] | None = None,
+    ) -> Future:
+        """ Future getting the SocketResult of the probe. `feed` is called from the loop thread """
+        probe = _SocketProbe(address, port, kind, mode, data, timeout, max_bytes, feed)
+        self.call_soon_threadsafe(self._open, probe)
+        return probe.future
+
+    def _watch(self, probe: _SocketProbe, events: int, callback: Callable):
+        callback = functools.partial(callback, probe)
+        if probe.watched:
+            self.modify(probe.socket, events, callback)
+        else:
+            self.register(probe.socket, events, callback)
+            probe.watched = True
+
+    def _open(self, probe: _SocketProbe):
+        probe.started_at = time.monotonic()
+        self.call_at(probe.started_at + probe.timeout, self._expire, probe)
+        family = socket.AF_INET6 if ':' in probe.address else socket.AF_INET
+        try:
+            probe.socket = socket.socket(family, probe.kind)
+            probe.socket.setblocking(False)
+            error = probe.socket.connect_ex((probe.address, probe.port))
+        except OSError as exception:
+            self._finish(probe, exception.strerror or str(exception))
+            return
+
+        if error in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self._watch(probe, selectors.EVENT_WRITE, self._on_connect)
+        elif error:
+            self._finish(probe, _error_cause(error))
+        else:
+            # udp sockets connect right away
+            self._connected(probe)
+
+    def _on_connect(self, probe: _SocketProbe, sock: socket.socket, mask: int):
+        error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self._finish(probe, _error_cause(error))
+        else:
+            self._connected(probe)
+
+    def _connected(self, probe: _SocketProbe):
+        probe.connected_at = time.monotonic()
+        probe.result.connect_time = probe.connected_at - probe.started_at
+        if probe.mode == 'connect':
+            self._finish(probe)
+        else:
+            self._send(probe)
+
+    def _send(self, probe: _SocketProbe):
+        while probe.to_send:
+            try:
+                sent = probe.socket.send(probe.to_send)
+            except BlockingIOError:
+                self._watch(probe, selectors.EVENT_WRITE, self._on_writable)
+                return
+            except OSError as exception:
+                self._finish(probe, _error_cause(exception.errno))
+                return
+            probe.to_send = probe.to_send[sent:]
+        self._watch(probe, selectors.EVENT_READ, self._on_readable)
+
+    def _on_writable(self, probe: _SocketProbe, sock: socket.socket, mask: int):
+        self._send(probe)
+
+    def _on_readable(self, probe: _SocketProbe, sock: socket.socket, mask: int):
+        result = probe.result
+        while True:
+            try:
+                chunk = sock.recv(min(config.SOCKET_CHUNK_BYTES, probe.max_bytes - len(result.response)))
+            except BlockingIOError:
+                return
+            except OSError as exception:
+                # a connection reset after some bytes were received still answered
+                self._finish(probe, None if result.response else _error_cause(exception.errno))
+                return
+
+            if not chunk:
+                self._finish(probe)
+                return
+            if result.ttfb is None:
+                result.ttfb = time.monotonic() - probe.connected_at
+            result.response += chunk
+            if (
+                probe.feed is None
+                or probe.feed(chunk)
+                or probe.kind == socket.SOCK_DGRAM
+                or len(result.response) >= probe.max_bytes
+            ):
+                self._finish(probe)
+                return
+
+    def _expire(self, probe: _SocketProbe):
+        if not probe.future.done():
+            self._finish(probe, None if probe.result.response else 'Timeout')
+
+    def _finish(self, probe: _SocketProbe, error: str | None = None):
+        if probe.future.done():
+            return
+
+        if probe.socket is not None:
+            if probe.watched:
+                self.unregister(probe.socket)
+            probe.socket.close()
+        probe.result.error = error
+        probe.result.elapsed = time.monotonic() - probe.started_at
+        probe.future.set_result(probe.result)
+
+
+socket_prober = SocketProber()
@@ -1,116 +1,291 @@
-from datetime import datetime, timedelta
+import asyncio
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, replace
+from datetime import datetime
 
 import requests
 import sentry_sdk
-from celery import Celery
+from celery import Celery, group
 from sendgrid import SendGridAPIClient
 from sentry_sdk.integrations.celery import CeleryIntegration
 
 from app import crud
-from app import schemas
 from app.core import config
 from app.db.session import SessionLocal
+from app.services.async_monitoring import ProbeEngineThread, hold_probe_host as async_hold_probe_host
+from app.services.backpressure import (
+    get_queue_status, get_queued_monitor_ids, mark_queued, record_consumer_lag, record_publish_seconds, unmark_queued
+)
+from app.services.coalescing import group_by_request
 from app.services.email import SendUserEmailVerificationEmail, SendInvitationEmail
+from app.services.fairshare import FairShareQueue, add_tenant_usage, get_tenant_usage
+from app.services.freshness import record_fleet_drifts
 from app.services.incident import send_incident_alerts
-from app.services.monitoring import check_monitor
+from app.services.lanes import prune_probe_seconds, record_probe_seconds, split_by_lane
+from app.services.lease import (
+    acquire_monitor_leases, get_lease_ttl_seconds, get_leased_monitor_ids, release_monitor_leases
+)
+from app.services.monitoring import ProbeSpec, hold_probe_host, probe_monitor_group
+from app.services.outcome import MonitorOutcome, record_outcomes
+from app.services.scheduler import get_scheduler
 
 
 celery_app = Celery('celery', broker=config.CELERY_BROKER)
 
 sentry_sdk.init(integrations=[CeleryIntegration()])
 
+# asyncio probe engine of the worker process, shared by all its batches
+probe_engine_thread = ProbeEngineThread(concurrency=config.PROBE_ENGINE_CONCURRENCY)
+
 
 @celery_app.task
-def schedule_task():
-    def should_monitor(db_last_result, monitoring_periodicity_seconds):
-        if db_last_result is None:
-            return True
+def schedule_task(shard=0):
+    """
+    Dispatch the due monitors of a shard. Without backpressure every due monitor is dispatched (up to the tenant
+    budgets) page by page as the scheduler streams them. Under backpressure the capacity left is shared fairly
+    between the tenants of the whole due set, queued at most `capacity` monitors per tenant.
+    """
+    db = SessionLocal()
+    now = datetime.now()
+    scheduler = get_scheduler(db, shard)
+    queue_status = get_queue_status()
 
-        next_monitoring_instant = db_last_result.created_at + timedelta(seconds=monitoring_periodicity_seconds)
-        return next_monitoring_instant <= datetime.now()
+    fair_share_queue = FairShareQueue(max_per_tenant=queue_status.capacity)
+    num_busy = num_dispatched = num_skipped = 0
+    publish_seconds = 0.0
+    for due_monitors in scheduler.iter_due(now):
+        # monitors still queued or being probed from the previous period are not dispatched again
+        due_monitor_ids = [due_monitor.id for due_monitor in due_monitors]
+        busy_monitor_ids = get_leased_monitor_ids(due_monitor_ids) | get_queued_monitor_ids(due_monitor_ids)
+        for due_monitor in due_monitors:
+            if due_monitor.id in busy_monitor_ids:
+                num_busy += 1
+            elif not fair_share_queue.push(due_monitor):
+                num_skipped += 1
 
-    db = SessionLocal()
+        if queue_status.capacity is None:
+            dispatched, seconds = _dispatch(fair_share_queue, None, now)
+            num_dispatched, publish_seconds = num_dispatched + dispatched, publish_seconds + seconds
+            num_skipped += len(fair_share_queue)
+            fair_share_queue = FairShareQueue()
 
-    db_monitors = crud.monitor.get_multi(db)
-    for monitor in db_monitors:
-        db_last_result = crud.result.get_last_by_monitor(db, monitor.id)
-        if should_monitor(db_last_result, monitor.periodicity):
-            monitor_task.apply_async(args=[monitor.id])
+    if queue_status.capacity is not None:
+        num_dispatched, publish_seconds = _dispatch(fair_share_queue, queue_status.capacity, now)
+        num_skipped += len(fair_share_queue)
 
+    if num_dispatched:
+        record_publish_seconds(publish_seconds)
+        print(f"* Dispatched {num_dispatched} monitors on shard={shard} in {publish_seconds * 1000:.1f}ms")
+    if queue_status.degraded or num_skipped:
+        print(
+            f"* Scheduler degraded on shard={shard}: queue depth={queue_status.depth}, "
+            f"consumer lag={queue_status.consumer_lag:.1f}s, last publish={queue_status.publish_seconds * 1000:.1f}ms, "
+            f"dispatched={num_dispatched}, busy={num_busy}, skipped={num_skipped}"
+        )
+
+    prune_probe_seconds(db)
     db.close()
 
 
+def _dispatch(fair_share_queue, capacity, now):
+    """ Drain the fair share queue up to `capacity` and publish, returning the monitors dispatched and the time it took """
+    dispatched_monitors = list(fair_share_queue.drain(
+        capacity=capacity,
+        usage=get_tenant_usage(list(fair_share_queue.queues), now),
+        budget=config.TENANT_CHECKS_PER_MINUTE,
+    ))
+    if not dispatched_monitors:
+        return 0, 0.0
+
+    # marked before publishing, a fast worker could otherwise unmark before the mark is set
+    mark_queued([due_monitor.id for due_monitor in dispatched_monitors], config.SCHEDULER_QUEUED_MARK_SECONDS)
+    publish_seconds = _publish_monitor_tasks(dispatched_monitors)
+    add_tenant_usage(Counter(due_monitor.tenant for due_monitor in dispatched_monitors), now)
+    return len(dispatched_monitors), publish_seconds
+
+
+def _publish_monitor_tasks(due_monitors):
+    """
+    Publish the probes to the queue of their lane, in batches of MONITOR_BATCH_SIZE monitors,
+    as a single group through one broker connection, returning the time it took
+    """
+    enqueued_at = time.time()
+    batch_tasks = []
+    for lane, lane_monitors in split_by_lane(due_monitors).items():
+        # monitors making the same request end up next to each other, in the same batch to share their probe,
+        # keeping the fair share order of the drain otherwise
+        lane_monitors = [
+            due_monitor
+            for same_request in group_by_request(lane_monitors, lambda due_monitor: due_monitor.probe_spec)
+            for due_monitor in same_request
+        ]
+        for i in range(0, len(lane_monitors), config.MONITOR_BATCH_SIZE):
+            batch_tasks.append(monitor_batch_task.signature(
+                args=[[
+                    asdict(due_monitor.probe_spec.without_credentials())
+                    for due_monitor in lane_monitors[i:i + config.MONITOR_BATCH_SIZE]
+                ]],
+                kwargs={
+                    'enqueued_at': enqueued_at,
+                    'due_ats': [due_monitor.due_at for due_monitor in lane_monitors[i:i + config.MONITOR_BATCH_SIZE]],
+                },
+                queue=config.PROBE_QUEUES[lane],
+            ))
+
+    start = time.perf_counter()
+    with celery_app.producer_or_acquire() as producer:
+        group(batch_tasks).apply_async(producer=producer)
+    return time.perf_counter() - start
+
+
 @celery_app.task
-def monitor_task(monitor_id):
+def monitor_task(monitor_id, request_timeout=None, enqueued_at=None):
+    """ Probe a single monitor reading its config from the database """
     db = SessionLocal()
-    print(f"* Monitoring monitor_id={monitor_id}")
     db_monitor = crud.monitor.get(db, monitor_id)
+    db.close()
+    if db_monitor is None:
+        return
+
+    _monitor_batch([ProbeSpec.from_monitor(db_monitor)], enqueued_at)
+
+
+@celery_app.task
+def monitor_batch_task(probe_specs, enqueued_at=None, due_ats=None):
+    """
+    Probe a batch of monitors given their probe specs, touching the database only to record the outcomes.
+    `due_ats` are the timestamps every check was due at, to measure the scheduling drift.
+    """
+    _monitor_batch([ProbeSpec(**probe_spec) for probe_spec in probe_specs], enqueued_at, due_ats)
 
-    # TODO has no sense to have both created_at and monitored_at at same moment
-    result = schemas.ResultCreate(
-        created_at=datetime.now(),
-        monitored_at=datetime.now(),
-        response_time=None,
-        status=None,
-        monitor_id=monitor_id,
-    )
-    db_result = crud.result.create(db, obj_in=result)
 
-    monit_response = check_monitor(db_monitor)
+def _monitor_batch(probe_specs, enqueued_at, due_ats=None):
+    monitor_ids = [probe_spec.id for probe_spec in probe_specs]
+    unmark_queued(monitor_ids)
+    if enqueued_at:
+        record_consumer_lag(time.time() - enqueued_at)
 
-    updated_result = schemas.ResultUpdate(
-        created_at=db_result.created_at,
-        monitored_at=db_result.monitored_at,
-        response_time=monit_response.response_time,
-        status=monit_response.status,
-        monitor_id=db_result.monitor_id,
+    # drop duplicated deliveries before touching the database
+    lease_tokens = acquire_monitor_leases(
+        monitor_ids,
+        get_lease_ttl_seconds([probe_spec.request_timeout for probe_spec in probe_specs], config.MONITOR_BATCH_CONCURRENCY),
     )
-    db_result = crud.result.update(db, db_obj=db_result, obj_in=updated_result)
-
-    # search for last open incident
-    last_open_incident = crud.incident.get_last_open_by_monitor(db, monitor_id)
-    if monit_response.status:
-        if last_open_incident:
-            # set ended at
-            updated_incident = schemas.IncidentUpdate(
-                started_at=last_open_incident.started_at,
-                ended_at=db_result.monitored_at,
-                monitor_id=last_open_incident.monitor_id,
-                cause=last_open_incident.cause,
-                response=last_open_incident.response,
-                request=last_open_incident.request,
-            )
-            db_incident = crud.incident.update(db, db_obj=last_open_incident, obj_in=updated_incident)
-            crud.incident_event.create(db, obj_in=schemas.IncidentEventCreate(
-                incident_id=db_incident.id,
-                type=schemas.IncidentEventTypeEnum.monitoring_success,
-                field=monit_response.status,
-                extra_field=config.WORKER_ID,
-            ))
-            send_incident_alerts(db, db_incident)
+    for monitor_id in monitor_ids:
+        if monitor_id not in lease_tokens:
+            print(f"* Skipping monitor_id={monitor_id}, already being monitored")
+    if not lease_tokens:
+        return
 
-    else:
-        if not last_open_incident:
-            request_repr = f"{db_monitor.http_method if db_monitor.monitor_type == 'http' else db_monitor.monitor_type} {db_monitor.endpoint}"
-            if db_monitor.monitor_type in ('tcp', 'udp'):
-                request_repr += f":{db_monitor.port}"
-            new_incident = schemas.IncidentCreate(
-                started_at=db_result.monitored_at,
-                ended_at=None,
-                monitor_id=db_result.monitor_id,
-                cause=monit_response.incident_cause,
-                request=request_repr,
-                response=monit_response.response_representation,
+    timeline = {
+        probe_spec.id: (
+            datetime.fromtimestamp(due_at) if due_at else None,
+            datetime.fromtimestamp(enqueued_at) if enqueued_at else None,
+        )
+        for probe_spec, due_at in zip(probe_specs, due_ats or [None] * len(probe_specs))
+    }
+    try:
+        _monitor(_with_credentials([probe_spec for probe_spec in probe_specs if probe_spec.id in lease_tokens]), timeline)
+    finally:
+        release_monitor_leases(lease_tokens)
+
+
+def _with_credentials(probe_specs):
+    """ The specs with the credentials left out of the task payload, read back for the monitors having them """
+    monitor_ids = [probe_spec.id for probe_spec in probe_specs if probe_spec.auth_user]
+    if not monitor_ids:
+        return probe_specs
+
+    db = SessionLocal()
+    auth_passes = crud.monitor.get_auth_passes(db, monitor_ids=monitor_ids)
+    db.close()
+    return [
+        replace(probe_spec, auth_pass=auth_passes.get(probe_spec.id)) if probe_spec.auth_user else probe_spec
+        for probe_spec in probe_specs
+    ]
+
+
+def _check(probe_specs, timeline):
+    """
+    Probe monitors making the same request once, returning the outcome of every one of them.
+    The probe is timed once the host slot is held, the wait for the host limits is not part of it.
+    """
+    start = None
+    try:
+        with hold_probe_host(probe_specs[0]):
+            monitored_at = datetime.now()
+            start = time.monotonic()
+            monit_responses = probe_monitor_group(probe_specs)
+            probe_seconds = time.monotonic() - start
+    except Exception as exception:
+        return _check_failed(probe_specs, exception, time.monotonic() - start if start is not None else None)
+    return _fan_out(probe_specs, timeline, monitored_at, monit_responses, probe_seconds)
+
+
+async def _async_check(probe_engine, probe_specs, timeline):
+    start = None
+    try:
+        async with async_hold_probe_host(probe_specs[0]):
+            monitored_at = datetime.now()
+            start = time.monotonic()
+            monit_responses = await probe_engine.probe_group(probe_specs)
+            probe_seconds = time.monotonic() - start
+    except Exception as exception:
+        return _check_failed(probe_specs, exception, time.monotonic() - start if start is not None else None)
+    return _fan_out(probe_specs, timeline, monitored_at, monit_responses, probe_seconds)
+
+
+def _fan_out(probe_specs, timeline, monitored_at, monit_responses, probe_seconds):
+    return [
+        MonitorOutcome(probe_spec, monitored_at, monit_response, probe_seconds, *timeline[probe_spec.id])
+        for probe_spec, monit_response in zip(probe_specs, monit_responses)
+    ]
+
+
+def _check_failed(probe_specs, exception, probe_seconds=None):
+    # a failing probe should not lose the outcomes of the rest of the batch
+    print(f"* Error monitoring monitor_ids={[probe_spec.id for probe_spec in probe_specs]}: {exception!r}")
+    sentry_sdk.capture_exception(exception)
+    # recorded all the same, monitors whose probes fail slowly belong on the slow lane
+    if probe_seconds is not None:
+        record_probe_seconds({probe_spec.id: probe_seconds for probe_spec in probe_specs})
+    return []
+
+
+async def _async_checks(probe_engine, groups, timeline):
+    return await asyncio.gather(*[_async_check(probe_engine, group, timeline) for group in groups])
+
+
+def _monitor(probe_specs, timeline):
+    """ `timeline` has the (due_at, enqueued_at) of every monitor """
+    print(f"* Monitoring monitor_ids={[probe_spec.id for probe_spec in probe_specs]}")
+    # monitors making the same request share a single probe
+    groups = group_by_request(probe_specs)
+    if config.PROBE_ENGINE == 'asyncio':
+        # the probes time out by themselves long before, unless the loop of the process is stuck
+        timeout = get_lease_ttl_seconds(
+            [probe_spec.request_timeout for probe_spec in probe_specs], config.MONITOR_BATCH_CONCURRENCY
+        )
+        try:
+            checked = probe_engine_thread.run(
+                lambda probe_engine: _async_checks(probe_engine, groups, timeline), timeout=timeout
             )
-            db_incident = crud.incident.create(db, obj_in=new_incident)
-            crud.incident_event.create(db, obj_in=schemas.IncidentEventCreate(
-                incident_id=db_incident.id,
-                type=schemas.IncidentEventTypeEnum.monitoring_failure,
-                field=monit_response.incident_cause,
-                extra_field=config.WORKER_ID,
-            ))
-            send_incident_alerts(db, db_incident)
+        except TimeoutError as exception:
+            checked = [_check_failed(probe_specs, exception, timeout)]
+    else:
+        with ThreadPoolExecutor(max_workers=config.MONITOR_BATCH_CONCURRENCY) as executor:
+            checked = list(executor.map(lambda group: _check(group, timeline), groups))
+    outcomes = [outcome for group_outcomes in checked for outcome in group_outcomes]
+    record_probe_seconds({outcome.probe_spec.id: outcome.probe_seconds for outcome in outcomes})
+    record_fleet_drifts(
+        [(outcome.monitored_at - outcome.due_at).total_seconds() for outcome in outcomes if outcome.due_at],
+        datetime.now(),
+    )
 
+    db = SessionLocal()
+    for db_incident in record_outcomes(db, outcomes):
+        send_incident_alerts(db, db_incident)
     db.close()
 
 
@@ -154,9 +329,16 @@ def send_telegram_message(text, chat_id):
     print(response)
 
 
+# single monitor probes, from before the batched probe lanes
+celery_app.conf.task_routes = {
+    'app.tasks.monitor_task': {'queue': config.PROBE_QUEUES['fast']},
+}
+
 celery_app.conf.beat_schedule = {
-    "schedule-task": {
+    f"schedule-task-{shard}": {
         "task": "app.tasks.schedule_task",
         "schedule": config.SCHEDULE_TASK_PERIODICITY_SECONDS,
+        "args": [shard],
     }
+    for shard in range(config.SCHEDULER_SHARDS if config.SCHEDULER_BACKEND == 'redis' else 1)
 }
@@ -1,4 +1,5 @@
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 
 import pytest
 from fastapi.testclient import TestClient
@@ -7,7 +8,7 @@ from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import StaticPool
 from unittest.mock import patch
 
-from app import crud, schemas
+from app import crud, models, schemas
 from app.db.base_class import Base
 from app.main import app
 from app.api.deps import get_db
@@ -42,18 +43,25 @@ def _add_default_values(monitor):
         "auth_pass": None,
         "auth_user": None,
         "keyword": None,
+        "keywords": None,
+        "keyword_regexes": None,
+        "keyword_match": "any",
         'periodicity': 120,
         'http_method': 'GET',
         'request_body': None,
         'request_headers': None,
         'request_timeout': 30,
+        'active': True,
+        'critical': False,
         'follow_redirects': True,
         'keep_cookies_between_redirects': True,
+        'fresh_connection': False,
         'verify_ssl': True,
         'ssl_check_expiration': 0,
         'num_pings': 4,
         'port': None,
         'data': None,
+        'socket_mode': None,
         'recovery_period': 0,
         'confirmation_period': 0,
         'send_email': True,
@@ -148,6 +156,19 @@ def test_create_monitor_unknown_alert_type(setup_access_token):
     }
 
 
+def test_create_monitor_non_positive_periodicity(setup_access_token):
+    for field in ('periodicity', 'request_timeout'):
+        response = client.post(
+            "/monitors",
+            json={"endpoint": "https://www.test.com", "name": "Name", field: 0},
+            headers={
+                "Authorization": f"Bearer {setup_access_token}"
+            }
+        )
+        assert response.status_code == 422
+        assert response.json()['detail'][0]['loc'] == ['body', field]
+
+
 def test_create_monitor_fails_if_keyword_not_specified(setup_access_token):
     response = client.post(
         "/monitors",
@@ -289,6 +310,48 @@ def test_get_monitor(setup_access_token):
 # TODO test get monitor detail of a monitor not owner by current user
 
 
+def test_update_monitor_validates_regexes_and_socket_mode(setup_access_token):
+    headers = {"Authorization": f"Bearer {setup_access_token}"}
+    response = client.post(
+        "/monitors", json={"name": "Test Monit", "endpoint": "127.0.0.1", "monitor_type": "tcp", "port": 22}, headers=headers
+    )
+    monitor_id = response.json()['id']
+
+    for changes, loc in (
+        ({"alert_type": "contains_keyword", "keyword_regexes": ["(a+)+b"]}, 'keyword_regexes'),
+        ({"alert_type": "contains_keyword", "keyword_regexes": ["("]}, 'keyword_regexes'),
+        ({"socket_mode": "request"}, 'socket_mode'),
+    ):
+        response = client.put(f"/monitors/{monitor_id}", json=changes, headers=headers)
+        assert response.status_code == 422
+        assert response.json()['detail'][0]['loc'] == ['body', loc]
+
+    response = client.put(f"/monitors/{monitor_id}", json={"socket_mode": "expect"}, headers=headers)
+    assert response.status_code == 200
+
+
+def test_only_superusers_set_critical(setup_access_token):
+    headers = {"Authorization": f"Bearer {setup_access_token}"}
+    response = client.post(
+        "/monitors", json={"name": "Test Monit", "endpoint": "http://google.com", "critical": True}, headers=headers
+    )
+    assert response.status_code == 403
+
+    response = client.post(
+        "/monitors", json={"name": "Test Monit", "endpoint": "http://google.com", "critical": False}, headers=headers
+    )
+    assert response.status_code == 201
+    monitor_id = response.json()['id']
+    assert client.put(f"/monitors/{monitor_id}", json={"critical": True}, headers=headers).status_code == 403
+    assert client.put(f"/monitors/{monitor_id}", json={"critical": False}, headers=headers).status_code == 200
+
+    db = next(override_get_db())
+    crud.user.update(db, db_obj=crud.user.get_by_email(db, email=SETUP_USER_EMAIL), obj_in={'is_superuser': True})
+    db.close()
+    response = client.put(f"/monitors/{monitor_id}", json={"critical": True}, headers=headers)
+    assert response.status_code == 200 and response.json()['critical']
+
+
 def test_get_monitor_results_filter_bad_format(setup_access_token):
     _ = client.post(
         "/monitors",
@@ -336,6 +399,7 @@ def test_get_monitor_results(setup_access_token):
         response_time=0,
         status=False,
         monitor_id=monitor_id,
+        timings={'dns': 0.001, 'connect': 0.02},
     )
     db_result = crud.result.create(db, obj_in=result_obj)
 
@@ -351,6 +415,7 @@ def test_get_monitor_results(setup_access_token):
         'monitored_at':  datetime(2020, 1, 1, 12, 1, 0).isoformat(),
         'response_time': 0,
         'status': False,
+        'timings': {'dns': 0.001, 'connect': 0.02},
     }]
 
 
@@ -398,9 +463,54 @@ def test_get_monitor_results_since(setup_access_token):
         'monitored_at': datetime(2020, 1, 1, 12, 0, 0).isoformat(),
         'response_time': 1,
         'status': True,
+        'timings': None,
     }]
 
 
+def test_pause_and_resume_monitors(setup_access_token):
+    for name in ('Test 1', 'Test 2'):
+        client.post(
+            "/monitors",
+            json={"endpoint": "https://www.test.com", "name": name},
+            headers={"Authorization": f"Bearer {setup_access_token}"}
+        )
+
+    response = client.post(
+        "/monitors/pause",
+        json={"monitor_ids": [2]},
+        headers={"Authorization": f"Bearer {setup_access_token}"}
+    )
+    assert response.status_code == 200
+    assert response.json() == {'monitor_ids': [2]}
+
+    response = client.get("/monitors/2", headers={"Authorization": f"Bearer {setup_access_token}"})
+    assert response.json()['active'] is False
+
+    response = client.post(
+        "/monitors/pause",
+        json={},
+        headers={"Authorization": f"Bearer {setup_access_token}"}
+    )
+    assert response.json() == {'monitor_ids': [1]}
+
+    response = client.post(
+        "/monitors/resume",
+        json={},
+        headers={"Authorization": f"Bearer {setup_access_token}"}
+    )
+    assert sorted(response.json()['monitor_ids']) == [1, 2]
+
+
+def test_iter_due_monitors_skips_paused_monitors(test_db):
+    from app.services.scheduler import iter_due_monitors
+
+    db = next(override_get_db())
+    db_monitor = crud.monitor.create(db, obj_in=schemas.MonitorCreate(name='test', endpoint='http://google.com', active=False))
+
+    assert list(iter_due_monitors(db, datetime.now() + timedelta(days=1))) == []
+    assert crud.monitor.get_scheduling_data(db, db_monitor.id) is None
+
+
 @patch('app.tasks.send_user_verification_mail.delay')
 def test_create_user(patch_delay, test_db):
     response = client.post(
@@ -468,3 +578,986 @@ def test_create_statuspage(setup_access_token):
         'monitor_ids': [db_monitor.id],
     }
     assert response.status_code == 201
+
+
+@patch('app.core.config.SCHEDULE_TASK_PAGE_SIZE', 2)
+def test_iter_due_monitors_walks_all_monitors(test_db):
+    from app.services.scheduler import iter_due_monitors
+
+    db = next(override_get_db())
+    for i in range(5):
+        crud.monitor.create(db, obj_in=schemas.MonitorCreate(name=f'test {i}', endpoint='http://google.com'))
+
+    due_pages = list(iter_due_monitors(db, datetime.now() + timedelta(days=1)))
+    assert [[due_monitor.id for due_monitor in page] for page in due_pages] == [[1, 2], [3, 4], [5]]
+
+
+def test_iter_due_monitors_skips_not_due_monitors(test_db):
+    from app.services.scheduler import iter_due_monitors
+
+    db = next(override_get_db())
+    now = datetime.now() + timedelta(days=1)
+    for i in range(3):
+        crud.monitor.create(db, obj_in=schemas.MonitorCreate(name=f'test {i}', endpoint='http://google.com'))
+    crud.monitor.update_next_checks(db, next_checks={2: now + timedelta(seconds=120)})
+
+    due_pages = list(iter_due_monitors(db, now))
+    assert [(due_monitor.id, due_monitor.periodicity) for page in due_pages for due_monitor in page] == [(1, 120), (3, 120)]
+
+
+def test_iter_due_monitors_skips_non_positive_periodicity(test_db):
+    from app.services.scheduler import iter_due_monitors
+
+    db = next(override_get_db())
+    for i in range(2):
+        crud.monitor.create(db, obj_in=schemas.MonitorCreate(name=f'test {i}', endpoint='http://google.com'))
+    # created before the periodicity was validated
+    db.query(models.Monitor).filter(models.Monitor.id == 1).update({'periodicity': 0})
+    db.commit()
+
+    due_pages = list(iter_due_monitors(db, datetime.now() + timedelta(days=1)))
+    assert [row.id for page in due_pages for row in page] == [2]
+
+
+def test_database_scheduler_reschedules_at_phase_slot(test_db):
+    from app.services.scheduler import DatabaseScheduler, DueMonitor, get_next_check_at
+
+    db = next(override_get_db())
+    db_monitor = crud.monitor.create(db, obj_in=schemas.MonitorCreate(name='test', endpoint='http://google.com', periodicity=60))
+    now = datetime.now()
+
+    scheduler = DatabaseScheduler(db)
+    assert [due_monitor.id for page in scheduler.iter_due(now) for due_monitor in page] == [db_monitor.id]
+    assert list(scheduler.iter_due(now)) == []
+
+    next_check_at = crud.monitor.get(db, db_monitor.id).next_check_at
+    assert next_check_at == get_next_check_at(DueMonitor(id=db_monitor.id, periodicity=60, request_timeout=30, tenant='user:None'), now)
+    assert now < next_check_at <= now + timedelta(seconds=60)
+
+
+def test_database_scheduler_does_not_fire_missed_checks(test_db):
+    from app.services.scheduler import DatabaseScheduler
+
+    db = next(override_get_db())
+    db_monitor = crud.monitor.create(db, obj_in=schemas.MonitorCreate(name='test', endpoint='http://google.com', periodicity=60))
+    now = datetime.now()
+    crud.monitor.update_next_checks(db, next_checks={db_monitor.id: now - timedelta(hours=1)})
+
+    assert list(DatabaseScheduler(db).iter_due(now)) == [[]]
+    assert now < crud.monitor.get(db, db_monitor.id).next_check_at <= now + timedelta(seconds=60)
+
+
+@pytest.fixture()
+def fake_redis():
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+def test_redis_scheduler_pops_and_reschedules(test_db, fake_redis):
+    from app.services.scheduler import DueMonitor, RedisScheduler, get_next_check_at
+
+    db = next(override_get_db())
+    for i in range(3):
+        crud.monitor.create(db, obj_in=schemas.MonitorCreate(name=f'test {i}', endpoint='http://google.com', periodicity=60))
+    now = datetime.now() + timedelta(seconds=1)
+    scheduler = RedisScheduler(db, fake_redis)
+    # missed for more than the grace period: rescheduled without being dispatched
+    fake_redis.zadd('scheduler:{0}:due', {3: (now - timedelta(hours=1)).timestamp()})
+
+    assert [due_monitor.id for page in scheduler.iter_due(now) for due_monitor in page] == [1, 2]
+    assert [due_monitor for page in scheduler.iter_due(now) for due_monitor in page] == []
+    for monitor_id in (1, 2, 3):
+        due_monitor = DueMonitor(id=monitor_id, periodicity=60, request_timeout=30, tenant='user:None')
+        assert fake_redis.zscore('scheduler:{0}:due', monitor_id) == pytest.approx(get_next_check_at(due_monitor, now).timestamp())
+
+
+def test_redis_scheduler_reload_prunes_deleted_monitors(test_db, fake_redis):
+    from app.services.scheduler import RedisScheduler
+
+    db = next(override_get_db())
+    for i in range(3):
+        crud.monitor.create(db, obj_in=schemas.MonitorCreate(name=f'test {i}', endpoint='http://google.com'))
+    scheduler = RedisScheduler(db, fake_redis)
+    scheduler.load()
+    assert sorted(fake_redis.hkeys('scheduler:{0}:monitors')) == ['1', '2', '3']
+
+    # deleted while the scheduler was not listening
+    crud.monitor.remove(db, id=2)
+    scheduler.load()
+    assert sorted(fake_redis.hkeys('scheduler:{0}:monitors')) == ['1', '2', '3']
+
+    fake_redis.delete('scheduler:{0}:loaded')
+    scheduler.load()
+    assert sorted(fake_redis.hkeys('scheduler:{0}:monitors')) == ['1', '3']
+    assert sorted(fake_redis.zrange('scheduler:{0}:due', 0, -1)) == ['1', '3']
+
+
+def test_monitor_leases(fake_redis):
+    from app.services.lease import acquire_monitor_leases, get_leased_monitor_ids, release_monitor_leases
+
+    with patch('app.services.lease.redis_client', fake_redis):
+        tokens = acquire_monitor_leases([1, 2], ttl_seconds=60)
+        assert set(tokens) == {1, 2}
+        # duplicated delivery of monitor 2
+        assert set(acquire_monitor_leases([2, 3], ttl_seconds=60)) == {3}
+
+        # not the owner of the lease: no-op
+        release_monitor_leases({1: 'foreign token'})
+        assert get_leased_monitor_ids([1, 2, 3, 4]) == {1, 2, 3}
+
+        release_monitor_leases(tokens)
+        assert get_leased_monitor_ids([1, 2, 3, 4]) == {3}
+        assert set(acquire_monitor_leases([1, 2], ttl_seconds=60)) == {1, 2}
+
+
+def test_phase_offsets_spread_consecutive_monitors():
+    from app.services.scheduler import get_phase_offset
+
+    phases = sorted(get_phase_offset(monitor_id, 60) for monitor_id in range(1, 11))
+    assert all(0 <= phase < 60 for phase in phases)
+    assert max(b - a for a, b in zip(phases, phases[1:])) < 12
+
+
+@patch('app.core.config.SCHEDULER_MAX_QUEUE_DEPTH', 100)
+@patch('app.core.config.SCHEDULER_MAX_CONSUMER_LAG_SECONDS', 30)
+def test_queue_status_capacity():
+    from app.services.backpressure import QueueStatus
+
+    assert QueueStatus(depth=10, consumer_lag=1).capacity is None
+    assert QueueStatus(depth=150, consumer_lag=1).capacity == 0
+    assert QueueStatus(depth=40, consumer_lag=60).capacity == 60
+
+
+def test_fair_share_queue_round_robins_tenants():
+    from app.services.fairshare import FairShareQueue
+    from app.services.scheduler import DueMonitor
+
+    fair_share_queue = FairShareQueue()
+    for monitor_id in range(1, 101):
+        fair_share_queue.push(DueMonitor(id=monitor_id, periodicity=30, request_timeout=30, tenant='team:1'))
+    fair_share_queue.push(DueMonitor(id=101, periodicity=30, request_timeout=30, tenant='team:2'))
+    fair_share_queue.push(DueMonitor(id=102, periodicity=30, request_timeout=30, tenant='user:3'))
+
+    dispatched = list(fair_share_queue.drain(capacity=4, usage={'team:1': 10}))
+    assert [due_monitor.id for due_monitor in dispatched] == [101, 102, 1, 2]
+    assert len(fair_share_queue) == 98
+
+
+def test_fair_share_queue_tenant_budget():
+    from app.services.fairshare import FairShareQueue
+    from app.services.scheduler import DueMonitor
+
+    fair_share_queue = FairShareQueue()
+    for monitor_id in range(1, 11):
+        fair_share_queue.push(DueMonitor(id=monitor_id, periodicity=30, request_timeout=30, tenant='team:1'))
+
+    dispatched = list(fair_share_queue.drain(capacity=None, usage={'team:1': 7}, budget=10))
+    assert [due_monitor.id for due_monitor in dispatched] == [1, 2, 3]
+
+
+def test_probe_seconds_averages(test_db, fake_redis):
+    from app import tasks
+    from app.services.lanes import PROBE_SECONDS_KEY, prune_probe_seconds, record_probe_seconds
+
+    db = next(override_get_db())
+    db_monitor = crud.monitor.create(db, obj_in=schemas.MonitorCreate(name='test', endpoint='http://google.com', periodicity=60))
+    with patch('app.services.lanes.redis_client', fake_redis):
+        record_probe_seconds({db_monitor.id: 1.0, 999: 2.0})
+        record_probe_seconds({db_monitor.id: 2.0})
+        assert float(fake_redis.hget(PROBE_SECONDS_KEY, db_monitor.id)) == pytest.approx(1.3)
+
+        # failed probes are recorded too
+        probe_spec = _socket_probe_spec('tcp', 1, id=db_monitor.id)
+        with patch('app.tasks.probe_monitor_group', side_effect=RuntimeError()):
+            assert tasks._check([probe_spec], {}) == []
+        assert float(fake_redis.hget(PROBE_SECONDS_KEY, db_monitor.id)) < 1.3
+
+        # deleted monitors are forgotten
+        prune_probe_seconds(db)
+        assert set(fake_redis.hkeys(PROBE_SECONDS_KEY)) == {str(db_monitor.id)}
+    db.close()
+
+
+def test_schedule_task_dispatches_page_by_page():
+    from unittest.mock import MagicMock
+    from app import tasks
+    from app.services.backpressure import QueueStatus
+    from app.services.scheduler import DueMonitor
+
+    pages = [
+        [DueMonitor(id=monitor_id, periodicity=30, request_timeout=30, tenant=f'team:{monitor_id % 2}') for monitor_id in page]
+        for page in ([1, 2, 3], [4, 5])
+    ]
+
+    def schedule(queue_status):
+        with patch('app.tasks.SessionLocal'), \
+                patch('app.tasks.get_scheduler', return_value=MagicMock(iter_due=lambda now: iter(pages))), \
+                patch('app.tasks.get_queue_status', return_value=queue_status), \
+                patch('app.tasks.get_leased_monitor_ids', return_value=set()), \
+                patch('app.tasks.get_queued_monitor_ids', return_value={5}), \
+                patch('app.tasks.get_tenant_usage', return_value={}), \
+                patch('app.tasks.add_tenant_usage'), patch('app.tasks.mark_queued'), patch('app.tasks.record_publish_seconds'), \
+                patch('app.tasks.prune_probe_seconds'), patch('app.tasks._publish_monitor_tasks', return_value=0.01) as publish:
+            tasks.schedule_task()
+        return [[due_monitor.id for due_monitor in call.args[0]] for call in publish.call_args_list]
+
+    assert schedule(QueueStatus(depth=0, consumer_lag=0)) == [[1, 2, 3], [4]]
+    # degraded with 2 probes of capacity left: at most 2 queued per tenant and shared between them
+    with patch('app.core.config.SCHEDULER_MAX_QUEUE_DEPTH', 10), \
+            patch('app.core.config.SCHEDULER_MAX_CONSUMER_LAG_SECONDS', 30):
+        assert schedule(QueueStatus(depth=8, consumer_lag=60)) == [[1, 2]]
+
+
+@patch('app.core.config.MONITOR_BATCH_SIZE', 2)
+def test_publish_monitor_tasks_in_one_group():
+    from unittest.mock import MagicMock
+    from app import tasks
+    from app.core import config
+    from app.services.scheduler import DueMonitor
+
+    def due_monitor(monitor_id, endpoint, critical=False):
+        probe_spec = _socket_probe_spec('tcp', 80, id=monitor_id, endpoint=endpoint)
+        return DueMonitor(
+            id=monitor_id, periodicity=30, request_timeout=1, tenant='team:1', critical=critical,
+            probe_spec=probe_spec, due_at=1.0,
+        )
+
+    due_monitors = [
+        due_monitor(1, '192.0.2.1'), due_monitor(2, '192.0.2.2'), due_monitor(3, '192.0.2.1'),
+        due_monitor(4, '192.0.2.3', critical=True),
+    ]
+    with patch('app.services.lanes.redis_client') as redis_client, \
+            patch('app.tasks.celery_app.producer_or_acquire', MagicMock()), \
+            patch('app.tasks.group') as group:
+        redis_client.hmget.return_value = [None] * len(due_monitors)
+        tasks._publish_monitor_tasks(due_monitors)
+
+    [batch_tasks] = group.call_args.args
+    group.return_value.apply_async.assert_called_once()
+    assert [
+        (batch_task.options['queue'], [probe_spec['id'] for probe_spec in batch_task.args[0]]) for batch_task in batch_tasks
+    ] == [
+        (config.PROBE_QUEUES['fast'], [1, 3]), (config.PROBE_QUEUES['fast'], [2]), (config.PROBE_QUEUES['priority'], [4]),
+    ]
+    assert batch_tasks[0].kwargs['due_ats'] == [1.0, 1.0]
+
+
+def test_apply_monitor_change_checks_updated_monitor_right_away(test_db):
+    from app.services.scheduler import DatabaseScheduler, apply_monitor_change
+
+    db = next(override_get_db())
+    db_monitor = crud.monitor.create(db, obj_in=schemas.MonitorCreate(name='test', endpoint='http://google.com'))
+    now = datetime.now()
+    crud.monitor.update_next_checks(db, next_checks={db_monitor.id: now + timedelta(hours=1)})
+
+    apply_monitor_change(db, DatabaseScheduler(db), db_monitor.id, 'update', now)
+    assert crud.monitor.get(db, db_monitor.id).next_check_at == now
+
+
+def test_record_outcomes_opens_and_closes_incidents(test_db):
+    from app.services.monitoring import MonitResponse, ProbeSpec
+    from app.services.outcome import MonitorOutcome, record_outcomes
+
+    db = next(override_get_db())
+    db_monitor = crud.monitor.create(db, obj_in=schemas.MonitorCreate(name='test', endpoint='http://google.com'))
+    probe_spec = ProbeSpec.from_monitor(db_monitor)
+
+    failure = MonitorOutcome(probe_spec, datetime(2020, 1, 1, 12, 0, 0), MonitResponse('', 'Timeout', 0, False))
+    [db_incident] = record_outcomes(db, [failure])
+    assert db_incident.started_at == datetime(2020, 1, 1, 12, 0, 0)
+    assert db_incident.request == 'GET http://google.com'
+    assert [event.type for event in db_incident.events] == ['monitoring_failure']
+
+    assert record_outcomes(db, [failure]) == []
+
+    success = MonitorOutcome(probe_spec, datetime(2020, 1, 1, 12, 2, 0), MonitResponse('200 OK', '', 0.1, True))
+    assert record_outcomes(db, [success]) == [db_incident]
+    assert db_incident.ended_at == datetime(2020, 1, 1, 12, 2, 0)
+    assert len(crud.result.get_multi_by_monitor(db, monitor_id=db_monitor.id)) == 3
+
+
+def test_due_monitor_carries_probe_spec(test_db):
+    from app.services.scheduler import DueMonitor
+
+    db = next(override_get_db())
+    db_monitor = crud.monitor.create(db, obj_in=schemas.MonitorCreate(name='test', endpoint='http://google.com'))
+
+    due_monitor = DueMonitor.from_row(crud.monitor.get_scheduling_data(db, db_monitor.id))
+    assert due_monitor.probe_spec.endpoint == 'http://google.com'
+    assert DueMonitor.loads(due_monitor.dumps()) == due_monitor
+
+    crud.monitor.update(db, db_obj=db_monitor, obj_in={'endpoint': 'http://google.es'})
+    updated_due_monitor = DueMonitor.from_row(crud.monitor.get_scheduling_data(db, db_monitor.id))
+    assert updated_due_monitor.probe_spec.endpoint == 'http://google.es'
+
+
+def test_credentials_left_out_of_serialized_specs(test_db):
+    from dataclasses import asdict
+    from app import tasks
+    from app.services.monitoring import ProbeSpec
+    from app.services.scheduler import DueMonitor
+
+    db = next(override_get_db())
+    db_monitor = crud.monitor.create(db, obj_in=schemas.MonitorCreate(
+        name='test', endpoint='http://google.com', auth_user='user', auth_pass='secret',
+    ))
+    due_monitor = DueMonitor.from_row(crud.monitor.get_scheduling_data(db, db_monitor.id))
+    assert due_monitor.probe_spec.auth_pass == 'secret'
+    assert 'secret' not in due_monitor.dumps()
+
+    payload = asdict(due_monitor.probe_spec.without_credentials())
+    assert payload['auth_pass'] is None
+    with patch('app.tasks.SessionLocal', TestingSessionLocal):
+        [probe_spec] = tasks._with_credentials([ProbeSpec(**payload)])
+    assert (probe_spec.auth_user, probe_spec.auth_pass) == ('user', 'secret')
+
+
+@patch('app.core.config.SLOW_LANE_THRESHOLD_SECONDS', 5)
+def test_get_lane():
+    from app.services.lanes import Lane, get_lane
+    from app.services.scheduler import DueMonitor
+
+    due_monitor = DueMonitor(id=1, periodicity=30, request_timeout=30, tenant='team:1')
+    assert get_lane(due_monitor, None) == Lane.fast
+    assert get_lane(due_monitor, 0.2) == Lane.fast
+    assert get_lane(due_monitor, 29.5) == Lane.slow
+
+    critical_monitor = DueMonitor(id=2, periodicity=30, request_timeout=30, tenant='team:1', critical=True)
+    assert get_lane(critical_monitor, 29.5) == Lane.priority
+
+
+def test_find_gaps(test_db):
+    from app.services.freshness import find_gaps
+
+    db = next(override_get_db())
+    now = datetime.now()
+    for name in ('fresh', 'stale', 'never checked'):
+        db_monitor = crud.monitor.create(db, obj_in=schemas.MonitorCreate(name=name, endpoint='http://google.com', periodicity=60))
+        crud.monitor.update(db, db_obj=db_monitor, obj_in={'created_at': now - timedelta(hours=1)})
+    for monitor_id, created_at in ((1, now + timedelta(seconds=100)), (2, now - timedelta(seconds=600))):
+        crud.result.create(db, obj_in=schemas.ResultCreate(created_at=created_at, status=True, monitor_id=monitor_id))
+
+    gaps = find_gaps(db, now + timedelta(seconds=150))
+    assert [(gap.monitor_id, gap.name) for gap in gaps] == [(2, 'stale'), (3, 'never checked')]
+    assert gaps[0].gap_seconds == 750
+
+
+def test_drift_histogram():
+    from app.services.freshness import get_drift_histogram
+
+    histogram = get_drift_histogram([0.05, 0.3, 0.4, 45, 1000])
+    assert histogram['<=0.1s'] == 1
+    assert histogram['<=0.5s'] == 2
+    assert histogram['<=60s'] == 1
+    assert histogram['>300s'] == 1
+    assert sum(histogram.values()) == 5
+
+
+def _socket_probe_spec(monitor_type, port, **kwargs):
+    from app.services.monitoring import ProbeSpec
+
+    return ProbeSpec(**{
+        'id': 1, 'monitor_type': monitor_type, 'endpoint': '127.0.0.1', 'alert_type': 'does_not_contain_keyword',
+        'keyword': 'pong', 'keywords': None, 'keyword_regexes': None, 'keyword_match': 'any', 'request_timeout': 1,
+        'http_method': None, 'request_body': None, 'request_headers': None, 'follow_redirects': None, 'keep_cookies_between_redirects': None, 'verify_ssl': None, 'fresh_connection': None,
+        'ssl_check_expiration': None, 'auth_user': None, 'auth_pass': None, 'num_pings': None, 'port': port,
+        'data': 'ping', 'socket_mode': None, **kwargs,
+    })
+
+
+def test_probe_engine_tcp_checks():
+    import asyncio
+    from app.services.async_monitoring import ProbeEngine
+
+    async def handle(reader, writer):
+        if await reader.read(1024) == b'ping':
+            writer.write(b'pong')
+            await writer.drain()
+        writer.close()
+
+    async def check(probe_specs):
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server, ProbeEngine(concurrency=2) as probe_engine:
+            return await asyncio.gather(*[
+                probe_engine.check(_socket_probe_spec('tcp', port, **probe_spec)) for probe_spec in probe_specs
+            ])
+
+    up, keyword_not_found, timeout = asyncio.run(check([{}, {'keyword': 'nope'}, {'data': None}]))
+    assert (up.status, up.response_representation) == (True, 'pong')
+    assert (keyword_not_found.status, keyword_not_found.incident_cause) == (False, 'Keyword not found')
+    assert (timeout.status, timeout.incident_cause) == (False, 'Timeout')
+
+
+def test_probe_engine_tcp_connection_refused():
+    import asyncio
+    import socket
+    from app.services.async_monitoring import ProbeEngine
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+
+    async def check():
+        async with ProbeEngine(concurrency=1) as probe_engine:
+            return await probe_engine.check(_socket_probe_spec('tcp', port))
+
+    monit_response = asyncio.run(check())
+    assert (monit_response.status, monit_response.incident_cause) == (False, 'Connection refused')
+
+
+@patch('app.core.config.SCHEDULER_MISSED_CHECK_GRACE_SECONDS', 10)
+def test_agent_pops_due_monitors():
+    from app.agent import Agent
+    from app.services.scheduler import DueMonitor
+
+    agent = Agent()
+    now = datetime.now()
+    for monitor_id, due_in in ((1, -5), (2, -60), (3, 30), (4, -1)):
+        agent.monitors[monitor_id] = DueMonitor(id=monitor_id, periodicity=60, request_timeout=30, tenant='team:1')
+        agent.schedule(monitor_id, now.timestamp() + due_in)
+    # deleted monitor
+    del agent.monitors[4], agent.next_checks[4]
+
+    assert [due_monitor.id for due_monitor in agent.pop_due(now)] == [1]
+    assert agent.next_checks[1] > now.timestamp() and agent.next_checks[2] > now.timestamp()
+    assert agent.pop_due(now) == []
+    assert 0 < agent.seconds_to_next_check(now) <= 30
+
+
+@patch('app.core.config.PROBE_COALESCE_WINDOW_SECONDS', 10)
+def test_agent_pulls_forward_same_requests():
+    from app.agent import Agent
+    from app.services.coalescing import get_request_fingerprint
+    from app.services.scheduler import DueMonitor
+
+    agent = Agent()
+    # 10s into a period: the next phase slot of monitor 1 (at 37s) is out of the pops below
+    now = datetime.fromtimestamp(time.time() // 60 * 60 + 10)
+    for monitor_id, due_in, port in ((1, -1, 80), (2, 5, 80), (3, 30, 80), (4, 5, 81)):
+        probe_spec = _socket_probe_spec('tcp', port, id=monitor_id)
+        agent.monitors[monitor_id] = DueMonitor(
+            id=monitor_id, periodicity=60, request_timeout=1, tenant='team:1', probe_spec=probe_spec
+        )
+        agent._fingerprints[monitor_id] = get_request_fingerprint(probe_spec)
+        agent._requests[agent._fingerprints[monitor_id]].add(monitor_id)
+        agent.schedule(monitor_id, now.timestamp() + due_in)
+
+    # 3 is not due within the window, 4 makes another request
+    assert [due_monitor.id for due_monitor in agent.pop_due(now)] == [1, 2]
+    assert agent.next_checks[2] > now.timestamp() + 5
+    assert [due_monitor.id for due_monitor in agent.pop_due(now + timedelta(seconds=6))] == [4]
+
+
+def test_host_connection_pool():
+    from app.services.http_pool import HostConnectionPool
+
+    connection_pool = HostConnectionPool(max_hosts=2, idle_seconds=60, connections_per_host=1)
+    session = connection_pool.session('https://google.com/search', verify_ssl=True)
+    other_session = connection_pool.session('https://google.com:443', verify_ssl=True)
+    assert session.get_adapter('https://google.com/') is other_session.get_adapter('https://google.com:443/')
+    assert session.cookies is not other_session.cookies
+    assert session.get_adapter('https://google.es/') is not other_session.get_adapter('https://google.com/')
+    assert len(connection_pool) == 1
+
+    connection_pool.session('https://google.com', verify_ssl=False)
+    connection_pool.session('http://google.com', verify_ssl=True)
+    assert len(connection_pool) == 2
+
+    with patch('time.monotonic', return_value=time.monotonic() + 120):
+        connection_pool.session('http://google.es', verify_ssl=True)
+    assert len(connection_pool) == 1
+
+
+def test_host_connection_pool_closes_released_adapters():
+    from unittest.mock import MagicMock
+    from app.services.http_pool import HostConnectionPool
+
+    connection_pool = HostConnectionPool(max_hosts=1, idle_seconds=60, connections_per_host=1)
+    session = connection_pool.session('https://google.com', verify_ssl=True)
+    adapter = session.get_adapter('https://google.com/')
+    redirect_adapter = session.get_adapter('https://google.es/')
+    adapter.poolmanager, redirect_adapter.poolmanager = MagicMock(), MagicMock()
+
+    # released by the session, still pooled
+    session.close()
+    redirect_adapter.poolmanager.clear.assert_called_once()
+    adapter.poolmanager.clear.assert_not_called()
+
+    # evicted while a check uses it: closed once released
+    session = connection_pool.session('https://google.com', verify_ssl=True)
+    connection_pool.session('https://google.es', verify_ssl=True)
+    adapter.poolmanager.clear.assert_not_called()
+    session.close()
+    adapter.poolmanager.clear.assert_called_once()
+
+
+def test_dns_cache():
+    import socket
+    from types import SimpleNamespace
+    from unittest.mock import MagicMock
+    import dns.resolver
+    from app.services.dns_cache import DNSCache, DNSResolutionError
+
+    class Answer(list):
+        rrset = SimpleNamespace(ttl=300)
+
+    dns_cache = DNSCache(min_ttl=10, max_ttl=60, negative_ttl=30, max_entries=10, timeout=1)
+    resolver = MagicMock()
+    resolver.resolve.return_value = Answer([SimpleNamespace(address='10.0.0.1')])
+    dns_cache._resolver = resolver
+
+    assert dns_cache.resolve('127.0.0.1') == ['127.0.0.1']
+    assert dns_cache.resolve('google.com') == ['10.0.0.1']
+    assert dns_cache.resolve('google.com') == ['10.0.0.1']
+    assert resolver.resolve.call_count == 1
+
+    # past the clamped TTL a resolver failure serves the last known addresses
+    resolver.resolve.side_effect = dns.resolver.NoNameservers()
+    with patch('time.monotonic', return_value=time.monotonic() + 61):
+        assert dns_cache.resolve('google.com') == ['10.0.0.1']
+
+    resolver.resolve.side_effect = dns.resolver.NXDOMAIN()
+    with patch('socket.getaddrinfo', side_effect=socket.gaierror()), pytest.raises(DNSResolutionError) as exception:
+        dns_cache.resolve('nope.google.com')
+    assert exception.value.incident_cause == 'DNS lookup failure'
+    with pytest.raises(DNSResolutionError):
+        dns_cache.resolve('nope.google.com')
+    assert resolver.resolve.call_count == 3
+
+    # IPv6 only hosts
+    def resolve(hostname, record_type, search):
+        if record_type == 'A':
+            raise dns.resolver.NoAnswer()
+        return Answer([SimpleNamespace(address='2001:db8::1')])
+
+    resolver.resolve.side_effect = resolve
+    assert dns_cache.resolve('ipv6.google.com') == ['2001:db8::1']
+
+
+def test_ssl_expiration_from_certificate_cache():
+    from unittest.mock import MagicMock
+    from app.services.monitoring import get_ssl_expiration_incident_cause
+
+    monitor = MagicMock(endpoint='https://google.com/search', request_timeout=30, ssl_check_expiration=10)
+    with patch('app.services.monitoring.certificate_cache') as certificate_cache:
+        certificate_cache.get.return_value = datetime.utcnow() + timedelta(days=5, hours=1)
+        assert get_ssl_expiration_incident_cause(monitor) == 'SSL certificate expires in 5 days'
+        certificate_cache.get.assert_called_with('google.com', 443)
+
+        certificate_cache.get.return_value = datetime.utcnow() + timedelta(days=90)
+        assert get_ssl_expiration_incident_cause(monitor) == ''
+
+
+def test_body_scanner_finds_keyword_across_chunks():
+    from app.services.matching import KeywordMatcher
+    from app.services.monitoring import BodyScanner
+
+    def scan(keyword):
+        return KeywordMatcher((keyword,), (), match_all=False).scan()
+
+    body_scanner = BodyScanner(scan('needle'), 'utf-8', max_bytes=1000)
+    assert not body_scanner.feed(b'hay ne')
+    assert body_scanner.feed(b'edle hay')
+    assert body_scanner.finish()
+
+    # a multibyte character split in two chunks
+    body_scanner = BodyScanner(scan('café'), 'utf-8', max_bytes=1000)
+    assert not body_scanner.feed('un caf'.encode() + 'é'.encode()[:1])
+    assert body_scanner.feed('é'.encode()[1:])
+
+    body_scanner = BodyScanner(scan('needle'), None, max_bytes=10)
+    assert body_scanner.feed(b'hay hay hay needle')
+    assert not body_scanner.finish()
+    assert body_scanner.read_bytes == 10
+
+
+def test_keyword_matcher():
+    from unittest.mock import MagicMock
+    from app.services.matching import get_matcher
+
+    monitor = MagicMock(keyword='foo', keywords=['bar', 'baz'], keyword_regexes=[r'v\d+\.\d+'], keyword_match='any')
+    assert get_matcher(monitor) is get_matcher(MagicMock(**{
+        attribute: getattr(monitor, attribute) for attribute in ('keyword', 'keywords', 'keyword_regexes', 'keyword_match')
+    }))
+    assert get_matcher(monitor).matches('release v1.2')
+    assert get_matcher(monitor).matches('a baz')
+    assert not get_matcher(monitor).matches('nothing')
+
+    monitor.keyword_match = 'all'
+    keyword_scan = get_matcher(monitor).scan()
+    assert not keyword_scan.feed('foo ba')
+    assert not keyword_scan.feed('r baz release v1.')
+    assert keyword_scan.feed('2 ')
+    assert keyword_scan.matched
+
+
+def test_status_intervals_average_timings():
+    from types import SimpleNamespace
+    from app.services.availability import calculate_status_intervals
+
+    start_date = datetime.now().astimezone().replace(second=0, microsecond=0) - timedelta(minutes=10)
+    results = [
+        SimpleNamespace(status=True, monitored_at=start_date + timedelta(seconds=70), timings={'dns': 0.1, 'ttfb': 0.3}),
+        SimpleNamespace(status=True, monitored_at=start_date + timedelta(seconds=80), timings={'dns': 0.3}),
+        SimpleNamespace(status=False, monitored_at=start_date + timedelta(seconds=190), timings=None),
+    ]
+    status = calculate_status_intervals(results, start_date, timedelta(minutes=1))
+    assert status['timings'][1] == {'dns': pytest.approx(0.2), 'ttfb': pytest.approx(0.3)}
+    assert status['timings'][3] == {}
+
+
+def test_icmp_echo_request_and_ping_response():
+    from app.services.icmp import PingResult, checksum, echo_request
+    from app.services.monitoring import get_ping_response
+
+    packet = echo_request(0x1234, 7, b'abc')
+    assert packet[:1] == b'\x08' and packet[4:8] == b'\x12\x34\x00\x07'
+    assert checksum(packet) == 0
+
+    ping_result = PingResult('192.0.2.1', 3)
+    ping_result.replies = [0.01, 'Request timed out', 0.03]
+    monit_response = get_ping_response(ping_result, 0.001)
+    assert monit_response.status
+    assert monit_response.response_time == pytest.approx(0.02)
+    assert '3 packets transmitted, 2 received, 33% packet loss' in monit_response.response_representation
+
+    ping_result.replies = ['Request timed out'] * 3
+    monit_response = get_ping_response(ping_result, 0.001)
+    assert not monit_response.status
+    assert monit_response.incident_cause == 'Request timed out'
+
+
+def test_icmp_pinger_loopback():
+    import socket
+    from app.services.icmp import ICMPPinger
+
+    icmp_pinger = ICMPPinger(interval=0.01, payload_size=56)
+    try:
+        futures = [icmp_pinger.submit(address, count=3, timeout=1) for _ in range(20) for address in ('127.0.0.1', '::1')]
+    except PermissionError:
+        pytest.skip('ICMP sockets not allowed')
+
+    for future in futures:
+        ping_result = future.result(timeout=5)
+        if ping_result.address == '::1' and socket.AF_INET6 not in icmp_pinger._sockets:
+            assert ping_result.errors[0] == 'IPv6 is not available on the monitoring worker'
+        else:
+            assert ping_result.success and ping_result.loss == 0
+
+
+def test_icmp_pinger_errors():
+    import errno
+    import socket
+    import struct
+    from concurrent.futures import Future
+    from app.services.icmp import (
+        DESTINATION_UNREACHABLE, ECHO_REQUEST_V6, SO_EE_ORIGIN_ICMP, ICMPPinger, _Ping, echo_request, get_error_cause,
+    )
+
+    # struct sock_extended_err of the error queue of datagram sockets, from an ICMP error or the local stack
+    assert get_error_cause(
+        socket.AF_INET, struct.pack('=IBBBBII', errno.EHOSTUNREACH, SO_EE_ORIGIN_ICMP, DESTINATION_UNREACHABLE, 1, 0, 0, 0)
+    ) == 'Destination unreachable'
+    assert get_error_cause(
+        socket.AF_INET, struct.pack('=IBBBBII', errno.EMSGSIZE, 1, 0, 0, 0, 1400, 0)
+    ) == 'Message too long'
+
+    # time exceeded received on a raw ICMPv6 socket, quoting the IPv6 header and the echo request
+    icmp_pinger = ICMPPinger(interval=0.01, payload_size=56)
+    icmp_pinger._identifier, icmp_pinger._in_flight = 7, {}
+    ping = _Ping('2001:db8::1', 1, 1, 0.01)
+    icmp_pinger._in_flight[42] = (ping, 0, 0)
+    ipv6_header = bytes(8) + socket.inet_pton(socket.AF_INET6, '2001:db8::2') + socket.inet_pton(socket.AF_INET6, '2001:db8::1')
+    original_echo = echo_request(7, 42, bytes(8), socket.AF_INET6)
+    assert original_echo[0] == ECHO_REQUEST_V6
+    icmp_pinger._answer_raw_error(socket.AF_INET6, 'TTL expired in transit', ipv6_header + original_echo)
+    assert ping.future.result(timeout=0).errors == ['TTL expired in transit'] and not icmp_pinger._in_flight
+
+    # a stalled loop does not block the probe
+    icmp_pinger.result_grace_seconds = 0
+    with patch.object(icmp_pinger, 'submit', return_value=Future()):
+        ping_result = icmp_pinger.ping('192.0.2.1', count=2, timeout=0.05)
+    assert ping_result.errors == ['Request timed out'] * 2
+
+
+def test_socket_probe_modes():
+    import socket
+    from concurrent.futures import ThreadPoolExecutor
+    from app.services.monitoring import check_monitor
+
+    with socket.socket() as tcp_server, socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_server:
+        # never sends anything
+        tcp_server.bind(('127.0.0.1', 0))
+        tcp_server.listen()
+        udp_server.bind(('127.0.0.1', 0))
+        tcp_port, udp_port = tcp_server.getsockname()[1], udp_server.getsockname()[1]
+
+        start = time.monotonic()
+        connected = check_monitor(_socket_probe_spec('tcp', tcp_port, alert_type='unavailable', data=None))
+        assert connected.status and 'connect' in connected.timings
+        assert time.monotonic() - start < 0.5
+
+        no_banner = check_monitor(_socket_probe_spec('tcp', tcp_port, alert_type='unavailable', socket_mode='expect'))
+        assert (no_banner.status, no_banner.incident_cause) == (False, 'Timeout')
+
+        future = ThreadPoolExecutor(max_workers=1).submit(check_monitor, _socket_probe_spec('udp', udp_port))
+        data, address = udp_server.recvfrom(1024)
+        assert data == b'ping'
+        udp_server.sendto(b'pong', address)
+        assert (future.result().status, future.result().response_representation) == (True, 'pong')
+
+
+def test_socket_probe_ipv6():
+    import socket
+    from app.services.monitoring import check_monitor
+
+    try:
+        server = socket.socket(socket.AF_INET6)
+        server.bind(('::1', 0))
+    except OSError:
+        pytest.skip('no IPv6 loopback')
+
+    with server:
+        server.listen()
+        monit_response = check_monitor(
+            _socket_probe_spec('tcp', server.getsockname()[1], endpoint='::1', alert_type='unavailable', data=None)
+        )
+    assert monit_response.status
+
+
+def test_host_limiter_delays_probes():
+    from app.services.host_limit import HostLimiter
+
+    host_limiter = HostLimiter(max_concurrent=2, per_second=10, max_delay_seconds=1, poll_seconds=0.05)
+    with patch('app.services.host_limit._acquire', side_effect=[100, 50, 0]) as acquire, \
+            patch('app.services.host_limit.redis_client') as redis_client:
+        start = time.monotonic()
+        with host_limiter.hold('192.0.2.1', 10):
+            assert time.monotonic() - start >= 0.15
+        assert acquire.call_count == 3
+        redis_client.zrem.assert_called_once()
+
+    # over the max delay the probe runs anyway
+    with patch('app.services.host_limit._acquire', return_value=5000) as acquire, \
+            patch('app.services.host_limit.redis_client'):
+        with host_limiter.hold('192.0.2.1', 10):
+            pass
+        assert acquire.call_count == 1
+
+    with patch('app.services.host_limit._acquire') as acquire:
+        with host_limiter.hold(None, 10):
+            pass
+        acquire.assert_not_called()
+
+
+def test_request_fingerprint():
+    from app.services.coalescing import get_request_fingerprint, group_by_request
+
+    http_spec = _socket_probe_spec(
+        'http', None, endpoint='HTTPS://Example.com:443', http_method='GET', request_headers={'Accept': 'text/html'},
+        data=None,
+    )
+    same_request = [
+        http_spec,
+        _socket_probe_spec(
+            'http', None, id=2, endpoint='https://example.com/', http_method='get', keyword='other',
+            alert_type='unavailable', request_headers={'accept': 'text/html'}, data=None,
+        ),
+    ]
+    other_requests = [
+        _socket_probe_spec('http', None, id=3, endpoint='https://example.com/other', http_method='GET', data=None),
+        _socket_probe_spec('http', None, id=4, endpoint='https://example.com', http_method='POST', data=None),
+    ]
+    fingerprints = {get_request_fingerprint(probe_spec) for probe_spec in same_request + other_requests}
+    assert len(fingerprints) == 3
+    groups = group_by_request(same_request + other_requests)
+    assert [[probe_spec.id for probe_spec in group] for group in groups] == [[1, 2], [3], [4]]
+    # first occurrence order
+    items = [(4, other_requests[1]), (1, http_spec), (3, other_requests[0]), (2, same_request[1])]
+    groups = group_by_request(items, lambda item: item[1])
+    assert [[item[0] for item in group] for group in groups] == [[4], [1, 2], [3]]
+
+
+def test_check_monitor_group_probes_once():
+    import socket
+    import threading
+    from app.services.monitoring import check_monitor_group
+
+    connections = []
+
+    def serve(server):
+        while True:
+            try:
+                connection, _ = server.accept()
+            except OSError:
+                return
+            connections.append(connection)
+            with connection:
+                connection.recv(1024)
+                connection.sendall(b'pong')
+
+    with socket.socket() as server:
+        server.bind(('127.0.0.1', 0))
+        server.listen()
+        threading.Thread(target=serve, args=(server,), daemon=True).start()
+        port = server.getsockname()[1]
+        found, not_found = check_monitor_group([
+            _socket_probe_spec('tcp', port), _socket_probe_spec('tcp', port, id=2, keyword='nope'),
+        ])
+    assert found.status
+    assert (not_found.status, not_found.incident_cause) == (False, 'Keyword not found')
+    assert len(connections) == 1
+
+
+def test_fresh_connection_session_closed_on_failure():
+    import requests
+    from app.services.monitoring import http_monitoring
+
+    probe_spec = _socket_probe_spec(
+        'http', None, endpoint='http://127.0.0.1/', http_method='GET', fresh_connection=True, alert_type='unavailable',
+    )
+    with patch('app.services.monitoring.new_session') as new_session:
+        new_session.return_value.request.side_effect = requests.exceptions.ConnectTimeout()
+        monit_response = http_monitoring(probe_spec)
+    assert (monit_response.status, monit_response.incident_cause) == (False, 'Timeout')
+    new_session.return_value.close.assert_called_once()
+
+
+def test_async_http_keep_cookies_between_redirects():
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from app.services.async_monitoring import ProbeEngineThread
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/login':
+                self.send_response(302)
+                self.send_header('Location', '/home')
+                self.send_header('Set-Cookie', 'session=1; Path=/')
+                body = b''
+            else:
+                self.send_response(200)
+                body = f"cookie: {self.headers.get('Cookie')}".encode()
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    probe_engine_thread = ProbeEngineThread(concurrency=2)
+
+    def check(keep_cookies):
+        probe_spec = _socket_probe_spec(
+            'http', None, endpoint=f'http://127.0.0.1:{server.server_port}/login', http_method='GET',
+            alert_type='does_not_contain_keyword', keyword='session=1', follow_redirects=True,
+            keep_cookies_between_redirects=keep_cookies, data=None,
+        )
+        return probe_engine_thread.run(lambda probe_engine: probe_engine.check(probe_spec), timeout=5)
+
+    try:
+        assert check(True).status
+        # the same engine, and its connection pool, serves every call of the process
+        assert (check(False).status, check(False).incident_cause) == (False, 'Keyword not found')
+    finally:
+        server.shutdown()
+
+
+def test_cached_dns_transport_ipv6_only_host():
+    import socket
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from types import SimpleNamespace
+    from unittest.mock import AsyncMock
+    import dns.resolver
+    from app.services.async_monitoring import ProbeEngineThread
+    from app.services.dns_cache import DNSCache
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = f"host: {self.headers.get('Host')}".encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class IPv6Server(ThreadingHTTPServer):
+        address_family = socket.AF_INET6
+
+    try:
+        server = IPv6Server(('::1', 0), Handler)
+    except OSError:
+        pytest.skip('IPv6 not available')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    class Answer(list):
+        rrset = SimpleNamespace(ttl=300)
+
+    async def resolve(hostname, record_type, search):
+        if record_type == 'A':
+            raise dns.resolver.NoAnswer()
+        return Answer([SimpleNamespace(address='::1')])
+
+    dns_cache = DNSCache(min_ttl=10, max_ttl=60, negative_ttl=30, max_entries=10, timeout=1)
+    dns_cache._async_resolver = AsyncMock(resolve=AsyncMock(side_effect=resolve))
+    probe_engine_thread = ProbeEngineThread(concurrency=2)
+
+    def check(port):
+        probe_spec = _socket_probe_spec(
+            'http', None, endpoint=f'http://ipv6-only.test:{port}/', http_method='GET',
+            alert_type='does_not_contain_keyword', keyword=f'host: ipv6-only.test:{port}', data=None,
+        )
+        return probe_engine_thread.run(lambda probe_engine: probe_engine.check(probe_spec), timeout=5)
+
+    with patch('app.services.async_monitoring.dns_cache', dns_cache):
+        try:
+            assert check(server.server_port).status
+        finally:
+            server.shutdown()
+            server.server_close()
+        # httpcore errors surface as the httpx ones
+        assert check(server.server_port).incident_cause == 'Connection Error'
+
+
+def test_host_limit_wait_outside_probe_time_and_concurrency():
+    import asyncio
+    from contextlib import asynccontextmanager, contextmanager
+    from app import tasks
+    from app.services.async_monitoring import ProbeEngine
+    from app.services.monitoring import MonitResponse
+
+    @contextmanager
+    def delayed_hold(monitor):
+        time.sleep(0.3)
+        yield
+
+    with patch('app.tasks.hold_probe_host', delayed_hold), \
+            patch('app.tasks.probe_monitor_group', return_value=[MonitResponse('', '', 0.01, True)]):
+        [outcome] = tasks._check([_socket_probe_spec('tcp', 1)], {1: (None, None)})
+    assert outcome.probe_seconds < 0.1
+
+    @asynccontextmanager
+    async def delayed_hold_async(monitor):
+        await asyncio.sleep(0.5 if monitor.id == 1 else 0)
+        yield
+
+    async def check():
+        async with ProbeEngine(concurrency=1) as probe_engine:
+            delayed = asyncio.create_task(probe_engine.check_group([_socket_probe_spec('tcp', 1, alert_type='unavailable')]))
+            await asyncio.sleep(0.05)
+            start = time.monotonic()
+            await probe_engine.check_group([_socket_probe_spec('tcp', 1, id=2, alert_type='unavailable')])
+            not_delayed_seconds = time.monotonic() - start
+            await delayed
+            return not_delayed_seconds
+
+    with patch('app.services.async_monitoring.hold_probe_host', delayed_hold_async):
+        # the delayed probe does not hold the only concurrency slot while it waits
+        assert asyncio.run(check()) < 0.3